@@ -8,7 +8,6 @@ from collections import Counter
 import json
 from datetime import datetime, timedelta
 from typing import List, Dict, Any
-from langchain_openai import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain.output_parsers import PydanticOutputParser
 from pydantic import BaseModel, Field
@@ -17,6 +16,8 @@ import openai
 import tempfile
 import io
 
+from llm_gateway import LLMGateway
+
 # Load environment variables
 env_path = find_dotenv()
 load_dotenv(env_path, override=True)
@@ -26,10 +27,11 @@ app = Flask(__name__)
 # Initialize OpenAI client
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-# Initialize OpenAI LLM
-llm = ChatOpenAI(
+# Initialize OpenAI LLM; calls go through the shared gateway (limits, deadlines, backoff)
+llm_gateway = LLMGateway.from_env()
+llm = LLMGateway.chat_model(
+    "gpt-4",
     openai_api_key=os.getenv("OPENAI_API_KEY"),
-    model="gpt-4",
     temperature=0
 )
 
@@ -107,7 +109,7 @@ def analyze_with_llm(conversation_history: List[Dict]) -> Dict[str, Any]:
 
     # Get analysis from LLM
     analysis_input = analysis_prompt.format(conversation=formatted_conversation)
-    analysis_output = llm.invoke(analysis_input)
+    analysis_output = llm_gateway.invoke(llm, analysis_input, route="analytics")
     
     try:
         # Parse the response into our Pydantic model
@@ -330,6 +332,10 @@ def stream_speech():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/analytics/metrics', methods=['GET'])
+def metrics():
+    return jsonify({'llm_gateway': llm_gateway.stats()})
+
 if __name__ == '__main__':
     port = int(os.getenv('ANALYTICS_PORT', 5001))
     app.run(host='0.0.0.0', port=port, debug=True) 
\ No newline at end of file
@@ -0,0 +1,113 @@
+import hashlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+
+def context_hash(document_context: str) -> str:
+    """
+    Hash of the prompt context, so an answer is only reused for the same source material
+    """
+    return hashlib.blake2b((document_context or "").encode("utf-8"), digest_size=16).hexdigest()
+
+
+class SemanticAnswerCache:
+    """
+    Cache of final streamed answers. A cached answer is served to a new question when
+    it was asked about the same PDF, page and context and its embedding lies within
+    max_distance (cosine distance) of the cached question.
+
+    Answers are stored as the list of streamed segments so they can be replayed
+    as the same SSE event sequence.
+    """
+
+    def __init__(self, max_entries: int = 512, max_distance: float = 0.05, ttl_seconds: float = 3600.0):
+        """
+        Args:
+            max_entries (int): Maximum number of cached answers (LRU across all buckets)
+            max_distance (float): Largest cosine distance between questions that counts as a match
+            ttl_seconds (float): Entry lifetime; 0 disables expiry
+        """
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.ttl_seconds = ttl_seconds
+        self._ids = itertools.count()
+        self._entries = OrderedDict()  # entry id -> (bucket, unit embedding, segments, created_at)
+        self._buckets = {}             # (pdf_path, page, context hash) -> [entry id]
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+    @staticmethod
+    def _unit(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id):
+        # Caller holds the lock
+        bucket = self._entries.pop(entry_id)[0]
+        ids = self._buckets.get(bucket)
+        if ids is not None:
+            ids.remove(entry_id)
+            if not ids:
+                del self._buckets[bucket]
+
+    def lookup(self, embedding: List[float], pdf_path: str, page_number, document_context: str) -> Optional[List[str]]:
+        """
+        Returns:
+            Optional[List[str]]: Streamed answer segments of the closest matching question, or None
+        """
+        bucket = (pdf_path, page_number, context_hash(document_context))
+        query = self._unit(embedding)
+        now = time.time()
+        with self._lock:
+            ids = list(self._buckets.get(bucket, ()))
+            for entry_id in ids:
+                if self.ttl_seconds and now - self._entries[entry_id][3] > self.ttl_seconds:
+                    self._remove(entry_id)
+                    self._stats["expired"] += 1
+            ids = self._buckets.get(bucket, [])
+            if ids:
+                matrix = np.vstack([self._entries[entry_id][1] for entry_id in ids])
+                similarities = matrix @ query
+                best = int(np.argmax(similarities))
+                if 1.0 - float(similarities[best]) <= self.max_distance:
+                    entry_id = ids[best]
+                    self._entries.move_to_end(entry_id)
+                    self._stats["hits"] += 1
+                    return list(self._entries[entry_id][2])
+            self._stats["misses"] += 1
+            return None
+
+    def store(self, embedding: List[float], pdf_path: str, page_number, document_context: str, segments: List[str]):
+        """Cache the streamed segments of a completed answer."""
+        if not segments:
+            return
+        bucket = (pdf_path, page_number, context_hash(document_context))
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = (bucket, self._unit(embedding), list(segments), time.time())
+            self._buckets.setdefault(bucket, []).append(entry_id)
+            self._stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+            stats["max_entries"] = self.max_entries
+            stats["max_distance"] = self.max_distance
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
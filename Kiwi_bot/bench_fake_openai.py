@@ -0,0 +1,177 @@
+"""
+Local stand-in for the OpenAI API, used by bench_query.py.
+
+Serves /v1/embeddings and /v1/chat/completions (streaming and non-streaming)
+with configurable latency, so /query can be load-tested without API keys or
+cost. Embeddings are deterministic hashed bags of tokens: texts sharing words
+get similar vectors, so the synthetic corpus of bench_seed_corpus.py retrieves
+sensibly.
+
+    python bench_fake_openai.py --port 8900 --first-token-ms 300 --token-ms 20
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+import zlib
+
+import numpy as np
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+EMBEDDING_DIM = 1536
+
+_WORD_RE = re.compile(r"\w+")
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # without the BPE files both sides fall back to words
+    _encoding = None
+
+ANSWER_WORDS = ("the gradient of the loss is computed for every parameter and the weights move a small step "
+                "against it until the validation error stops improving see page three for the derivation").split()
+
+
+def tokenize(text: str):
+    """Tokens of text the way OpenAIEmbeddings sends them (cl100k ids when tiktoken works, else words)."""
+    if _encoding is not None:
+        return _encoding.encode(text, disallowed_special=())
+    return _WORD_RE.findall(text.lower())
+
+
+def fake_embedding(tokens) -> list:
+    """Deterministic unit vector of a token sequence (signed feature hashing)."""
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for token in tokens:
+        digest = zlib.crc32(str(token).encode("utf-8"))
+        vector[digest % EMBEDDING_DIM] += 1.0 if digest & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    else:
+        vector[0] = 1.0
+    return vector.tolist()
+
+
+def embed_text(text: str) -> list:
+    return fake_embedding(tokenize(text))
+
+
+class FakeOpenAI:
+    def __init__(self, embedding_ms: float = 30.0, first_token_ms: float = 300.0, token_ms: float = 20.0,
+                 answer_tokens: int = 200, jitter: float = 0.1):
+        self.embedding_ms = embedding_ms
+        self.first_token_ms = first_token_ms
+        self.token_ms = token_ms
+        self.answer_tokens = answer_tokens
+        self.jitter = jitter
+        self.counts = {"embeddings": 0, "embedding_inputs": 0, "chat": 0, "chat_stream": 0, "open_streams": 0,
+                       "peak_open_streams": 0}
+
+    async def _sleep(self, ms: float):
+        if ms > 0:
+            await asyncio.sleep(ms / 1000.0 * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    async def embeddings(self, request):
+        body = await request.json()
+        inputs = body["input"]
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        self.counts["embeddings"] += 1
+        self.counts["embedding_inputs"] += len(inputs)
+        await self._sleep(self.embedding_ms)
+        data = [{"object": "embedding", "index": i,
+                 "embedding": embed_text(item) if isinstance(item, str) else fake_embedding(item)}
+                for i, item in enumerate(inputs)]
+        return JSONResponse({"object": "list", "data": data, "model": body.get("model", "fake-embedding"),
+                             "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+
+    def _answer(self, prompt: str) -> list:
+        """Reply tokens: verdicts for safety checks, a question array for quiz prompts, filler text otherwise."""
+        if "safety evaluator" in prompt:
+            return ["SAFE"]
+        if "Quiz Mode Instructions" in prompt or "multiple-choice questions at" in prompt:
+            question = {"question": f"Which statement about topic {uuid.uuid4().hex[:6]} is correct?",
+                        "options": ["A. One", "B. Two", "C. Three", "D. Four"],
+                        "correctAnswer": "B", "answer": "B", "explanation": "Synthetic benchmark question."}
+            return [json.dumps([question] if "JSON array" in prompt else question)]
+        return [ANSWER_WORDS[i % len(ANSWER_WORDS)] + " " for i in range(self.answer_tokens)]
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+        tokens = self._answer(prompt)
+        model = body.get("model", "fake-chat")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            self.counts["chat"] += 1
+            await self._sleep(self.first_token_ms + self.token_ms * (len(tokens) - 1))
+            return JSONResponse({
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            })
+
+        self.counts["chat_stream"] += 1
+
+        def chunk(delta, finish_reason=None):
+            return "data: " + json.dumps({
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }) + "\n\n"
+
+        async def stream():
+            self.counts["open_streams"] += 1
+            self.counts["peak_open_streams"] = max(self.counts["peak_open_streams"], self.counts["open_streams"])
+            try:
+                await self._sleep(self.first_token_ms)
+                yield chunk({"role": "assistant", "content": ""})
+                for i, token in enumerate(tokens):
+                    if i:
+                        await self._sleep(self.token_ms)
+                    yield chunk({"content": token})
+                yield chunk({}, finish_reason="stop")
+                yield "data: [DONE]\n\n"
+            finally:
+                self.counts["open_streams"] -= 1
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    async def stats(self, request):
+        return JSONResponse(dict(self.counts))
+
+    def app(self) -> Starlette:
+        return Starlette(routes=[
+            Route("/v1/embeddings", self.embeddings, methods=["POST"]),
+            Route("/v1/chat/completions", self.chat_completions, methods=["POST"]),
+            Route("/stats", self.stats),
+        ])
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--embedding-ms", type=float, default=30.0, help="latency of an embeddings request")
+    parser.add_argument("--first-token-ms", type=float, default=300.0, help="latency before the first streamed token")
+    parser.add_argument("--token-ms", type=float, default=20.0, help="gap between streamed tokens")
+    parser.add_argument("--answer-tokens", type=int, default=200, help="tokens per answer")
+    parser.add_argument("--jitter", type=float, default=0.1, help="relative random variation of every delay")
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(args.embedding_ms, args.first_token_ms, args.token_ms, args.answer_tokens, args.jitter)
+    uvicorn.run(fake.app(), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
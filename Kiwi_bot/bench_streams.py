@@ -0,0 +1,130 @@
+"""
+Concurrent-stream capacity benchmark for /query.
+
+Opens N simultaneous SSE streams against one or more running servers and reports
+how many completed, how many were open at the same time, and time-to-first-byte /
+total latency percentiles. Compare the sync Flask server with the async one:
+
+    # sync: python kiwi_flask.py (or gunicorn -w 4 kiwi_flask:app -b :5000)
+    # async: uvicorn kiwi_asgi:app --port 8000
+    python bench_streams.py --target sync=http://localhost:5000 --target async=http://localhost:8000 \
+        --concurrency 50,200,1000
+
+Point OPENAI_API_BASE of both servers at the same (stub) endpoint so the model
+latency is identical and no tokens are billed.
+"""
+import argparse
+import asyncio
+import json
+import math
+import time
+
+import httpx
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    # Nearest-rank percentile
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+async def one_stream(client, url, payload, state, timeout):
+    start = time.perf_counter()
+    ttfb = None
+    try:
+        async with client.stream("POST", f"{url}/query", json=payload, timeout=timeout) as response:
+            if response.status_code != 200:
+                return {"ok": False, "error": f"HTTP {response.status_code}"}
+            completed = False
+            async for line in response.aiter_lines():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+                    state["open"] += 1
+                    state["peak_open"] = max(state["peak_open"], state["open"])
+                if line.startswith("data: "):
+                    event = json.loads(line[6:])
+                    if "error" in event:
+                        return {"ok": False, "error": event["error"]}
+                    completed = completed or bool(event.get("complete")) or "answer" in event
+            return {"ok": completed, "ttfb": ttfb, "total": time.perf_counter() - start,
+                    "error": None if completed else "stream ended without an answer"}
+    except Exception as e:
+        return {"ok": False, "error": type(e).__name__}
+    finally:
+        if ttfb is not None:
+            state["open"] -= 1
+
+
+async def run_level(url, concurrency, payload, timeout):
+    state = {"open": 0, "peak_open": 0}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits) as client:
+        start = time.perf_counter()
+        results = await asyncio.gather(*[
+            one_stream(client, url, dict(payload, user_id=f"bench-{i}"), state, timeout) for i in range(concurrency)
+        ])
+        wall = time.perf_counter() - start
+    ok = [r for r in results if r["ok"]]
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    ttfb = [r["ttfb"] for r in ok]
+    total = [r["total"] for r in ok]
+    return {
+        "concurrency": concurrency,
+        "completed": len(ok),
+        "failed": len(results) - len(ok),
+        "errors": errors,
+        "peak_open_streams": state["peak_open"],
+        "wall_seconds": round(wall, 3),
+        "ttfb_p50": percentile(ttfb, 50), "ttfb_p95": percentile(ttfb, 95), "ttfb_p99": percentile(ttfb, 99),
+        "total_p50": percentile(total, 50), "total_p95": percentile(total, 95), "total_p99": percentile(total, 99),
+    }
+
+
+def fmt(value):
+    return "-" if value is None else f"{value:.3f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", action="append", required=True, help="name=base_url, repeatable")
+    parser.add_argument("--concurrency", default="10,50,200", help="comma-separated stream counts")
+    parser.add_argument("--query", default="What is gradient descent?")
+    parser.add_argument("--pdf-path", default=None)
+    parser.add_argument("--page", type=int, default=None)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--json", dest="json_path", help="also write the results to this file")
+    args = parser.parse_args()
+
+    # Answer cache off so every stream really generates
+    payload = {"query": args.query, "use_answer_cache": False}
+    if args.pdf_path:
+        payload["pdf_path"] = args.pdf_path
+    if args.page is not None:
+        payload["pageNumber"] = args.page
+
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    results = {}
+    for target in args.target:
+        name, url = target.split("=", 1)
+        results[name] = []
+        for concurrency in levels:
+            result = asyncio.run(run_level(url.rstrip("/"), concurrency, payload, args.timeout))
+            results[name].append(result)
+            print(f"{name:>8} c={concurrency:<5} ok={result['completed']:<5} failed={result['failed']:<5} "
+                  f"peak_open={result['peak_open_streams']:<5} ttfb p50/p95={fmt(result['ttfb_p50'])}/{fmt(result['ttfb_p95'])}s "
+                  f"total p50/p95={fmt(result['total_p50'])}/{fmt(result['total_p95'])}s wall={result['wall_seconds']}s")
+            if result["errors"]:
+                print(f"{'':>8} errors: {result['errors']}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
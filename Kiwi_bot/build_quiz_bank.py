@@ -0,0 +1,124 @@
+"""
+Offline quiz bank builder, run after pdf_embedding_2.py.
+
+Generates multiple-choice questions for every page range and difficulty of the
+embedded PDFs and stores them in "QuizBankQuestion", so /generate_quiz and quiz
+mode in /query can serve questions without an LLM call or a vector search.
+
+    python build_quiz_bank.py                      # PDFs that have no bank questions yet
+    python build_quiz_bank.py --rebuild --pdf public/mlpdf/lecture1.pdf
+"""
+import argparse
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+from tqdm import tqdm
+
+from db_pool import ConnectionPool
+from llm_gateway import LLMGateway
+from quiz_bank import QUIZ_BANK_DDL, store_questions
+from quiz_generation import QuizGenerator, build_quiz_prompt
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+
+def load_page_ranges(cursor, pdf_path: str, pages_per_range: int):
+    """
+    Chunks of a PDF grouped into consecutive page ranges
+    Returns:
+        List[Tuple[int, int, List[Dict]]]: (first page, last page, chunks) per range
+    """
+    cursor.execute(
+        'SELECT content, "pageNumber", "pdfName" FROM "PdfChunk" WHERE "pdfPath" = %s ORDER BY "pageNumber"',
+        (pdf_path,)
+    )
+    ranges = {}
+    for content, page, pdf_name in cursor.fetchall():
+        chunk = {"content": content, "metadata": {"page": page, "pdf_name": pdf_name, "pdf_path": pdf_path}}
+        ranges.setdefault(page // pages_per_range, []).append(chunk)
+    return [(chunks[0]["metadata"]["page"], chunks[-1]["metadata"]["page"], chunks)
+            for _, chunks in sorted(ranges.items())]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Quiz Bank Builder')
+    parser.add_argument('--pdf', action='append', help='PDF path to process (repeatable); default: all embedded PDFs')
+    parser.add_argument('--prefixes', default='public/lapdf,public/mlpdf', help='only PDFs under these path prefixes')
+    parser.add_argument('--difficulties', default='easy,medium,hard')
+    parser.add_argument('--pages-per-range', type=int, default=5, help='pages covered by one group of questions')
+    parser.add_argument('--questions-per-range', type=int, default=5, help='questions per page range and difficulty')
+    parser.add_argument('--workers', type=int, default=4, help='page ranges generated concurrently')
+    parser.add_argument('--rebuild', action='store_true', help='replace the bank questions of the selected PDFs')
+    parser.add_argument('--limit', type=int, default=0, help='process at most this many PDFs (0 = all)')
+    args = parser.parse_args()
+
+    difficulties = [d.strip() for d in args.difficulties.split(',') if d.strip()]
+    pool = ConnectionPool.from_env("DATABASE_URL3", minconn=1, maxconn=args.workers + 1,
+                                   statement_timeout_ms=120000, application_name="build_quiz_bank")
+    gateway = LLMGateway.from_env()
+    llm = LLMGateway.chat_model(os.getenv("QUIZ_BANK_MODEL", "gpt-4"), openai_api_key=os.getenv("OPENAI_API_KEY"))
+    generator = QuizGenerator(max_workers=args.workers, questions_per_call=args.questions_per_range)
+
+    with pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(QUIZ_BANK_DDL)
+            if args.pdf:
+                pdf_paths = args.pdf
+            else:
+                cursor.execute('SELECT DISTINCT "pdfPath" FROM "PdfChunk" WHERE "pdfPath" IS NOT NULL')
+                prefixes = tuple(p.strip() for p in args.prefixes.split(',') if p.strip())
+                pdf_paths = sorted(row[0] for row in cursor.fetchall() if row[0].startswith(prefixes))
+            if not args.rebuild:
+                cursor.execute('SELECT DISTINCT "pdfPath" FROM "QuizBankQuestion"')
+                banked = {row[0] for row in cursor.fetchall()}
+                pdf_paths = [path for path in pdf_paths if path not in banked]
+        conn.commit()
+
+    if args.limit > 0:
+        pdf_paths = pdf_paths[:args.limit]
+    if not pdf_paths:
+        logging.info("All selected PDFs already have quiz bank questions.")
+        return
+    logging.info(f"Building quiz bank for {len(pdf_paths)} PDFs ({', '.join(difficulties)})")
+
+    def build_range(pdf_path, page_start, page_end, chunks, difficulty):
+        generate = lambda group, count, exclude: gateway.invoke(
+            llm, build_quiz_prompt(group, count, difficulty, exclude), route="quiz_bank").content
+        questions = list(generator.generate(generate, chunks, args.questions_per_range))
+        with pool.connection() as conn:
+            with conn.cursor() as cursor:
+                store_questions(cursor, pdf_path, page_start, page_end, difficulty, questions)
+            conn.commit()
+        return len(questions)
+
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    try:
+        for pdf_path in tqdm(pdf_paths, desc="PDFs"):
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    if args.rebuild:
+                        cursor.execute('DELETE FROM "QuizBankQuestion" WHERE "pdfPath" = %s', (pdf_path,))
+                    page_ranges = load_page_ranges(cursor, pdf_path, args.pages_per_range)
+                conn.commit()
+
+            futures = [executor.submit(build_range, pdf_path, start, end, chunks, difficulty)
+                       for start, end, chunks in page_ranges for difficulty in difficulties]
+            stored = 0
+            for future in tqdm(as_completed(futures), total=len(futures), desc=pdf_path, leave=False):
+                try:
+                    stored += future.result()
+                except Exception as e:
+                    logging.error(f"Failed to build a page range of {pdf_path}: {e}")
+            logging.info(f"Stored {stored} questions for {pdf_path} ({len(page_ranges)} page ranges)")
+    finally:
+        executor.shutdown()
+        logging.info(f"LLM gateway: {gateway.stats()}")
+        pool.closeall()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import os
+import re
+import threading
+from typing import Callable, Dict, List, Tuple
+
+try:
+    import tiktoken
+except ImportError:  # token counts fall back to a characters / 4 estimate
+    tiktoken = None
+
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def _shingles(text: str, size: int = 5) -> set:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _suffix_prefix_overlap(a: str, b: str, min_overlap: int = 40, max_overlap: int = 400) -> int:
+    """Length of the longest suffix of a that is also a prefix of b (0 if shorter than min_overlap)."""
+    if len(a) < min_overlap or len(b) < min_overlap:
+        return 0
+    tail = a[-max_overlap:]
+    probe = b[:min_overlap]
+    start = tail.find(probe)
+    while start != -1:
+        if b.startswith(tail[start:]):
+            return len(tail) - start
+        start = tail.find(probe, start + 1)
+    return 0
+
+
+class ContextPacker:
+    """
+    Fills a per-model token budget with retrieved chunks in relevance order.
+
+    Chunks that are near-duplicates of already packed text are dropped, text
+    repeated by the splitter's chunk overlap is trimmed from neighbouring chunks
+    of the same PDF, and entries are only ever added whole, so citation links
+    are never cut.
+    """
+
+    def __init__(self, default_budget: int = 3000, budgets: Dict[str, int] = None, dedup_threshold: float = 0.8):
+        """
+        Args:
+            default_budget (int): Context tokens for models without an explicit budget
+            budgets (Dict[str, int]): Context tokens per model name
+            dedup_threshold (float): Share of a chunk's 5-word shingles already packed that makes it a duplicate
+        """
+        self.default_budget = default_budget
+        self.budgets = dict(budgets or {})
+        self.dedup_threshold = dedup_threshold
+        self._encodings = {}
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "tokens_used": 0, "tokens_saved": 0, "duplicates_dropped": 0,
+                       "over_budget_dropped": 0}
+
+    @classmethod
+    def from_env(cls) -> "ContextPacker":
+        """
+        Packer configured by CONTEXT_TOKEN_BUDGET, CONTEXT_TOKEN_BUDGETS
+        ("model=tokens,...") and CONTEXT_DEDUP_THRESHOLD.
+        """
+        budgets = {}
+        for item in os.getenv("CONTEXT_TOKEN_BUDGETS", "gpt-4=3000,gpt-4o=12000,gpt-4o-mini=12000").split(","):
+            if "=" in item:
+                model, tokens = item.split("=", 1)
+                budgets[model.strip()] = int(tokens)
+        return cls(
+            default_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000)),
+            budgets=budgets,
+            dedup_threshold=float(os.getenv("CONTEXT_DEDUP_THRESHOLD", 0.8)),
+        )
+
+    def budget_for(self, model: str) -> int:
+        return self.budgets.get(model, self.default_budget)
+
+    def _encoding(self, model: str):
+        if tiktoken is None:
+            return None
+        if model not in self._encodings:
+            try:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except (KeyError, TypeError):
+                    encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                # tiktoken downloads its BPE files on first use; estimate when that is not possible
+                print(f"Warning: Failed to load tokenizer for {model}, estimating token counts: {e}")
+                encoding = None
+            self._encodings[model] = encoding
+        return self._encodings[model]
+
+    def count_tokens(self, text: str, model: str = None) -> int:
+        encoding = self._encoding(model)
+        if encoding is None:
+            return (len(text) + 3) // 4
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def pack(self, chunks: List[Dict], render: Callable[[Dict], str], model: str = None,
+             reserved_tokens: int = 0, separator: str = "\n---\n") -> Tuple[List[Dict], dict]:
+        """
+        Select chunks for the prompt.
+
+        Args:
+            chunks (List[Dict]): Candidates, most relevant first
+            render (Callable[[Dict], str]): Formats one chunk as it appears in the prompt (citation + content)
+            model (str): Model name used for the budget and the tokenizer
+            reserved_tokens (int): Budget already spent on other context (e.g. the current page)
+            separator (str): Text placed between entries
+        Returns:
+            Tuple[List[Dict], dict]: Packed chunks (content possibly trimmed), in input order, and a report
+        """
+        budget = max(self.budget_for(model) - reserved_tokens, 0)
+        separator_tokens = self.count_tokens(separator, model)
+        packed = []
+        seen_shingles = set()
+        candidate_tokens = used = duplicates = over_budget = trimmed = 0
+
+        for chunk in chunks:
+            original_tokens = self.count_tokens(render(chunk), model) + separator_tokens
+            candidate_tokens += original_tokens
+
+            shingles = _shingles(chunk['content'])
+            if shingles and len(shingles & seen_shingles) / len(shingles) >= self.dedup_threshold:
+                duplicates += 1
+                continue
+
+            # Trim text repeated by the chunk overlap with neighbours already packed from the same PDF
+            content = chunk['content']
+            path = chunk['metadata'].get('pdf_path')
+            for kept in packed:
+                if kept['metadata'].get('pdf_path') != path:
+                    continue
+                head = _suffix_prefix_overlap(kept['content'], content)
+                if head:
+                    content = content[head:].lstrip()
+                tail = _suffix_prefix_overlap(content, kept['content'])
+                if tail:
+                    content = content[:-tail].rstrip()
+            if not content.strip():
+                duplicates += 1
+                continue
+            if content != chunk['content']:
+                chunk = {**chunk, "content": content}
+
+            tokens = self.count_tokens(render(chunk), model) + separator_tokens
+            if used + tokens > budget:
+                over_budget += 1
+                continue
+            trimmed += original_tokens - tokens
+            used += tokens
+            packed.append(chunk)
+            seen_shingles |= shingles
+
+        report = {
+            "model": model,
+            "budget": self.budget_for(model),
+            "reserved_tokens": reserved_tokens,
+            "tokens_used": used + reserved_tokens,
+            "tokens_saved": candidate_tokens - used,
+            "overlap_tokens_trimmed": trimmed,
+            "chunks_in": len(chunks),
+            "chunks_packed": len(packed),
+            "duplicates_dropped": duplicates,
+            "over_budget_dropped": over_budget,
+        }
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["tokens_used"] += report["tokens_used"]
+            self._stats["tokens_saved"] += report["tokens_saved"]
+            self._stats["duplicates_dropped"] += duplicates
+            self._stats["over_budget_dropped"] += over_budget
+        return packed, report
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["default_budget"] = self.default_budget
+        stats["budgets"] = dict(self.budgets)
+        stats["tokenizer"] = {model or "default": "tiktoken" if encoding is not None else "estimate"
+                              for model, encoding in list(self._encodings.items())}
+        return stats
@@ -0,0 +1,97 @@
+import threading
+import time
+
+# Single-row table holding a counter that ingestion scripts bump whenever they change "PdfChunk"
+CORPUS_STATE_DDL = """
+    CREATE TABLE IF NOT EXISTS "CorpusState" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "generation" BIGINT NOT NULL DEFAULT 0,
+        "updatedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+def bump_corpus_generation(cursor) -> int:
+    """
+    Increment the corpus generation. Call inside the transaction that modifies "PdfChunk",
+    so servers never see the new generation before the new rows.
+    Args:
+        cursor: psycopg2 cursor
+    Returns:
+        int: The new generation
+    """
+    cursor.execute(CORPUS_STATE_DDL)
+    cursor.execute("""
+        INSERT INTO "CorpusState" ("id", "generation", "updatedAt")
+        VALUES (1, 1, CURRENT_TIMESTAMP)
+        ON CONFLICT ("id") DO UPDATE
+        SET "generation" = "CorpusState"."generation" + 1, "updatedAt" = CURRENT_TIMESTAMP
+        RETURNING "generation"
+    """)
+    return cursor.fetchone()[0]
+
+
+class CorpusGeneration:
+    """
+    Server-side view of the corpus generation counter. The value is re-read from
+    the database at most once per poll_interval, so checking it is free on the hot path.
+    Callbacks registered with on_change() run when a new generation is observed.
+    """
+
+    def __init__(self, pool, poll_interval: float = 5.0):
+        """
+        Args:
+            pool (ConnectionPool): Pool used for the polling query
+            poll_interval (float): Seconds a read value is trusted
+        """
+        self.pool = pool
+        self.poll_interval = poll_interval
+        self._generation = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def on_change(self, callback):
+        """Register callback(old_generation, new_generation)."""
+        self._callbacks.append(callback)
+
+    def _read(self) -> int:
+        with self.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""SELECT to_regclass('"CorpusState"') IS NOT NULL""")
+            if not cursor.fetchone()[0]:
+                return 0
+            cursor.execute('SELECT "generation" FROM "CorpusState" WHERE "id" = 1')
+            row = cursor.fetchone()
+            return row[0] if row else 0
+
+    def current(self) -> int:
+        """
+        Returns:
+            int: The last known generation (possibly up to poll_interval seconds old)
+        """
+        if self._generation is not None and time.monotonic() - self._checked_at < self.poll_interval:
+            return self._generation
+        # Only one thread polls; the others keep using the value they already have
+        if not self._lock.acquire(blocking=self._generation is None):
+            return self._generation
+        try:
+            if self._generation is not None and time.monotonic() - self._checked_at < self.poll_interval:
+                return self._generation
+            try:
+                generation = self._read()
+            except Exception as e:
+                print(f"Warning: Failed to read corpus generation: {e}")
+                generation = self._generation if self._generation is not None else 0
+            old, self._generation = self._generation, generation
+            self._checked_at = time.monotonic()
+        finally:
+            self._lock.release()
+
+        if old is not None and generation != old:
+            print(f"Corpus generation changed: {old} -> {generation}")
+            for callback in self._callbacks:
+                try:
+                    callback(old, generation)
+                except Exception as e:
+                    print(f"Warning: Corpus generation callback failed: {e}")
+        return generation
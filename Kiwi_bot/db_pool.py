@@ -0,0 +1,310 @@
+import os
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+
+class PoolTimeout(PoolError):
+    """Raised when no connection becomes available within the acquire timeout."""
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of warm Postgres connections.
+
+    Session settings (statement timeout, application name) are passed as
+    startup options, so they are applied once per physical connection rather
+    than with an extra SET round trip per request. The SSL mode that worked
+    for the first connection is remembered and reused for every later one.
+    """
+
+    def __init__(self, db_url: str, minconn: int = 2, maxconn: int = 10,
+                 statement_timeout_ms: int = 30000, acquire_timeout: float = 10.0,
+                 health_check_interval: float = 30.0, max_lifetime: float = 1800.0,
+                 sslmode: str = None, application_name: str = "kiwi_bot"):
+        """
+        Args:
+            db_url (str): postgres:// connection URL
+            minconn (int): Connections opened by warm() and kept idle
+            maxconn (int): Hard cap on open connections
+            statement_timeout_ms (int): Per-connection statement_timeout
+            acquire_timeout (float): Seconds getconn() waits for a free connection
+            health_check_interval (float): Idle seconds after which a connection is pinged before reuse
+            max_lifetime (float): Seconds after which a connection is recycled
+            sslmode (str, optional): Fixed SSL mode; if omitted, 'require' is tried first, then 'prefer'
+            application_name (str): Reported in pg_stat_activity
+        """
+        if not db_url:
+            raise ValueError("Database URL is not set")
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"Invalid pool size: minconn={minconn}, maxconn={maxconn}")
+
+        parsed = urlparse(db_url)
+        self._connect_kwargs = {
+            "dbname": parsed.path[1:],  # Remove leading slash
+            "user": parsed.username,
+            "password": parsed.password,
+            "host": parsed.hostname,
+            "port": parsed.port or 5432,
+            "application_name": application_name,
+            "options": f"-c statement_timeout={int(statement_timeout_ms)}",
+            "keepalives": 1,
+            "keepalives_idle": 30,
+        }
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self.max_lifetime = max_lifetime
+
+        self._sslmode = sslmode
+        self._ssl_lock = threading.Lock()
+
+        self._cond = threading.Condition()
+        self._idle = deque()        # (conn, created_at, last_used)
+        self._in_use = {}           # id(conn) -> (conn, created_at)
+        self._opening = 0
+        self._closed = False
+
+        self._stats = {
+            "connections_created": 0,
+            "connections_closed": 0,
+            "connections_failed": 0,
+            "health_check_failures": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "total_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+        }
+
+    @classmethod
+    def from_env(cls, env_var: str = "DATABASE_URL3", **kwargs) -> "ConnectionPool":
+        """
+        Build a pool from the URL in env_var. Pool sizing can be overridden with
+        DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT and DB_SSLMODE.
+        """
+        kwargs.setdefault("minconn", int(os.getenv("DB_POOL_MIN", 2)))
+        kwargs.setdefault("maxconn", int(os.getenv("DB_POOL_MAX", 10)))
+        kwargs.setdefault("acquire_timeout", float(os.getenv("DB_POOL_TIMEOUT", 10)))
+        kwargs.setdefault("sslmode", os.getenv("DB_SSLMODE") or None)
+        return cls(os.getenv(env_var), **kwargs)
+
+    # ---------- Physical connections ----------
+
+    def _connect(self):
+        if self._sslmode:
+            return psycopg2.connect(sslmode=self._sslmode, **self._connect_kwargs)
+
+        # Resolve the SSL mode once; concurrent first connections wait for the answer
+        with self._ssl_lock:
+            if self._sslmode:
+                return psycopg2.connect(sslmode=self._sslmode, **self._connect_kwargs)
+            try:
+                conn = psycopg2.connect(sslmode="require", **self._connect_kwargs)
+                self._sslmode = "require"
+            except psycopg2.OperationalError as e:
+                print(f"Database connection with sslmode=require failed ({e}), falling back to sslmode=prefer")
+                conn = psycopg2.connect(sslmode="prefer", **self._connect_kwargs)
+                self._sslmode = "prefer"
+            print(f"Database SSL mode resolved to '{self._sslmode}'")
+            return conn
+
+    def _open_connection(self):
+        """Open a new physical connection. Caller must already hold an _opening slot."""
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._opening -= 1
+                self._stats["connections_failed"] += 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._opening -= 1
+            self._stats["connections_created"] += 1
+        return conn, time.monotonic()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._stats["connections_closed"] += 1
+
+    def _is_healthy(self, conn, created_at: float, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if self.max_lifetime and now - created_at > self.max_lifetime:
+            return False
+        if now - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            self._stats["health_check_failures"] += 1
+            return False
+
+    # ---------- Checkout / return ----------
+
+    def getconn(self, timeout: float = None):
+        """
+        Borrow a connection, waiting up to timeout seconds when the pool is exhausted.
+        Returns:
+            psycopg2.connection: Connection that must be handed back with putconn()
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        waited = False
+
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolError("connection pool is closed")
+                    if self._idle:
+                        conn, created_at, last_used = self._idle.pop()
+                        action = "reuse"
+                        break
+                    if len(self._in_use) + self._opening < self.maxconn:
+                        self._opening += 1
+                        action = "open"
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"No database connection available after {timeout:.1f}s "
+                            f"({len(self._in_use)} in use, max {self.maxconn})"
+                        )
+                    waited = True
+                    self._cond.wait(remaining)
+
+            if action == "open":
+                conn, created_at = self._open_connection()
+            elif not self._is_healthy(conn, created_at, last_used):
+                with self._cond:
+                    self._discard(conn)
+                continue
+
+            wait_ms = (time.monotonic() - start) * 1000
+            with self._cond:
+                self._in_use[id(conn)] = (conn, created_at)
+                self._stats["checkouts"] += 1
+                if waited:
+                    self._stats["waits"] += 1
+                self._stats["total_wait_ms"] += wait_ms
+                self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+            return conn
+
+    def putconn(self, conn, discard: bool = False):
+        """
+        Return a borrowed connection. Open transactions are rolled back and
+        autocommit is reset so the next borrower starts from a clean state.
+        """
+        with self._cond:
+            entry = self._in_use.pop(id(conn), None)
+        if entry is None:
+            raise PoolError("trying to put back a connection that was not borrowed from this pool")
+        _, created_at = entry
+
+        if not discard and not conn.closed:
+            try:
+                if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except Exception:
+                discard = True
+
+        with self._cond:
+            if discard or conn.closed or self._closed:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, created_at, time.monotonic()))
+            self._cond.notify()
+
+    class _Borrowed:
+        def __init__(self, pool, timeout):
+            self._pool = pool
+            self._timeout = timeout
+            self._conn = None
+
+        def __enter__(self):
+            self._conn = self._pool.getconn(self._timeout)
+            return self._conn
+
+        def __exit__(self, exc_type, exc, tb):
+            # A connection-level failure leaves the socket in an unknown state
+            broken = exc_type is not None and issubclass(exc_type, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            self._pool.putconn(self._conn, discard=broken)
+            return False
+
+    def connection(self, timeout: float = None):
+        """
+        Context manager that borrows a connection and always returns it.
+        Usage:
+            with pool.connection() as conn:
+                ...
+        """
+        return ConnectionPool._Borrowed(self, timeout)
+
+    # ---------- Lifecycle ----------
+
+    def warm(self) -> int:
+        """
+        Open connections until minconn are idle or in use.
+        Returns:
+            int: Number of connections opened
+        """
+        opened = 0
+        while True:
+            with self._cond:
+                if self._closed or len(self._idle) + len(self._in_use) + self._opening >= self.minconn:
+                    return opened
+                self._opening += 1
+            conn, created_at = self._open_connection()
+            with self._cond:
+                self._idle.append((conn, created_at, time.monotonic()))
+                self._cond.notify()
+            opened += 1
+
+    def closeall(self):
+        """Close idle connections and refuse new checkouts; borrowed ones are closed when returned."""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _, _ = self._idle.pop()
+                self._discard(conn)
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Pool gauges (in_use, idle) and cumulative counters
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "opening": self._opening,
+                "minconn": self.minconn,
+                "maxconn": self.maxconn,
+                "sslmode": self._sslmode,
+            })
+        checkouts = stats["checkouts"] or 1
+        stats["avg_wait_ms"] = round(stats["total_wait_ms"] / checkouts, 3)
+        stats["total_wait_ms"] = round(stats["total_wait_ms"], 3)
+        stats["max_wait_ms"] = round(stats["max_wait_ms"], 3)
+        return stats
@@ -0,0 +1,204 @@
+import atexit
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+
+
+def normalize_query(text: str) -> str:
+    """
+    Normalize query text for cache lookups: trim, collapse whitespace and casefold
+    so trivially different spellings of the same question share an entry.
+    """
+    return re.sub(r"\s+", " ", text or "").strip().casefold()
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU + TTL cache of query embeddings keyed by (model, normalized text).
+    Optionally persisted to a .npz file so hits survive restarts.
+    """
+
+    def __init__(self, max_entries: int = 2048, ttl_seconds: float = 3600.0,
+                 persist_path: str = None, persist_interval: float = 60.0):
+        """
+        Args:
+            max_entries (int): Maximum number of cached embeddings
+            ttl_seconds (float): Entry lifetime; 0 disables expiry
+            persist_path (str, optional): .npz file to load from and save to
+            persist_interval (float): Minimum seconds between background saves
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+        self.persist_interval = persist_interval
+
+        self._entries = OrderedDict()  # (model, text) -> (embedding, created_at wall-clock)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._last_save = time.time()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "loaded": 0, "saves": 0}
+
+        if persist_path:
+            self.load()
+            atexit.register(self.save)
+
+    @classmethod
+    def from_env(cls) -> "EmbeddingCache":
+        """
+        Build a cache configured by EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL
+        and EMBEDDING_CACHE_PATH (unset disables persistence).
+        """
+        return cls(
+            max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", 2048)),
+            ttl_seconds=float(os.getenv("EMBEDDING_CACHE_TTL", 3600)),
+            persist_path=os.getenv("EMBEDDING_CACHE_PATH") or None,
+        )
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return bool(self.ttl_seconds) and now - created_at > self.ttl_seconds
+
+    def get(self, model: str, text: str):
+        """
+        Returns:
+            List[float] | None: Cached embedding, or None on a miss
+        """
+        key = (model, normalize_query(text))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            embedding, created_at = entry
+            if self._expired(created_at, now):
+                del self._entries[key]
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return embedding
+
+    def put(self, model: str, text: str, embedding: List[float], created_at: float = None):
+        key = (model, normalize_query(text))
+        with self._lock:
+            self._entries[key] = (embedding, created_at or time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+            self._dirty = True
+        self._maybe_save()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dirty = True
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+            stats["max_entries"] = self.max_entries
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+    # ---------- Persistence ----------
+
+    def _maybe_save(self):
+        # Save off the request path, at most once per persist_interval
+        if not self.persist_path or time.time() - self._last_save < self.persist_interval:
+            return
+        self._last_save = time.time()
+        threading.Thread(target=self.save, daemon=True).start()
+
+    def save(self):
+        """Atomically write live entries to persist_path."""
+        if not self.persist_path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                now = time.time()
+                items = [(k, v) for k, v in self._entries.items() if not self._expired(v[1], now)]
+                self._dirty = False
+            try:
+                if items:
+                    matrix = np.asarray([v[0] for _, v in items], dtype=np.float32)
+                else:
+                    matrix = np.zeros((0, 0), dtype=np.float32)
+                tmp_path = f"{self.persist_path}.tmp.npz"
+                np.savez(
+                    tmp_path,
+                    models=np.asarray([k[0] for k, _ in items], dtype=str),
+                    texts=np.asarray([k[1] for k, _ in items], dtype=str),
+                    created=np.asarray([v[1] for _, v in items], dtype=np.float64),
+                    embeddings=matrix,
+                )
+                os.replace(tmp_path, self.persist_path)
+                self._last_save = time.time()
+                self._stats["saves"] += 1
+            except Exception as e:
+                print(f"Warning: Failed to persist embedding cache: {e}")
+
+    def load(self) -> int:
+        """
+        Load entries from persist_path, skipping ones that have already expired.
+        Returns:
+            int: Number of entries loaded
+        """
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return 0
+        try:
+            with np.load(self.persist_path) as data:
+                models, texts = data["models"], data["texts"]
+                created, matrix = data["created"], data["embeddings"]
+        except Exception as e:
+            print(f"Warning: Failed to load embedding cache from {self.persist_path}: {e}")
+            return 0
+
+        now = time.time()
+        loaded = 0
+        with self._lock:
+            # Oldest first so the LRU order roughly follows creation time
+            for i in np.argsort(created):
+                if self._expired(created[i], now):
+                    continue
+                key = (str(models[i]), str(texts[i]))
+                self._entries[key] = (matrix[i].tolist(), float(created[i]))
+                loaded += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._stats["loaded"] += loaded
+        print(f"Loaded {loaded} cached query embeddings from {self.persist_path}")
+        return loaded
+
+
+class CachedEmbeddings:
+    """
+    Drop-in wrapper around a LangChain embeddings object that serves
+    embed_query() from an EmbeddingCache. Other attributes are delegated.
+    """
+
+    def __init__(self, embeddings, cache: EmbeddingCache):
+        self._embeddings = embeddings
+        self.cache = cache
+        self.model = getattr(embeddings, "model", None) or type(embeddings).__name__
+
+    def embed_query(self, text: str) -> List[float]:
+        embedding = self.cache.get(self.model, text)
+        if embedding is None:
+            embedding = self._embeddings.embed_query(text)
+            self.cache.put(self.model, text, embedding)
+        return embedding
+
+    def __getattr__(self, name):
+        return getattr(self._embeddings, name)
@@ -0,0 +1,277 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from langchain.schema import SystemMessage
+
+# Marks the system message holding the rolling summary, after the personalized prompt
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+# Longest message text quoted in a summary prompt
+SUMMARY_MESSAGE_CHARS = 2000
+
+# Active session of a user: its summary and the entries after it. With a window, entries start
+# at the summary or at the window, whichever is earlier, so turns not yet summarized are kept;
+# without one (window 0) every entry is returned.
+_LOAD_SQL = """
+    SELECT s."historySummary",
+           COALESCE((
+               SELECT jsonb_agg(entry.value ORDER BY entry.position)
+               FROM jsonb_array_elements(s."conversationhistory") WITH ORDINALITY AS entry(value, position)
+               WHERE %(window)s = 0
+                  OR entry.position > LEAST(s."summaryUpTo", GREATEST(s."messageCount" - %(window)s, 0))
+           ), '[]'::jsonb)
+    FROM "UserSession" s
+    WHERE s."userId" = %(user_id)s AND s."sessionEndTime" IS NULL
+    ORDER BY s."sessionStartTime" DESC
+    LIMIT 1
+"""
+
+# Entries between the summary and the window, at most %(batch)s of them
+_PENDING_SQL = """
+    SELECT s.id, s."historySummary", s."summaryUpTo",
+           COALESCE((
+               SELECT jsonb_agg(entry.value ORDER BY entry.position)
+               FROM jsonb_array_elements(s."conversationhistory") WITH ORDINALITY AS entry(value, position)
+               WHERE entry.position > s."summaryUpTo"
+                 AND entry.position <= LEAST(s."messageCount" - %(window)s, s."summaryUpTo" + %(batch)s)
+           ), '[]'::jsonb)
+    FROM "UserSession" s
+    WHERE s."userId" = %(user_id)s AND s."sessionEndTime" IS NULL
+    ORDER BY s."sessionStartTime" DESC
+    LIMIT 1
+"""
+
+
+def build_summary_prompt(summary: Optional[str], entries: List[Dict]) -> str:
+    """Prompt that folds conversation entries into the previous summary."""
+    lines = []
+    for entry in entries:
+        message = str(entry.get("message", ""))[:SUMMARY_MESSAGE_CHARS]
+        lines.append(f"{entry.get('sender', 'unknown')}: {message}")
+    prompt = (
+        "You maintain a running summary of a tutoring conversation between a student (user) and "
+        "an assistant (bot) about lecture documents. Update the summary with the new messages. "
+        "Keep the topics, documents and pages discussed, what the student struggled with and any "
+        "answers they still need. Write at most 200 words of plain text.\n\n"
+    )
+    if summary:
+        prompt += f"Current summary:\n{summary}\n\n"
+    prompt += "New messages:\n" + "\n".join(lines) + "\n\nUpdated summary:"
+    return prompt
+
+
+def _is_summary(message) -> bool:
+    return isinstance(message, SystemMessage) and message.content.startswith(SUMMARY_PREFIX)
+
+
+def format_history(memory, turns: int) -> str:
+    """The summary (if any) and the last turns of a memory as prompt text."""
+    messages = list(memory.chat_memory.messages)
+    lines = [m.content for m in messages if _is_summary(m)]
+    conversation = [m for m in messages if not isinstance(m, SystemMessage)]
+    for message in conversation[-2 * turns:]:
+        role = "User" if message.type == "human" else "Assistant"
+        lines.append(f"{role}: {message.content}")
+    return "\n".join(lines)
+
+
+class HistoryWindow:
+    """
+    Bounded conversation memory: the last window_turns turns verbatim plus a rolling
+    summary of everything before them.
+
+    The summary is stored with the session ("historySummary", covering the first
+    "summaryUpTo" entries of "conversationhistory"), so hydrating a user loads one
+    summary and the window instead of the whole session. Once more than
+    summarize_after turns have piled up beyond the window, they are folded into the
+    summary on a background thread and the resident memory is trimmed. Whether or
+    not refreshes succeed, at most max_resident_turns turns stay resident; older
+    ones are dropped from memory (the database keeps them for a later summary).
+    """
+
+    def __init__(self, pool, summarize: Callable[[Optional[str], List[Dict]], str], window_turns: int = 10,
+                 summarize_after: int = 10, batch_entries: int = 100, max_workers: int = 2,
+                 max_resident_turns: int = 50):
+        """
+        Args:
+            pool (ConnectionPool): Database pool
+            summarize (Callable): summarize(previous_summary, entries) -> new summary
+            window_turns (int): Turns kept verbatim; 0 keeps the whole history (no summaries)
+            summarize_after (int): Turns beyond the window before the summary is refreshed
+            batch_entries (int): Most entries folded into the summary by one model call
+            max_workers (int): Concurrent summary refreshes
+            max_resident_turns (int): Hard cap on resident turns, at least window_turns + summarize_after
+        """
+        self.pool = pool
+        self.summarize = summarize
+        self.window_turns = window_turns
+        self.summarize_after = summarize_after
+        self.batch_entries = batch_entries
+        self.max_resident_turns = max(max_resident_turns, window_turns + summarize_after)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="history-summary")
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._capped = {}  # user_id -> messages dropped by the cap that no summary has covered yet
+        self._stats = {"loads": 0, "loaded_entries": 0, "refreshes": 0, "refresh_errors": 0,
+                       "summarized_entries": 0, "trimmed_messages": 0, "capped_messages": 0}
+
+    @classmethod
+    def from_env(cls, pool, summarize: Callable[[Optional[str], List[Dict]], str]) -> "HistoryWindow":
+        """
+        Window configured by HISTORY_WINDOW_TURNS, HISTORY_SUMMARY_AFTER, HISTORY_SUMMARY_BATCH
+        and HISTORY_MAX_RESIDENT_TURNS.
+        """
+        return cls(
+            pool,
+            summarize,
+            window_turns=int(os.getenv("HISTORY_WINDOW_TURNS", 10)),
+            summarize_after=int(os.getenv("HISTORY_SUMMARY_AFTER", 10)),
+            batch_entries=int(os.getenv("HISTORY_SUMMARY_BATCH", 100)),
+            max_resident_turns=int(os.getenv("HISTORY_MAX_RESIDENT_TURNS", 50)),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.window_turns > 0
+
+    def _count(self, key: str, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def load(self, cursor, user_id: str) -> Tuple[Optional[str], List[Dict]]:
+        """
+        Summary and entries to hydrate a user's memory with, from the active session.
+        Returns:
+            Tuple[Optional[str], List[Dict]]: The summary (None without one or when disabled) and the entries
+        """
+        cursor.execute(_LOAD_SQL, {"user_id": user_id, "window": 2 * self.window_turns})
+        row = cursor.fetchone()
+        if not row:
+            return None, []
+        summary, entries = row
+        self._count("loads")
+        self._count("loaded_entries", len(entries))
+        return (summary if self.enabled else None), entries
+
+    def _cap(self, user_id: Optional[str], memory):
+        # Caller holds the lock. Drops the oldest conversation messages beyond the hard cap
+        if not self.enabled:
+            return
+        messages = memory.chat_memory.messages
+        conversation = [m for m in messages if not isinstance(m, SystemMessage)]
+        excess = len(conversation) - 2 * self.max_resident_turns
+        if excess <= 0:
+            return
+        dropped = {id(m) for m in conversation[:excess]}
+        messages[:] = [m for m in messages if id(m) not in dropped]
+        self._stats["capped_messages"] += excess
+        if user_id is not None:
+            self._capped[user_id] = self._capped.get(user_id, 0) + excess
+
+    def hydrate(self, memory, summary: Optional[str], entries: List[Dict], user_id: str = None):
+        """Add the summary and the user and bot entries to a memory, within the resident cap."""
+        with self._lock:
+            self._capped.pop(user_id, None)
+            if summary:
+                memory.chat_memory.messages.append(SystemMessage(content=SUMMARY_PREFIX + summary))
+            for entry in entries:
+                if entry["sender"] == "user":
+                    memory.chat_memory.add_user_message(entry["message"])
+                elif entry["sender"] == "bot":
+                    memory.chat_memory.add_ai_message(entry["message"])
+            self._cap(user_id, memory)
+
+    def add_turn(self, user_id: str, memory, user_input: str, answer: str):
+        """Add a finished turn to a memory; schedules a summary refresh once the window overflows."""
+        with self._lock:
+            memory.chat_memory.add_user_message(user_input)
+            memory.chat_memory.add_ai_message(answer)
+            # Bounds the memory even when summary refreshes keep failing
+            self._cap(user_id, memory)
+            conversation = sum(1 for m in memory.chat_memory.messages if not isinstance(m, SystemMessage))
+        if self.enabled and conversation > 2 * (self.window_turns + self.summarize_after):
+            self.schedule_refresh(user_id, memory)
+
+    def schedule_refresh(self, user_id: str, memory=None):
+        """Fold the turns beyond the window into the summary in the background (once per user at a time)."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if user_id in self._pending:
+                return
+            self._pending.add(user_id)
+        self._executor.submit(self._refresh, user_id, memory)
+
+    def _refresh(self, user_id: str, memory):
+        try:
+            while True:
+                with self.pool.connection() as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute(_PENDING_SQL, {"user_id": user_id, "window": 2 * self.window_turns,
+                                                      "batch": self.batch_entries})
+                        row = cursor.fetchone()
+                if not row or not row[3]:
+                    break
+                session_id, summary, summary_up_to, entries = row
+                # No connection is held while the model writes the summary
+                summary = self.summarize(summary, entries)
+                with self.pool.connection() as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute("""
+                            UPDATE "UserSession" SET "historySummary" = %s, "summaryUpTo" = %s
+                            WHERE id = %s AND "summaryUpTo" = %s
+                        """, (summary, summary_up_to + len(entries), session_id, summary_up_to))
+                        updated = cursor.rowcount
+                    conn.commit()
+                if not updated:
+                    # Another worker moved the summary on; it applies the result
+                    break
+                self._count("refreshes")
+                self._count("summarized_entries", len(entries))
+                if memory is not None:
+                    covered = sum(1 for entry in entries if entry.get("sender") in ("user", "bot"))
+                    self.apply_summary(memory, summary, covered, user_id)
+                if len(entries) < self.batch_entries:
+                    break
+        except Exception as e:
+            self._count("refresh_errors")
+            print(f"Warning: History summary refresh failed for user {user_id}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(user_id)
+
+    def apply_summary(self, memory, summary: str, covered: int, user_id: str = None):
+        """
+        Replace a memory's summary and drop the conversation messages it now covers.
+
+        The resident conversation starts right after the previous summary (see load()), so
+        the covered messages are its oldest ones. Only those are dropped: turns the session
+        writer has not flushed yet are in memory but not in the summarized entries.
+        Args:
+            memory: User memory
+            summary (str): The new summary
+            covered (int): User and bot entries folded into the summary by this refresh
+            user_id (str, optional): Owner of the memory; messages the cap already dropped are not trimmed again
+        """
+        with self._lock:
+            capped = self._capped.pop(user_id, 0)
+            already_dropped = min(capped, covered)
+            if capped > already_dropped:
+                self._capped[user_id] = capped - already_dropped
+            covered -= already_dropped
+            messages = memory.chat_memory.messages
+            system = [m for m in messages if isinstance(m, SystemMessage) and not _is_summary(m)]
+            conversation = [m for m in messages if not isinstance(m, SystemMessage)]
+            covered = min(covered, len(conversation))
+            self._stats["trimmed_messages"] += covered
+            messages[:] = system + [SystemMessage(content=SUMMARY_PREFIX + summary)] + conversation[covered:]
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending_refreshes"] = len(self._pending)
+        stats.update(window_turns=self.window_turns, summarize_after=self.summarize_after,
+                     max_resident_turns=self.max_resident_turns)
+        return stats
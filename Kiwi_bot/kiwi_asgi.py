@@ -0,0 +1,157 @@
+"""
+Async serving mode for the Kiwi bot.
+
+/query is served on the event loop: request preparation (history load, retrieval,
+page lookup) runs on a bounded thread pool and the answer is streamed with
+llm_gateway.astream, so an open stream holds neither a worker nor a thread while the
+model generates. All other routes are the unchanged Flask app mounted as WSGI.
+
+Run with:
+    uvicorn kiwi_asgi:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import kiwi_flask
+from kiwi_flask import (ANSWER_HISTORY_TURNS, answer_cache, build_answer_prompt, collect_metrics, llm, llm_gateway,
+                        load_user_history, lookup_cached_answer, moderate_segment, moderated_answer, prepare_query,
+                        quiz_mode_answer, record_turn, safety_gate, sse_event, stream_stats)
+from stream_coalescer import TokenCoalescer
+
+# Blocking work (psycopg2 queries, embeddings, quiz generation) runs here; streams never hold a thread
+ASGI_BLOCKING_WORKERS = int(os.getenv("ASGI_BLOCKING_WORKERS", 32))
+blocking_executor = ThreadPoolExecutor(max_workers=ASGI_BLOCKING_WORKERS, thread_name_prefix="asgi-blocking")
+
+_stream_lock = threading.Lock()
+_stream_stats = {"open_streams": 0, "peak_open_streams": 0, "completed": 0, "errors": 0, "disconnects": 0}
+
+
+async def run_blocking(fn, *args):
+    """Run a blocking call on the bounded executor without stalling the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, lambda: fn(*args))
+
+
+def _track(key: str, delta: int = 1):
+    with _stream_lock:
+        _stream_stats[key] += delta
+        if key == "open_streams":
+            _stream_stats["peak_open_streams"] = max(_stream_stats["peak_open_streams"], _stream_stats["open_streams"])
+
+
+async def astream_answer(query_context: dict):
+    """
+    Async counterpart of kiwi_flask.stream_answer, driving llm.astream
+
+    Args:
+        query_context (dict): Result of prepare_query
+    Yields:
+        str: SSE "data:" events
+    """
+    _track("open_streams")
+    try:
+        if query_context["quiz_mode"]:
+            answer_text = await run_blocking(quiz_mode_answer, query_context)
+            yield sse_event({'answer': answer_text})
+            _track("completed")
+            return
+
+        question_embedding, cached_segments = await run_blocking(lookup_cached_answer, query_context)
+        if cached_segments is not None:
+            for segment in cached_segments:
+                yield sse_event({'answer': segment})
+            yield sse_event({'complete': True, 'answer_length': len(''.join(cached_segments))})
+            _track("completed")
+            record_turn(query_context, ''.join(cached_segments))
+            return
+
+        if ANSWER_HISTORY_TURNS:
+            # The prompt reads the history; load it off the event loop
+            await run_blocking(load_user_history, query_context["user_id"], query_context["user_data"])
+
+        coalescer = TokenCoalescer.from_env()
+        moderator = safety_gate.stream() if safety_gate is not None else None
+        answer_segments = []
+        async for chunk in llm_gateway.astream(llm, build_answer_prompt(query_context), route="query"):
+            segment = coalescer.add(chunk.content)
+            if segment:
+                for payload in moderate_segment(moderator, segment):
+                    if 'answer' in payload:
+                        answer_segments.append(payload['answer'])
+                    yield sse_event(payload)
+
+        payloads = []
+        segment = coalescer.flush()
+        if segment:
+            payloads.extend(moderate_segment(moderator, segment))
+        if moderator is not None:
+            # Waits for outstanding window checks
+            payloads.extend(await run_blocking(moderator.finish))
+        for payload in payloads:
+            if 'answer' in payload:
+                answer_segments.append(payload['answer'])
+            yield sse_event(payload)
+
+        full_answer = moderated_answer(moderator, answer_segments)
+        yield sse_event({'complete': True, 'answer_length': len(full_answer)})
+        _track("completed")
+        stream_stats.record(coalescer.summary())
+        record_turn(query_context, full_answer)
+
+        if question_embedding is not None and not (moderator is not None and moderator.blocked):
+            answer_cache.store(question_embedding, query_context["search_pdf_path"], query_context["page_number"],
+                               query_context["document_context"], answer_segments)
+    except asyncio.CancelledError:
+        # Client went away; cancelling stops the upstream generation as well
+        _track("disconnects")
+        raise
+    except Exception as e:
+        print(f"Error in async generate function: {str(e)}")
+        traceback.print_exc()
+        _track("errors")
+        yield sse_event({'error': str(e)})
+    finally:
+        _track("open_streams", -1)
+
+
+async def query(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not data or "query" not in data:
+        return JSONResponse({"error": "Missing 'query' in request."}, status_code=400)
+    try:
+        query_context = await run_blocking(prepare_query, data)
+    except Exception as e:
+        print(f"Error in query function: {str(e)}")
+        traceback.print_exc()
+        return JSONResponse({"error": str(e)}, status_code=500)
+    return StreamingResponse(astream_answer(query_context), media_type="text/event-stream")
+
+
+async def metrics(request):
+    result = await run_blocking(collect_metrics)
+    with _stream_lock:
+        result["asgi"] = dict(_stream_stats, blocking_workers=ASGI_BLOCKING_WORKERS)
+    return JSONResponse(result)
+
+
+app = Starlette(routes=[
+    Route("/query", query, methods=["POST"]),
+    Route("/metrics", metrics, methods=["GET"]),
+    Mount("/", app=WSGIMiddleware(kiwi_flask.app)),
+])
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host=os.getenv("HOST", "127.0.0.1"), port=int(os.getenv("PORT", 5000)))
@@ -1,13 +1,14 @@
 import os
 import glob
-import time
 from langchain_community.document_loaders import PyPDFLoader
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain.memory import ConversationBufferMemory
 from langchain.prompts import PromptTemplate
 from langchain.schema import SystemMessage
 
+from llm_gateway import LLMGateway
+
 def get_document_context(query, retriever, k=3):
     """Fetch relevant documents based on the query."""
     docs = retriever.invoke(query)[:k]
@@ -67,9 +68,10 @@ def main():
     memory.chat_memory.messages.append(SystemMessage(content=system_prompts["answer"]))
 
     print("Initializing Chat Models...", flush=True)
+    llm_gateway = LLMGateway.from_env()
     llm = {
-        "answer": ChatOpenAI(openai_api_key=OPENAI_API_KEY, model="gpt-4o"),
-        "quiz": ChatOpenAI(openai_api_key=OPENAI_API_KEY, model="gpt-4o")
+        "answer": LLMGateway.chat_model("gpt-4o", openai_api_key=OPENAI_API_KEY),
+        "quiz": LLMGateway.chat_model("gpt-4o", openai_api_key=OPENAI_API_KEY)
     }
 
     prompt_templates = {
@@ -127,7 +129,7 @@ def main():
             )
 
             try:
-                response = llm["quiz"].invoke(full_prompt)
+                response = llm_gateway.invoke(llm["quiz"], full_prompt, route="quiz")
                 answer_text = response.get("content", "") if isinstance(response, dict) else response.content
                 print("QuizBot:", answer_text, "\n", flush=True)
                 
@@ -163,13 +165,10 @@ def main():
             )
 
             response = None
-            for _ in range(3):  # Retry mechanism for API call
-                try:
-                    response = llm[agent].invoke(full_prompt)
-                    break
-                except Exception as e:
-                    print(f"API error: {e}. Retrying...", flush=True)
-                    time.sleep(2)
+            try:  # the gateway retries rate limits and transient errors with backoff
+                response = llm_gateway.invoke(llm[agent], full_prompt, route=agent)
+            except Exception as e:
+                print(f"API error: {e}", flush=True)
 
             if not response:
                 print("Bot: Sorry, I couldn't process your request at the moment.\n", flush=True)
@@ -1,7 +1,10 @@
 import os
 import glob
+import atexit
+import base64
+import gzip
 from flask import Flask, request, jsonify, Response
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_openai import OpenAIEmbeddings
 from langchain.memory import ConversationBufferMemory
 from langchain.prompts import PromptTemplate
 from langchain.schema import SystemMessage
@@ -16,17 +19,39 @@ from urllib.parse import urlparse
 from dotenv import load_dotenv, find_dotenv
 from pathlib import Path
 import time
+import threading
+import itertools
 import traceback
 import uuid
 
 import re
 
+from db_pool import ConnectionPool
+from embedding_cache import EmbeddingCache, CachedEmbeddings, normalize_query
+from vector_index import InMemoryVectorIndex, parse_vector
+from pdf_cache import PdfChunkCache
+from corpus_state import CorpusGeneration
+from retrieval_cache import RetrievalCache, embedding_fingerprint
+from answer_cache import SemanticAnswerCache
+from query_stages import StageRunner
+from stream_coalescer import TokenCoalescer, StreamStats
+from context_packer import ContextPacker
+from mmr import apply_distance_cutoff, mmr_select
+from stream_moderation import SafetyGate
+from llm_gateway import LLMGateway
+from quiz_generation import QuizGenerator, build_quiz_prompt, normalize_difficulty
+from quiz_bank import QuizBank, to_quiz_mode
+from memory_store import UserMemoryStore
+from history_window import HistoryWindow, build_summary_prompt, format_history
+from session_history import append_session_messages, message_entry
+from session_writer import SessionWriter
+
 # Find and load .env file
 env_path = find_dotenv()
 print("Found .env file at:", env_path)
 
-# Force reload environment variables
-load_dotenv(env_path, override=True)
+# Force reload environment variables (DOTENV_OVERRIDE=0 keeps variables already set, e.g. by the benchmark harness)
+load_dotenv(env_path, override=os.getenv("DOTENV_OVERRIDE", "1").lower() not in ("0", "false", "no"))
 
 # Print environment variables for debugging
 print("Environment variables after loading:")
@@ -47,57 +72,37 @@ if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY environment variable is not set.")
 
 # Initialize embeddings
-embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY)
+# Query embeddings are cached (LRU + TTL, optionally persisted) so repeated questions skip the API round trip
+embedding_cache = EmbeddingCache.from_env()
+embeddings = CachedEmbeddings(OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY), embedding_cache)
+
+# Per-PDF chunk text and page maps, warmed by /load_pdf when a student opens a document
+pdf_cache = PdfChunkCache(
+    max_pdfs=int(os.getenv("PDF_CACHE_SIZE", 32)),
+    ttl_seconds=float(os.getenv("PDF_CACHE_TTL", 600)),
+)
 
-# Initialize global document chunks
-document_chunks = []
+# Initialize database connection pool
+# Connections are opened once (SSL mode resolved and statement_timeout applied at connect time)
+# and reused across requests instead of doing a fresh TLS handshake per query.
+db_pool = ConnectionPool.from_env("DATABASE_URL3", statement_timeout_ms=30000)
 
-# Initialize database connection
 def get_db_connection():
     """
-    Create a database connection
+    Borrow a connection from the pool. Must be handed back with release_db_connection().
     Returns:
         psycopg2.connection: Database connection
     """
-    try:
-        # Parse database URL
-        db_url = os.getenv("DATABASE_URL3")
-        if not db_url:
-            print("ERROR: DATABASE_URL3 environment variable is not set")
-            raise ValueError("DATABASE_URL3 environment variable is not set")
-        
-        print(f"Connecting to database with URL: {db_url[:20]}...")
-        parsed = urlparse(db_url)
-        
-        # Try to connect to the database
-        conn = psycopg2.connect(
-            dbname=parsed.path[1:],  # Remove leading slash
-            user=parsed.username,
-            password=parsed.password,
-            host=parsed.hostname,
-            port=parsed.port or 5432,
-            sslmode='require'  # Enable SSL for RDS
-        )
-        print("Database connection established successfully")
-        return conn
-    except Exception as e:
-        print(f"ERROR: Failed to connect to database: {str(e)}")
-        # Retry without SSL
-        try:
-            print("Retrying connection without SSL...")
-            conn = psycopg2.connect(
-                dbname=parsed.path[1:],  # Remove leading slash
-                user=parsed.username,
-                password=parsed.password,
-                host=parsed.hostname,
-                port=parsed.port or 5432,
-                sslmode='prefer'  # Try to use SSL, but not required
-            )
-            print("Database connection established successfully (without SSL requirement)")
-            return conn
-        except Exception as retry_e:
-            print(f"ERROR: Failed retry connection: {str(retry_e)}")
-            raise
+    return db_pool.getconn()
+
+def release_db_connection(conn, discard: bool = False):
+    """
+    Return a borrowed connection to the pool
+    Args:
+        conn (psycopg2.connection): Connection from get_db_connection()
+        discard (bool): Close the connection instead of reusing it
+    """
+    db_pool.putconn(conn, discard=discard)
 
 
 def create_or_update_user_session(user_id, pdf_name, user_input, bot_response):
@@ -113,80 +118,25 @@ def create_or_update_user_session(user_id, pdf_name, user_input, bot_response):
     if not user_id:
         print("User ID not provided, cannot save session")
         return
-        
+
     conn = get_db_connection()
     try:
         with conn.cursor() as cursor:
-            # 检查是否存在活跃会话
-            cursor.execute("""
-                SELECT id, "conversationhistory", "pdfname" FROM "UserSession"
-                WHERE "userId" = %s AND "sessionEndTime" IS NULL
-                ORDER BY "sessionStartTime" DESC
-                LIMIT 1
-            """, (user_id,))
-
-            session = cursor.fetchone()
-
-            message_entry_user = {
-                "timestamp": datetime.utcnow().isoformat(),
-                "sender": "user",
-                "message": user_input
-            }
-            message_entry_bot = {
-                "timestamp": datetime.utcnow().isoformat(),
-                "sender": "bot",
-                "message": bot_response
-            }
-
-            if session:
-                session_id, conversation_history, existing_pdf = session
-                
-                # 如果会话中的PDF与当前不同，记录PDF切换信息
-                if existing_pdf != pdf_name:
-                    pdf_switch_message = {
-                        "timestamp": datetime.utcnow().isoformat(),
-                        "sender": "system",
-                        "message": f"Switched document: from {existing_pdf} to {pdf_name}"
-                    }
-                    conversation_history.append(pdf_switch_message)
-                    
-                    # 更新会话中的PDF名称
-                    cursor.execute("""
-                        UPDATE "UserSession"
-                        SET "pdfname" = %s
-                        WHERE id = %s
-                    """, (pdf_name, session_id))
-                
-                # 添加新消息
-                conversation_history.append(message_entry_user)
-                conversation_history.append(message_entry_bot)
-
-                cursor.execute("""
-                    UPDATE "UserSession"
-                    SET "conversationhistory" = %s
-                    WHERE id = %s
-                """, (Json(conversation_history), session_id))
-
-                print(f"Updating existing session {session_id}, now has {len(conversation_history)} messages")
-
-            else:
-                # 创建新会话
-                session_id = str(uuid.uuid4())
-                conversation_history = [message_entry_user, message_entry_bot]
-
-                cursor.execute("""
-                    INSERT INTO "UserSession" (id, "userId", "pdfname", "conversationhistory", "sessionStartTime")
-                    VALUES (%s, %s, %s, %s, %s)
-                """, (session_id, user_id, pdf_name, Json(conversation_history), datetime.utcnow()))
-
-                print(f"Created new session {session_id}")
-
+            # 只追加本轮的两条消息, 由数据库拼接 -> only this turn's entries are sent, Postgres appends them
+            session_id, message_count, created = append_session_messages(
+                cursor, user_id, pdf_name,
+                [message_entry("user", user_input), message_entry("bot", bot_response)]
+            )
         conn.commit()
+        if created:
+            print(f"Created new session {session_id}")
+        else:
+            print(f"Updating existing session {session_id}, now has {message_count} messages")
     except Exception as e:
         print(f"Session management error: {e}")
         traceback.print_exc()
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 # Load embeddings from database
 def load_embeddings_from_db(pdf_name: str = None) -> List[Dict]:
@@ -210,16 +160,8 @@ def load_embeddings_from_db(pdf_name: str = None) -> List[Dict]:
         conn.autocommit = True
         # print("Database connection established successfully")
 
-        # Set statement timeout to avoid hanging
+        # statement_timeout is already set on pooled connections
         with conn.cursor() as cursor:
-            cursor.execute("SET statement_timeout = 30000;")  # 30 seconds
-            # print("Setting statement timeout to 30 seconds...")
-            
-            # Execute a simple count query first to test database responsiveness
-            # cursor.execute("SELECT COUNT(*) FROM \"PdfChunk\";")
-            total_chunks = cursor.fetchone()[0]
-            print(f"Found {total_chunks} total chunks in database. Query took {time.time() - start_time:.2f} seconds")
-            
             # Load chunks by page order
             if pdf_name:
                 sql = """
@@ -277,10 +219,9 @@ def load_embeddings_from_db(pdf_name: str = None) -> List[Dict]:
         # Return empty list, not None
         return []
     finally:
-        # Ensure database connection is closed
+        # Ensure database connection is returned to the pool
         if conn:
-            conn.close()
-            print("Database connection closed")
+            release_db_connection(conn)
 
     return document_chunks
 
@@ -312,9 +253,81 @@ system_prompt = (
     "This comprehensive approach helps users build a deeper understanding of course concepts by seeing how they relate across different materials."
 )
 
-user_memories = {}
+# 有界的用户记忆: 按人数、字节预算和空闲时间淘汰 -> bounded by users, a byte budget and idle time
+user_memories = UserMemoryStore.from_env()
+user_memories.start_sweeper()
+
+# 对话历史异步批量写入数据库, 回答流不等待保存 -> finished turns are written behind the answer stream in batches
+SESSION_SAVE_ENABLED = os.getenv("SESSION_SAVE_ENABLED", "1").lower() not in ("0", "false", "no")
+session_writer = SessionWriter.from_env(db_pool)
+atexit.register(session_writer.close)
+
+# 历史按需加载: 只有用到历史的功能才读取数据库 -> history is loaded on demand, only by the features that read it
+HISTORY_LAZY = os.getenv("HISTORY_LAZY", "1").lower() not in ("0", "false", "no")
+# Recent turns included in the /query answer prompt (0 = none, answers then never load the history)
+ANSWER_HISTORY_TURNS = int(os.getenv("ANSWER_HISTORY_TURNS", 0))
+
+def new_user_memory(user_id: str, user_name: str = "User", user_email: str = "N/A") -> dict:
+    """
+    Build an empty memory entry seeded with the personalized system prompt
+    (without loading any history from the database, see load_user_history)
+    """
+    user_data = {
+        "memory": ConversationBufferMemory(memory_key="chat_history", return_messages=True),
+        "personalized_prompt": (
+            f"{system_prompt}\n\n"
+            f"The user's name is {user_name}. "
+            f"The user's email address is {user_email}. "
+            f"The user's unique ID is {user_id}."
+        ),
+        "last_access": datetime.utcnow(),
+        "history_loaded": False,
+        "history_lock": threading.Lock(),
+    }
+    # 初始化记忆对象，添加系统提示
+    user_data["memory"].chat_memory.messages.append(SystemMessage(content=user_data["personalized_prompt"]))
+    return user_data
+
+def load_user_history(user_id: str, user_data: dict) -> dict:
+    """
+    Hydrate a memory entry with the conversation history of the user's active session, once.
+    A failed load is retried by the next caller.
+
+    Args:
+        user_id (str): User ID
+        user_data (dict): Entry from get_user_memory
+    Returns:
+        dict: The same entry
+    """
+    with user_data["history_lock"]:
+        if user_data["history_loaded"]:
+            return user_data
+
+        # 尝试从数据库加载历史对话: 滚动摘要加最近N轮 -> load the rolling summary and the last N turns (or everything without a window)
+        conn = None
+        try:
+            conn = get_db_connection()
+            with conn.cursor() as cursor:
+                summary, entries = history_window.load(cursor, user_id)
+            if summary or entries:
+                print(f"Loaded {len(entries)} conversation history entries from database"
+                      f"{' and a summary' if summary else ''}")
+                history_window.hydrate(user_data["memory"], summary, entries, user_id)
+                # 未摘要的轮次过多时后台刷新摘要 -> too many unsummarized turns: refresh the summary in the background
+                if len(entries) > 2 * (history_window.window_turns + history_window.summarize_after):
+                    history_window.schedule_refresh(user_id, user_data["memory"])
+            user_data["history_loaded"] = True
+        except Exception as e:
+            print(f"Failed to load conversation history: {e}")
+            return user_data
+        finally:
+            if conn:
+                release_db_connection(conn)
+
+    user_memories.touch(user_id)
+    return user_data
 
-def get_user_memory(user_id: str, user_name: str = "User", user_email: str = "N/A"):
+def get_user_memory(user_id: str, user_name: str = "User", user_email: str = "N/A", load_history: bool = None):
     """
     Get or create user's conversation memory. Conversation memory persists throughout the session,
     even if the user switches PDFs, chat history will not be lost.
@@ -323,62 +336,45 @@ def get_user_memory(user_id: str, user_name: str = "User", user_email: str = "N/
         user_id (str): User ID
         user_name (str): User name
         user_email (str): User email
+        load_history (bool, optional): Hydrate the history now (default: unless HISTORY_LAZY)
         
     Returns:
         dict: Dictionary containing user memory and personalized prompt
     """
-    # 如果用户ID不在内存中，则创建新的记忆对象
-    if user_id not in user_memories:
+    # 常驻的用户直接返回 (同时刷新last_access) -> resident users are returned directly (last_access refreshed)
+    user_data = user_memories.get(user_id)
+    if user_data is None:
+        # 如果用户ID不在内存中，则创建新的记忆对象
         print(f"Creating new user memory object: {user_id}")
-        user_memories[user_id] = {
-            "memory": ConversationBufferMemory(memory_key="chat_history", return_messages=True),
-            "personalized_prompt": (
-                f"{system_prompt}\n\n"
-                f"The user's name is {user_name}. "
-                f"The user's email address is {user_email}. "
-                f"The user's unique ID is {user_id}."
-            ),
-            "last_access": datetime.utcnow()
-        }
-        # 初始化记忆对象，添加系统提示
-        user_memories[user_id]["memory"].chat_memory.messages.append(
-            SystemMessage(content=user_memories[user_id]["personalized_prompt"])
-        )
-        
-        # 尝试从数据库加载历史对话
-        try:
-            conn = get_db_connection()
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                    SELECT "conversationhistory" FROM "UserSession"
-                    WHERE "userId" = %s AND "sessionEndTime" IS NULL
-                    ORDER BY "sessionStartTime" DESC
-                    LIMIT 1
-                """, (user_id,))
-                
-                session = cursor.fetchone()
-                if session and session[0]:
-                    conversation_history = session[0]
-                    print(f"Loaded {len(conversation_history)} conversation history entries from database")
-                    
-                    # 将对话历史添加到记忆对象中
-                    for entry in conversation_history:
-                        if entry["sender"] == "user":
-                            user_memories[user_id]["memory"].chat_memory.add_user_message(entry["message"])
-                        elif entry["sender"] == "bot":
-                            user_memories[user_id]["memory"].chat_memory.add_ai_message(entry["message"])
-            conn.close()
-        except Exception as e:
-            print(f"Failed to load conversation history: {e}")
-    else:
-        # 更新最后访问时间
-        user_memories[user_id]["last_access"] = datetime.utcnow()
+        user_data = new_user_memory(user_id, user_name, user_email)
+        # 存入有界的记忆存储, 超出上限时淘汰最久未用的用户 -> least recently used users are evicted beyond the limits
+        user_memories.put(user_id, user_data)
 
-    return user_memories[user_id]
+    if load_history if load_history is not None else not HISTORY_LAZY:
+        load_user_history(user_id, user_data)
+    return user_data
 
 # Initialize Chat Model
 print("Initializing Chat Model...")
-llm = ChatOpenAI(openai_api_key=OPENAI_API_KEY, model="gpt-4")
+# All model calls go through the gateway: concurrency limits per route, deadlines, backoff and hedging
+llm_gateway = LLMGateway.from_env()
+llm = LLMGateway.chat_model("gpt-4", openai_api_key=OPENAI_API_KEY)
+
+# Streamed answers are checked in sentence windows by a cheaper model while generation continues.
+# Opt-in: with the hold policy the first window waits for its check, which delays the first text
+SAFETY_STREAM_ENABLED = os.getenv("SAFETY_STREAM_ENABLED", "0").lower() not in ("0", "false", "no")
+SAFETY_MODEL = os.getenv("SAFETY_MODEL", "gpt-4o-mini")
+safety_llm = LLMGateway.chat_model(SAFETY_MODEL, openai_api_key=OPENAI_API_KEY, temperature=0)
+safety_gate = SafetyGate.from_env(lambda text, context: check_answer_window(text, context)) if SAFETY_STREAM_ENABLED else None
+
+# Conversation memory keeps the last HISTORY_WINDOW_TURNS turns plus a rolling summary, refreshed in the background
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "gpt-4o-mini")
+summary_llm = LLMGateway.chat_model(HISTORY_SUMMARY_MODEL, openai_api_key=OPENAI_API_KEY, temperature=0)
+history_window = HistoryWindow.from_env(db_pool, lambda summary, entries: summarize_history(summary, entries))
+
+# Retrieved chunks are packed into a per-model token budget instead of a fixed chunk count
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", 20))
+context_packer = ContextPacker.from_env()
 
 # Create the prompt template
 prompt_template = PromptTemplate(
@@ -394,123 +390,235 @@ prompt_template = PromptTemplate(
     )
 )
 
-def get_relevant_chunks(query: str, pdf_name: str = None, pdf_path: str = None, k: int = 5, allow_fallback: bool = True, use_ann: bool = True) -> List[Dict]:
+# pgvector HNSW settings
+# Build parameters only apply when an index is (re)created; ef_search is set per query
+HNSW_M = int(os.getenv("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 64))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", 40))
+# Course prefixes that get their own partial HNSW index (same prefixes pdf_embedding_2.py ingests)
+HNSW_COURSE_PREFIXES = [p.strip() for p in os.getenv("HNSW_COURSE_PREFIXES", "public/lapdf,public/mlpdf").split(",") if p.strip()]
+# "all" searches other PDFs across every course, "course" only within the current PDF's course prefix
+SEARCH_SCOPE = os.getenv("SEARCH_SCOPE", "all").lower()
+# Set by create_vector_index() once the installed pgvector version is known (iterative scans need >= 0.8.0)
+pgvector_iterative_scan = False
+
+# Hybrid retrieval: fuse full-text ("contentTsv") and vector rankings with reciprocal rank fusion
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1").lower() not in ("0", "false", "no")
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 50))  # per-ranking candidate depth
+RRF_K = int(os.getenv("RRF_K", 60))
+FULLTEXT_CONFIG = os.getenv("FULLTEXT_CONFIG", "english")
+if not re.fullmatch(r"[a-z_]+", FULLTEXT_CONFIG):
+    print(f"Warning: Invalid FULLTEXT_CONFIG '{FULLTEXT_CONFIG}', using 'english'")
+    FULLTEXT_CONFIG = "english"
+# Set by create_vector_index() once the generated tsvector column is known to exist
+fulltext_available = False
+
+# Optional diversification of retrieved chunks (per-request overrides: "mmr", "mmr_lambda", "max_distance")
+MMR_ENABLED = os.getenv("MMR_ENABLED", "0").lower() not in ("0", "false", "no")
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", 0.5))
+MMR_FETCH_FACTOR = int(os.getenv("MMR_FETCH_FACTOR", 3))  # candidates fetched per side = k * factor
+MAX_DISTANCE = float(os.environ["MAX_DISTANCE"]) if os.getenv("MAX_DISTANCE") else None  # cosine distance cutoff
+
+
+def course_prefix_for(pdf_path: str):
     """
-    获取与查询相关的文档块，同时结合当前PDF和其他PDF中的内容
-    
+    Returns:
+        Optional[str]: The configured course prefix pdf_path belongs to, if any
+    """
+    if not pdf_path:
+        return None
+    for prefix in HNSW_COURSE_PREFIXES:
+        if pdf_path.startswith(prefix):
+            return prefix
+    return None
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _row_to_chunk(row, is_current_pdf: bool) -> Dict:
+    """
+    Convert a (id, content, pageNumber, pdfName, pdfPath, distance[, rrf_score[, embedding text]]) row into a chunk dict
+    """
+    id, content, page_number, pdf, pdf_path, distance = row[:6]
+    chunk = {
+        "id": id,
+        "content": content,
+        "metadata": {
+            "page": page_number,
+            "pdf_name": pdf,
+            "pdf_path": pdf_path,
+            "source": f"{pdf} - Page {page_number}",
+            "distance": distance,
+            "is_current_pdf": is_current_pdf
+        }
+    }
+    if len(row) > 6 and row[6] is not None:
+        chunk["metadata"]["rrf_score"] = float(row[6])
+    if len(row) > 7 and row[7] is not None:
+        # Only fetched for MMR re-selection; removed again before results are cached
+        chunk["embedding"] = parse_vector(row[7])
+    return chunk
+
+
+def _rank_key(chunk: Dict):
+    """
+    Sort key for retrieved chunks: fused score (higher first) for hybrid results, else distance
+    """
+    metadata = chunk['metadata']
+    if 'rrf_score' in metadata:
+        return -metadata['rrf_score']
+    distance = metadata.get('distance')
+    return 1.0 if distance is None else distance
+
+
+def _search_settings_sql(k: int, use_ann: bool, ef_search: int = None) -> str:
+    """
+    Build the SET LOCAL prefix sent in the same round trip as the search statement.
+    SET LOCAL only lasts until the pooled connection's transaction is rolled back on release.
+    """
+    if not use_ann:
+        # Exact search: keep the planner off the approximate HNSW index
+        return "SET LOCAL enable_indexscan = off; "
+    # ef_search below k would cap the number of candidates the index can return
+    ef = max(int(ef_search or HNSW_EF_SEARCH), k)
+    settings = f"SET LOCAL hnsw.ef_search = {ef}; "
+    if pgvector_iterative_scan:
+        # Keep scanning the graph until filtered queries (e.g. "pdfPath" != ...) have k rows
+        settings += "SET LOCAL hnsw.iterative_scan = relaxed_order; "
+    return settings
+
+
+def fetch_retrieval_bundle(query_embedding: List[float], pdf_path: str = None, k: int = 5, page_number: int = None,
+                           use_ann: bool = True, ef_search: int = None, query_text: str = None, hybrid: bool = False,
+                           with_embeddings: bool = False):
+    """
+    Fetch the current-PDF kNN, the other-PDF kNN and (optionally) the exact page
+    in a single SQL statement, i.e. one database round trip.
+
     Args:
-        query (str): 用户查询
-        pdf_name (str, optional): PDF名称过滤 (已弃用)
-        pdf_path (str, optional): PDF路径过滤
-        k (int): 返回的结果数量
-        allow_fallback (bool): 如果在指定PDF中找不到，是否回退到全局搜索
-        use_ann (bool): 是否使用近似最近邻搜索加速查询
-    
+        query_embedding (List[float]): Query vector
+        pdf_path (str, optional): Current PDF path (with public/ prefix)
+        k (int): Neighbours to fetch from each side
+        page_number (int, optional): 0-based page of pdf_path whose content should also be returned
+        use_ann (bool): Use the HNSW index; False forces an exact scan
+        ef_search (int, optional): HNSW candidate list size for this query (default HNSW_EF_SEARCH)
+        query_text (str, optional): Raw query, used for the full-text ranking
+        hybrid (bool): Fuse full-text and vector rankings with RRF (needs the contentTsv column)
+        with_embeddings (bool): Also return each chunk's embedding (for MMR)
+
     Returns:
-        Tuple[List[Dict], bool]: 相关文档块列表和是否使用了回退策略
+        Tuple[List[Dict], List[Dict], Optional[str]]: current-PDF chunks, other-PDF chunks, exact page content
     """
-    query_embedding = embeddings.embed_query(query)
-    
-    conn = get_db_connection()
-    chunks = []
-    used_fallback = False
+    distance_op = "<=>"  # cosine distance
+    columns = f'id, content, "pageNumber", "pdfName", "pdfPath", (embedding {distance_op} %(embedding)s::vector) AS distance'
+    course_prefix = course_prefix_for(pdf_path)
+    hybrid = hybrid and fulltext_available and bool(query_text and query_text.strip())
+    params = {"embedding": query_embedding, "pdf_path": pdf_path, "k": k, "page": page_number,
+              "course_like": _escape_like(course_prefix) + "%" if course_prefix else None,
+              "query_text": query_text, "ts_config": FULLTEXT_CONFIG,
+              "candidates": max(HYBRID_CANDIDATES, k), "rrf_k": RRF_K}
+
+    embedding_column = ", embedding::text AS embedding_text" if with_embeddings else ""
+    fused_embedding_column = ", c.embedding::text AS embedding_text" if with_embeddings else ""
+    page_padding = ", NULL::text AS embedding_text" if with_embeddings else ""
+
+    # Repeating the course predicate lets the planner match the per-course partial HNSW index.
+    # The current-PDF branch stays on the exact pdfPath filter, which the btree index answers fully.
+    other_filter = ""
+    if SEARCH_SCOPE == "course" and course_prefix:
+        other_filter = ' AND "pdfPath" LIKE %(course_like)s'
+
+    def knn_branch(kind: str, where: str) -> str:
+        # Each branch repeats the vector literal so pgvector can still use the HNSW index for ORDER BY
+        if not hybrid:
+            return f"""
+            (SELECT '{kind}' AS kind, {columns}, NULL::float8 AS rrf_score{embedding_column}
+             FROM "PdfChunk"
+             WHERE {where}
+             ORDER BY distance
+             LIMIT %(k)s)"""
+        # Reciprocal rank fusion of the vector ranking and the full-text ranking
+        return f"""
+            (WITH vec AS (
+                SELECT id, distance, row_number() OVER (ORDER BY distance) AS rnk
+                FROM (SELECT id, (embedding {distance_op} %(embedding)s::vector) AS distance
+                      FROM "PdfChunk"
+                      WHERE {where}
+                      ORDER BY distance
+                      LIMIT %(candidates)s) v
+             ), lex AS (
+                SELECT id, row_number() OVER (ORDER BY rank DESC) AS rnk
+                FROM (SELECT id, ts_rank_cd("contentTsv", tsq) AS rank
+                      FROM "PdfChunk", websearch_to_tsquery(%(ts_config)s::regconfig, %(query_text)s) tsq
+                      WHERE {where} AND "contentTsv" @@ tsq
+                      ORDER BY rank DESC
+                      LIMIT %(candidates)s) l
+             ), fused AS (
+                SELECT COALESCE(vec.id, lex.id) AS id, vec.distance,
+                       COALESCE(1.0 / (%(rrf_k)s + vec.rnk), 0) + COALESCE(1.0 / (%(rrf_k)s + lex.rnk), 0) AS rrf_score
+                FROM vec FULL OUTER JOIN lex ON vec.id = lex.id
+                ORDER BY rrf_score DESC
+                LIMIT %(k)s
+             )
+             SELECT '{kind}' AS kind, c.id, c.content, c."pageNumber", c."pdfName", c."pdfPath",
+                    COALESCE(f.distance, c.embedding {distance_op} (SELECT qv FROM query_vector)) AS distance,
+                    f.rrf_score::float8 AS rrf_score{fused_embedding_column}
+             FROM fused f JOIN "PdfChunk" c ON c.id = f.id)"""
+
+    parts = []
+    if pdf_path:
+        parts.append(knn_branch("current", '"pdfPath" = %(pdf_path)s'))
+        parts.append(knn_branch("other", f'"pdfPath" != %(pdf_path)s{other_filter}'))
+        if page_number is not None:
+            parts.append(f"""
+            (SELECT 'page' AS kind, id, content, "pageNumber", "pdfName", "pdfPath", NULL::float8 AS distance, NULL::float8 AS rrf_score{page_padding}
+             FROM "PdfChunk"
+             WHERE "pdfPath" = %(pdf_path)s AND "pageNumber" = %(page)s
+             LIMIT 1)""")
+    else:
+        parts.append(knn_branch("other", "TRUE"))
+
+    sql = " UNION ALL ".join(parts)
+    if hybrid:
+        # Lexical-only hits still report a cosine distance, computed from this single copy of the vector
+        sql = "WITH query_vector AS (SELECT %(embedding)s::vector AS qv) " + sql
+
     current_pdf_chunks = []
     other_pdf_chunks = []
+    page_content = None
 
+    conn = get_db_connection()
     try:
         with conn.cursor() as cursor:
-            cursor.execute("SET statement_timeout = 30000;")
-
-            # 选择距离操作符
-            distance_op = "<=>"  # cosine distance
-            
-            # 1. 首先在当前PDF中搜索
-            if pdf_path:
-                try:
-                    sql = f"""
-                    SELECT id, content, "pageNumber", "pdfName", "pdfPath", (embedding {distance_op} %s::vector) as distance
-                    FROM "PdfChunk"
-                    WHERE "pdfPath" = %s
-                    ORDER BY distance
-                    LIMIT %s;
-                    """
-                    cursor.execute(sql, (query_embedding, pdf_path, k))
-                    rows = cursor.fetchall()
-                    
-                    # 处理当前PDF的结果
-                    for row in rows:
-                        # 确保行数据完整
-                        if len(row) >= 6:
-                            id, content, page_number, pdf, pdf_path, distance = row
-                            current_pdf_chunks.append({
-                                "id": id,
-                                "content": content,
-                                "metadata": {
-                                    "page": page_number,
-                                    "pdf_name": pdf,
-                                    "pdf_path": pdf_path,
-                                    "source": f"{pdf} - Page {page_number}",
-                                    "distance": distance,
-                                    "is_current_pdf": True
-                                }
-                            })
-                        else:
-                            print(f"Warning: Incomplete row data: {row}")
-                except Exception as e:
-                    print(f"Current PDF search error: {e}")
-                    traceback.print_exc()
-            
-            # 2. 无论如何，总是尝试搜索其他PDF
-            try:
-                if pdf_path:
-                    sql = f"""
-                    SELECT id, content, "pageNumber", "pdfName", "pdfPath", (embedding {distance_op} %s::vector) as distance
-                    FROM "PdfChunk"
-                    WHERE "pdfPath" != %s
-                    ORDER BY distance
-                    LIMIT %s;
-                    """
-                    cursor.execute(sql, (query_embedding, pdf_path, k))
+            cursor.execute(_search_settings_sql(k, use_ann, ef_search) + sql + ";", params)
+            for row in cursor.fetchall():
+                kind, rest = row[0], row[1:]
+                if kind == "page":
+                    page_content = rest[1]
+                elif kind == "current":
+                    current_pdf_chunks.append(_row_to_chunk(rest, True))
                 else:
-                    sql = f"""
-                    SELECT id, content, "pageNumber", "pdfName", "pdfPath", (embedding {distance_op} %s::vector) as distance
-                    FROM "PdfChunk"
-                    ORDER BY distance
-                    LIMIT %s;
-                    """
-                    cursor.execute(sql, (query_embedding, k))
-                    
-                rows = cursor.fetchall()
-                
-                # 处理其他PDF的结果
-                for row in rows:
-                    # 确保行数据完整
-                    if len(row) >= 6:
-                        id, content, page_number, pdf, pdf_path, distance = row
-                        other_pdf_chunks.append({
-                            "id": id,
-                            "content": content,
-                            "metadata": {
-                                "page": page_number,
-                                "pdf_name": pdf,
-                                "pdf_path": pdf_path,
-                                "source": f"{pdf} - Page {page_number}",
-                                "distance": distance,
-                                "is_current_pdf": False
-                            }
-                        })
-                    else:
-                        print(f"Warning: Incomplete row data: {row}")
-            except Exception as e:
-                print(f"Other PDF search error: {e}")
-                traceback.print_exc()
-
-    except Exception as e:
-        print(f"Error in similarity search: {e}")
-        traceback.print_exc()
+                    other_pdf_chunks.append(_row_to_chunk(rest, False))
     finally:
-        conn.close()
-    
+        release_db_connection(conn)
+
+    # UNION ALL does not guarantee branch order is preserved
+    current_pdf_chunks.sort(key=_rank_key)
+    other_pdf_chunks.sort(key=_rank_key)
+    return current_pdf_chunks, other_pdf_chunks, page_content
+
+
+def merge_balanced_chunks(current_pdf_chunks: List[Dict], other_pdf_chunks: List[Dict], k: int):
+    """
+    Merge current-PDF and other-PDF results, reserving a share of the k slots for other PDFs
+
+    Returns:
+        Tuple[List[Dict], bool]: Merged chunks and whether other-PDF content was used
+    """
+    used_fallback = False
+
     # 3. 合并结果，平衡当前PDF与其他PDF的结果
     # 确保至少包含一些其他PDF的内容
     if len(current_pdf_chunks) > 0 and len(other_pdf_chunks) > 0:
@@ -531,8 +639,8 @@ def get_relevant_chunks(query: str, pdf_name: str = None, pdf_path: str = None,
         # 如果只有一种类型的结果，就全部使用
         chunks = current_pdf_chunks + other_pdf_chunks
         
-    # 按相似度重新排序
-    chunks.sort(key=lambda x: x['metadata'].get('distance', 1.0))
+    # 按相似度重新排序 (混合检索时按融合分数)
+    chunks.sort(key=_rank_key)
     
     # 如果使用了非当前PDF的内容，标记为使用了回退
     if other_pdf_chunks and len(other_pdf_chunks) > 0:
@@ -542,41 +650,253 @@ def get_relevant_chunks(query: str, pdf_name: str = None, pdf_path: str = None,
     return chunks[:k], used_fallback
 
 
-def get_fallback_chunks(pdf_name: str = None, k: int = 10) -> List[Dict]:
+def get_relevant_chunks(query: str, pdf_name: str = None, pdf_path: str = None, k: int = 5, allow_fallback: bool = True, use_ann: bool = True, ef_search: int = None, hybrid: bool = None,
+                        mmr: bool = None, mmr_lambda: float = None, max_distance: float = None) -> List[Dict]:
+    """
+    获取与查询相关的文档块，同时结合当前PDF和其他PDF中的内容
+    
+    Args:
+        query (str): 用户查询
+        pdf_name (str, optional): PDF名称过滤 (已弃用)
+        pdf_path (str, optional): PDF路径过滤
+        k (int): 返回的结果数量
+        allow_fallback (bool): 如果在指定PDF中找不到，是否回退到全局搜索
+        use_ann (bool): 是否使用近似最近邻搜索加速查询
+        ef_search (int, optional): HNSW搜索候选列表大小
+        hybrid (bool, optional): 是否融合全文检索与向量检索 (默认 HYBRID_SEARCH)
+        mmr (bool, optional): 是否使用最大边际相关性重新选择 (默认 MMR_ENABLED)
+        mmr_lambda (float, optional): MMR 相关性与多样性的权衡 (默认 MMR_LAMBDA)
+        max_distance (float, optional): 余弦距离阈值，超过的结果被丢弃 (默认 MAX_DISTANCE)
+    
+    Returns:
+        Tuple[List[Dict], bool]: 相关文档块列表和是否使用了回退策略
+    Raises:
+        Exception: 检索或嵌入失败时抛出, 由调用方处理 -> retrieval or embedding errors, handled by the caller
+    """
+    chunks, used_fallback, _ = retrieve_query_context(query, pdf_path, k=k, use_ann=use_ann, ef_search=ef_search,
+                                                      hybrid=hybrid, mmr=mmr, mmr_lambda=mmr_lambda,
+                                                      max_distance=max_distance)
+    return chunks, used_fallback
+
+
+def retrieve_query_context(query: str, pdf_path: str = None, page_number: int = None, k: int = 5, use_ann: bool = True,
+                           ef_search: int = None, hybrid: bool = None, mmr: bool = None, mmr_lambda: float = None,
+                           max_distance: float = None):
+    """
+    Retrieve the balanced relevant chunks and, when page_number is given, the exact
+    page content of pdf_path - all with a single database round trip.
+
+    Args:
+        query (str): User query
+        pdf_path (str, optional): Current PDF path (with public/ prefix)
+        page_number (int, optional): 0-based current page
+        k (int): Number of chunks to return
+        use_ann (bool): Whether to use approximate nearest neighbor search
+        ef_search (int, optional): HNSW candidate list size for this request
+        hybrid (bool, optional): Fuse full-text and vector rankings (default HYBRID_SEARCH);
+            the in-memory backend is vector-only
+        mmr (bool, optional): Re-select each side with maximal marginal relevance (default MMR_ENABLED)
+        mmr_lambda (float, optional): MMR relevance/diversity trade-off (default MMR_LAMBDA)
+        max_distance (float, optional): Drop chunks farther than this cosine distance (default MAX_DISTANCE)
+
+    Returns:
+        Tuple[List[Dict], bool, Optional[str]]: Chunks, whether other-PDF content was used, exact page content
+    Raises:
+        Exception: The embedding or search error, so callers can fall back to the current PDF's pages
+    """
+    query_embedding = embeddings.embed_query(query)
+
+    use_memory_index = vector_index is not None and vector_index.ready
+    hybrid = HYBRID_SEARCH if hybrid is None else hybrid
+    mmr = MMR_ENABLED if mmr is None else bool(mmr)
+    mmr_lambda = MMR_LAMBDA if mmr_lambda is None else float(mmr_lambda)
+    max_distance = MAX_DISTANCE if max_distance is None else float(max_distance)
+    fetch_k = k * max(MMR_FETCH_FACTOR, 1) if mmr else k
+    cache_key = (
+        embedding_fingerprint(query_embedding), pdf_path, k,
+        "memory" if use_memory_index else "pgvector", bool(use_ann), ef_search,
+        # Full-text ranking depends on the wording, not just the embedding
+        normalize_query(query) if hybrid and not use_memory_index else None,
+        mmr_lambda if mmr else None, max_distance,
+    )
+    generation = corpus_generation.current()
+    cached = retrieval_cache.get(cache_key, generation)
+    if cached is not None:
+        chunks, used_fallback = cached
+        page_content = None
+        if page_number is not None:
+            # Page text is not part of the cached result; look up just that page (one row, not the whole PDF)
+            try:
+                page_content = fetch_page_content(pdf_path, page_number)
+            except Exception as e:
+                print(f"Error fetching exact page: {e}")
+        return list(chunks), used_fallback, page_content
+
+    try:
+        if use_memory_index:
+            # In-process backend: exact search and page lookup without touching the database
+            current_pdf_chunks, other_pdf_chunks = vector_index.search(query_embedding, pdf_path, k=fetch_k,
+                                                                       with_embeddings=mmr)
+            page_content = vector_index.page_content(pdf_path, page_number) if page_number is not None else None
+        else:
+            current_pdf_chunks, other_pdf_chunks, page_content = fetch_retrieval_bundle(
+                query_embedding, pdf_path, k=fetch_k, page_number=page_number, use_ann=use_ann, ef_search=ef_search,
+                query_text=query, hybrid=hybrid, with_embeddings=mmr
+            )
+    except Exception as e:
+        print(f"Error in similarity search: {e}")
+        traceback.print_exc()
+        raise
+
+    # Relevance cutoff, then MMR on each side so overlapping windows of one page do not fill every slot
+    current_pdf_chunks = apply_distance_cutoff(current_pdf_chunks, max_distance)
+    other_pdf_chunks = apply_distance_cutoff(other_pdf_chunks, max_distance)
+    if mmr:
+        current_pdf_chunks = mmr_select(query_embedding, current_pdf_chunks, k, mmr_lambda)
+        other_pdf_chunks = mmr_select(query_embedding, other_pdf_chunks, k, mmr_lambda)
+        for chunk in current_pdf_chunks + other_pdf_chunks:
+            chunk.pop("embedding", None)
+
+    chunks, used_fallback = merge_balanced_chunks(current_pdf_chunks, other_pdf_chunks, k)
+    retrieval_cache.put(cache_key, generation, (list(chunks), used_fallback))
+    return chunks, used_fallback, page_content
+
+
+def load_pdf_chunks(pdf_path: str = None, pdf_name: str = None, use_cache: bool = True) -> List[Dict]:
+    """
+    Load all chunks of one PDF in page order, through the per-PDF cache
+
+    Args:
+        pdf_path (str, optional): PDF path (with public/ prefix); preferred
+        pdf_name (str, optional): PDF name, for older clients
+        use_cache (bool): Serve from pdf_cache when present
+    Returns:
+        List[Dict]: Chunks sorted by page number
+    """
+    cache_key = pdf_path or f"name:{pdf_name}"
+    if use_cache:
+        cached = pdf_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    chunks = []
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        if pdf_path:
+            # 通过路径查询
+            cursor.execute("""
+                SELECT id, content, "pageNumber", "pdfPath", "pdfName"
+                FROM "PdfChunk"
+                WHERE "pdfPath" = %s
+                ORDER BY "pageNumber"
+            """, (pdf_path,))
+        else:
+            # 通过名称查询(兼容旧版)
+            cursor.execute("""
+                SELECT id, content, "pageNumber", "pdfPath", "pdfName"
+                FROM "PdfChunk"
+                WHERE "pdfName" = %s
+                ORDER BY "pageNumber"
+            """, (pdf_name,))
+        rows = cursor.fetchall()
+
+    for row in rows:
+        id, content, page_number, path, name = row
+        chunks.append({
+            "id": id,
+            "content": content,
+            "metadata": {
+                "page": page_number,
+                "pdf_path": path,
+                "pdf_name": name,
+                "source": f"{path} - Page {page_number}"
+            }
+        })
+
+    # 按页码排序 -> Sort by page number
+    chunks.sort(key=lambda x: x['metadata']['page'])
+    pdf_cache.put(cache_key, chunks)
+    return chunks
+
+
+def fetch_page_content(pdf_path: str, page_number: int):
+    """
+    Exact content of one page of pdf_path, looked up independently of the vector search
+
+    Args:
+        pdf_path (str): PDF path (with public/ prefix)
+        page_number (int): 0-based page
+    Returns:
+        Optional[str]: Content of the first chunk on the page, or None if there is none
+    """
+    cached, content = pdf_cache.page_content(pdf_path, page_number)
+    if cached:
+        return content
+    if vector_index is not None and vector_index.ready:
+        return vector_index.page_content(pdf_path, page_number)
+    with db_pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT content FROM "PdfChunk"
+            WHERE "pdfPath" = %s AND "pageNumber" = %s
+            LIMIT 1
+        """, (pdf_path, page_number))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def get_fallback_chunks(pdf_name: str = None, k: int = 10, pdf_path: str = None) -> List[Dict]:
     """
     Get chunks sorted by page number as a fallback when similarity search fails
     
     Args:
         pdf_name (str, optional): PDF name to filter
         k (int): Number of chunks to return
+        pdf_path (str, optional): PDF path to filter (preferred over pdf_name)
     Returns:
         List[Dict]: Chunks sorted by page number
     """
     print("Using fallback: retrieving chunks sorted by page number")
-    global document_chunks
+    try:
+        if pdf_path or pdf_name:
+            # Served from the per-PDF cache when the document was opened via /load_pdf
+            chunks = load_pdf_chunks(pdf_path, pdf_name)
+        else:
+            chunks = load_embeddings_from_db()
+    except Exception as e:
+        print(f"Error loading fallback chunks: {str(e)}")
+        return []  # Return empty list if all fails
     
-    # If document_chunks is empty, try to load from database
-    if not document_chunks:
-        try:
-            document_chunks = load_embeddings_from_db(pdf_name)
-        except Exception as e:
-            print(f"Error loading fallback chunks: {str(e)}")
-            return []  # Return empty list if all fails
+    # Return limited number of chunks
+    return chunks[:k]
+
+def render_chunk(chunk: Dict) -> str:
+    """
+    Format a chunk as it appears in the prompt: a clickable page link followed by its content
+    """
+    page_number = chunk['metadata'].get('page', 'unknown')
+    doc_path = chunk['metadata'].get('pdf_path', '')
+    doc_name = chunk['metadata'].get('pdf_name', '')
     
-    # Filter by PDF name if specified
-    filtered_chunks = document_chunks
-    if pdf_name and document_chunks:
-        filtered_chunks = [c for c in document_chunks if c.get('metadata', {}).get('pdf_name') == pdf_name]
+    # Create page link with clickable format, using inline mode
+    source_name = os.path.basename(doc_path) if doc_path else doc_name
     
-    # Sort by page number
-    sorted_chunks = sorted(filtered_chunks, key=lambda x: x['metadata'].get('page', 0))
+    # Process PDF path to remove public/ prefix
+    clean_path = doc_path
+    if clean_path and clean_path.startswith('public/'):
+        clean_path = clean_path[7:]  # Remove public/ prefix
+        
+    # Ensure slashes in the link are forward slashes
+    if clean_path:
+        clean_path = clean_path.replace('\\', '/')
+        
+    # Add 1 to page number to match what user sees
+    display_page = page_number + 1 if isinstance(page_number, int) else page_number
     
-    # Return limited number of chunks
-    return sorted_chunks[:k]
+    page_info = f"[{source_name} - Page {display_page}](https://{display_page}?file={clean_path})"
+    return f"{page_info}: {chunk['content']}"
 
 def get_document_context(query: str, pdf_name: str = None, pdf_path: str = None, use_ann: bool = True) -> str:
     """
-    Get document context relevant to the query
+    Get document context relevant to the query, packed into the model's context token budget
     
     Args:
         query (str): User query
@@ -589,9 +909,8 @@ def get_document_context(query: str, pdf_name: str = None, pdf_path: str = None,
     """
     print(f"Getting document context: query='{query}', PDF path='{pdf_path}'")
     
-    # 1. Get relevant document chunks - limit quantity to prevent exceeding context window
-    max_chunks = 15  # Reduced from 30 to 15
-    relevant_chunks, used_fallback = get_relevant_chunks(query, None, pdf_path, k=max_chunks, allow_fallback=True)
+    # 1. Get relevant document chunks; the token budget, not the count, bounds the context
+    relevant_chunks, used_fallback = get_relevant_chunks(query, None, pdf_path, k=CONTEXT_CANDIDATES, allow_fallback=True)
     
     # If no relevant content found
     if not relevant_chunks:
@@ -605,52 +924,27 @@ def get_document_context(query: str, pdf_name: str = None, pdf_path: str = None,
         fallback_note = "**Note:** No exact matches found in current document. Showing related content from other documents.\n\n"
         formatted_chunks.append(fallback_note)
     
-    # Format each document chunk, add page links
-    for chunk in relevant_chunks:
-        page_number = chunk['metadata'].get('page', 'unknown')
-        content = chunk['content']
-        doc_path = chunk['metadata'].get('pdf_path', '')
-        doc_name = chunk['metadata'].get('pdf_name', '')
-        
-        # Create page link with clickable format, using inline mode
-        source_name = os.path.basename(doc_path) if doc_path else doc_name
-        
-        # Use inline prefix to indicate opening in current page
-        # Process PDF path to remove public/ prefix
-        clean_path = doc_path
-        if clean_path and clean_path.startswith('public/'):
-            clean_path = clean_path[7:]  # Remove public/ prefix
-            
-        # Ensure slashes in the link are forward slashes
-        if clean_path:
-            clean_path = clean_path.replace('\\', '/')
-            
-        # Add 1 to page number to match what user sees
-        display_page = page_number + 1 if isinstance(page_number, int) else page_number
-            
-        # Add quotes to ensure special characters are escaped
-        page_info = f"[{source_name} - Page {display_page}](https://{display_page}?file={clean_path})"
-        
-        # Add to formatted chunks
-        formatted_chunks.append(f"{page_info}: {content}")
+    # Fill the token budget in relevance order with whole entries, so page links are never cut
+    reserved = context_packer.count_tokens(formatted_chunks[0], llm.model_name) if formatted_chunks else 0
+    packed_chunks, report = context_packer.pack(relevant_chunks, render_chunk, model=llm.model_name,
+                                                reserved_tokens=reserved)
+    formatted_chunks.extend(render_chunk(chunk) for chunk in packed_chunks)
     
     # 3. Combine and return final result
     result = "\n---\n".join(formatted_chunks)
     
-    # 4. If result is too long, truncate it
-    if len(result) > 10000:  # About 3000 tokens
-        print(f"Document context too long ({len(result)} characters), truncating...")
-        result = result[:10000] + "\n\n[Content too long, truncated]"
-    
-    print(f"Found {len(relevant_chunks)} relevant document chunks, total length: {len(result)} characters")
+    print(f"Found {len(relevant_chunks)} relevant document chunks, packed {len(packed_chunks)}: {report}")
     
     return result
 
-def safety_check(answer: str) -> str:
+def safety_check(answer: str, model=None, context: str = "", timeout: float = None) -> str:
     """
     Check if the answer is safe to return
     Args:
         answer (str): Answer to check
+        model (optional): Chat model used for the check (default llm)
+        context (str): Text preceding the answer, when checking part of a streamed answer
+        timeout (float, optional): Deadline of the check in seconds (default LLM_TIMEOUT)
     Returns:
         str: Safety verdict
     """
@@ -658,12 +952,26 @@ def safety_check(answer: str) -> str:
         "You are a safety evaluator. Review the following answer and determine if it reveals "
         "too much sensitive or internal information. Reply with 'SAFE' if it is acceptable or 'BLOCK' "
         "if it discloses too much. Answer only with one word: either 'SAFE' or 'BLOCK'.\n\n"
-        f"Answer: {answer}"
     )
-    safety_response = llm.invoke(check_prompt)
+    if context:
+        check_prompt += f"Preceding text (already reviewed, for context only): {context}\n\n"
+    check_prompt += f"Answer: {answer}"
+    safety_response = llm_gateway.invoke(model or llm, check_prompt, route="safety", timeout=timeout)
     verdict = safety_response.get("content", "") if isinstance(safety_response, dict) else safety_response.content.strip()
     return verdict.upper()
 
+def summarize_history(summary, entries) -> str:
+    """
+    Fold conversation entries into the rolling summary of a session
+    Args:
+        summary (str): Previous summary, or None
+        entries (List[Dict]): "conversationhistory" entries not yet summarized
+    Returns:
+        str: Updated summary
+    """
+    response = llm_gateway.invoke(summary_llm, build_summary_prompt(summary, entries), route="summary")
+    return response.content.strip()
+
 def get_safe_answer(initial_answer: str, max_attempts: int = 3) -> str:
     """
     Get a safe answer after checking and potentially revising
@@ -686,12 +994,37 @@ def get_safe_answer(initial_answer: str, max_attempts: int = 3) -> str:
                 "Please provide a revised answer that conveys the necessary information safely without revealing "
                 "any sensitive or internal details."
             )
-            revised_response = llm.invoke(revision_prompt)
+            revised_response = llm_gateway.invoke(llm, revision_prompt, route="safety")
             answer_text = revised_response.get("content", "") if isinstance(revised_response, dict) else revised_response.content
             attempt += 1
 
     return answer_text
 
+def check_answer_window(text: str, context: str = "") -> bool:
+    """
+    Safety check of one window of a streamed answer, using the cheaper SAFETY_MODEL
+    """
+    # The gate stops waiting after its own timeout; give the call the same deadline so it frees its slot
+    timeout = safety_gate.timeout if safety_gate is not None else None
+    return safety_check(text, model=safety_llm, context=context, timeout=timeout).startswith("SAFE")
+
+def moderate_segment(moderator, segment: str) -> List[Dict]:
+    """
+    SSE payloads to send for a new answer segment, after the stream's safety moderator (if any)
+    """
+    if moderator is None:
+        return [{'answer': segment}]
+    return moderator.add(segment)
+
+
+def moderated_answer(moderator, answer_segments: List[str]) -> str:
+    """
+    Final answer text as the client shows it: the sent segments with retracted windows replaced,
+    so retracted text is never saved or fed back as history
+    """
+    answer = "".join(answer_segments)
+    return moderator.apply_retractions(answer) if moderator is not None else answer
+
 def generate_quiz_question(user_input, personalized_prompt, document_context):
     # Define quiz-specific instructions
     quiz_instructions = (
@@ -729,47 +1062,95 @@ def generate_quiz_question(user_input, personalized_prompt, document_context):
     print("Final quiz prompt for LLM:")
     print(final_prompt)
     
-    response = llm.invoke(final_prompt)
+    response = llm_gateway.invoke(llm, final_prompt, route="quiz")
     answer_text = response.content.strip()
     return answer_text
 
+def _hnsw_index_name(prefix: str = None) -> str:
+    if not prefix:
+        return "pdf_chunk_embedding_idx"
+    slug = re.sub(r"[^a-z0-9]+", "_", prefix.lower()).strip("_")
+    return f"pdf_chunk_embedding_{slug}_idx"
+
+
+def _version_tuple(version: str):
+    return tuple(int(part) for part in re.findall(r"\d+", version or "")[:3])
+
+
 def create_vector_index():
     """
     在数据库中创建或更新向量索引以加速查询
+    -> Create the global HNSW index, one partial HNSW index per course prefix and the pdfPath index.
+    Build parameters come from HNSW_M / HNSW_EF_CONSTRUCTION; existing indexes are left untouched.
     """
+    global pgvector_iterative_scan, fulltext_available
+
     conn = get_db_connection()
     try:
         with conn.cursor() as cursor:
+            # 检测pgvector版本 -> iterative index scans need pgvector >= 0.8.0
+            cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+            row = cursor.fetchone()
+            pgvector_version = row[0] if row else None
+            pgvector_iterative_scan = _version_tuple(pgvector_version) >= (0, 8, 0)
+            print(f"pgvector version: {pgvector_version}, iterative scans: {pgvector_iterative_scan}")
+
             # 检查是否已存在索引
             cursor.execute("""
                 SELECT indexname FROM pg_indexes 
-                WHERE tablename = 'PdfChunk' AND indexname = 'pdf_chunk_embedding_idx'
+                WHERE tablename = 'PdfChunk'
             """)
-            
-            index_exists = cursor.fetchone() is not None
-            
-            if not index_exists:
-                print("Creating HNSW vector index for faster similarity search...")
-                # 创建HNSW索引，这是一种近似最近邻索引，能显著加速向量搜索
-                cursor.execute("""
-                    CREATE INDEX pdf_chunk_embedding_idx 
-                    ON "PdfChunk" USING hnsw (embedding vector_cosine_ops)
-                    WITH (m = 16, ef_construction = 64);
-                """)
+            existing_indexes = {r[0] for r in cursor.fetchall()}
+
+            build_options = f"WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION})"
+
+            # 创建HNSW索引，这是一种近似最近邻索引，能显著加速向量搜索
+            # -> None is the global index; each course prefix gets a smaller partial index
+            for prefix in [None] + HNSW_COURSE_PREFIXES:
+                index_name = _hnsw_index_name(prefix)
+                if index_name in existing_indexes:
+                    print(f"Vector index {index_name} already exists.")
+                    continue
+
+                print(f"Creating HNSW vector index {index_name} ({build_options})...")
+                if prefix:
+                    cursor.execute(f"""
+                        CREATE INDEX {index_name}
+                        ON "PdfChunk" USING hnsw (embedding vector_cosine_ops)
+                        {build_options}
+                        WHERE "pdfPath" LIKE %s;
+                    """, (_escape_like(prefix) + "%",))
+                else:
+                    cursor.execute(f"""
+                        CREATE INDEX {index_name}
+                        ON "PdfChunk" USING hnsw (embedding vector_cosine_ops)
+                        {build_options};
+                    """)
                 conn.commit()
-                print("HNSW vector index created successfully.")
-            else:
-                print("Vector index already exists.")
+                print(f"HNSW vector index {index_name} created successfully.")
                 
-            # 添加pdfPath的索引
+            # 全文检索: 生成的tsvector列及其GIN索引 -> generated tsvector column + GIN index for hybrid search
             cursor.execute("""
-                SELECT indexname FROM pg_indexes 
-                WHERE tablename = 'PdfChunk' AND indexname = 'pdf_chunk_path_idx'
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'PdfChunk' AND column_name = 'contentTsv'
             """)
-            
-            path_index_exists = cursor.fetchone() is not None
-            
-            if not path_index_exists:
+            if cursor.fetchone() is None:
+                print("Adding generated full-text column contentTsv (one-time table rewrite)...")
+                cursor.execute(f"""
+                    ALTER TABLE "PdfChunk" ADD COLUMN IF NOT EXISTS "contentTsv" tsvector
+                    GENERATED ALWAYS AS (to_tsvector('{FULLTEXT_CONFIG}'::regconfig, content)) STORED;
+                """)
+                conn.commit()
+            if "pdf_chunk_content_tsv_idx" not in existing_indexes:
+                print("Creating GIN full-text index...")
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS pdf_chunk_content_tsv_idx ON "PdfChunk" USING gin ("contentTsv");
+                """)
+                conn.commit()
+            fulltext_available = True
+
+            # 添加pdfPath的索引
+            if "pdf_chunk_path_idx" not in existing_indexes:
                 print("Creating index on pdfPath column...")
                 cursor.execute("""
                     CREATE INDEX pdf_chunk_path_idx ON "PdfChunk" ("pdfPath");
@@ -784,7 +1165,7 @@ def create_vector_index():
         print(f"Error creating vector index: {str(e)}")
         traceback.print_exc()
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 # 应用启动时尝试创建向量索引
 try:
@@ -792,155 +1173,242 @@ try:
 except Exception as e:
     print(f"Warning: Failed to create vector index: {str(e)}")
 
-@app.route("/query", methods=["POST"])
-def query():
+# Retrieval results are cached per (query embedding, pdfPath, k, backend) and dropped whenever the
+# ingestion scripts bump the corpus generation after changing "PdfChunk"
+retrieval_cache = RetrievalCache(
+    max_entries=int(os.getenv("RETRIEVAL_CACHE_SIZE", 1024)),
+    ttl_seconds=float(os.getenv("RETRIEVAL_CACHE_TTL", 900)),
+)
+corpus_generation = CorpusGeneration(db_pool, poll_interval=float(os.getenv("CORPUS_GENERATION_POLL_INTERVAL", 5)))
+corpus_generation.on_change(lambda old, new: retrieval_cache.clear())
+corpus_generation.on_change(lambda old, new: pdf_cache.invalidate())
+
+# Final answers of non-quiz /query requests, reused for semantically identical questions
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+answer_cache = SemanticAnswerCache(
+    max_entries=int(os.getenv("ANSWER_CACHE_SIZE", 512)),
+    max_distance=float(os.getenv("ANSWER_CACHE_MAX_DISTANCE", 0.05)),
+    ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL", 3600)),
+)
+corpus_generation.on_change(lambda old, new: answer_cache.clear())
+
+# /query runs its independent stages (history load, page lookup, embedding + vector search)
+# concurrently, each with its own timeout; 0 restores the sequential single-round-trip path
+CONCURRENT_QUERY_STAGES = os.getenv("CONCURRENT_QUERY_STAGES", "1").lower() not in ("0", "false", "no")
+query_stages = StageRunner.from_env()
+STAGE_FAILED = object()  # default of a stage whose None result is meaningful
+
+# Write statistics of all answer streams (see TokenCoalescer for the flush policy)
+stream_stats = StreamStats()
+
+# /generate_quiz fans larger requests out over chunk groups (QUIZ_QUESTIONS_PER_CALL questions per call)
+QUIZ_CHUNKS_PER_QUESTION = int(os.getenv("QUIZ_CHUNKS_PER_QUESTION", 3))
+QUIZ_MAX_CHUNKS = int(os.getenv("QUIZ_MAX_CHUNKS", 60))
+quiz_generator = QuizGenerator.from_env()
+# Precomputed questions (build_quiz_bank.py); live generation only covers what the bank cannot serve
+quiz_bank = QuizBank.from_env(db_pool)
+
+# Open the minimum number of pooled connections before the first request arrives
+try:
+    print(f"Warmed {db_pool.warm()} database connections")
+except Exception as e:
+    print(f"Warning: Failed to warm connection pool: {str(e)}")
+
+# Retrieval backend: "pgvector" (default) searches in the database,
+# "memory" loads every chunk embedding into an in-process NumPy index at startup
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "pgvector").lower()
+vector_index = None
+if RETRIEVAL_BACKEND == "memory":
+    vector_index = InMemoryVectorIndex(db_pool, refresh_interval=float(os.getenv("VECTOR_INDEX_REFRESH_INTERVAL", 60)))
     try:
-        data = request.get_json()
-        if not data or "query" not in data:
-            return jsonify({"error": "Missing 'query' in request."}), 400
-        print(data)
-        user_input = data["query"]
-        pdf_path = data.get("pdf_url")  # 获取pdf_path参数
-        if not pdf_path:
-            pdf_path = data.get("pdf_path")  # 尝试备用参数名
-        page_number = data.get("pageNumber")  # 获取当前页码
-        quiz_mode = data.get("quiz_mode", False)
-        user_id = data.get("user_id", "anonymous")
-        user_name = data.get("user_name", "User")
-        user_email = data.get("user_email", "N/A")
-        pdf_url = data.get("pdf_url")
-        use_ann = data.get("use_ann", True)
-        reset_context = data.get("reset_context", False)  # 添加是否重置上下文的参数
+        vector_index.load()
+    except Exception as e:
+        # Searches fall back to pgvector until the refresher manages a full load
+        print(f"Warning: Failed to load in-memory vector index: {str(e)}")
+    vector_index.start_refresher()
+    # Pick up re-embedded chunks right away instead of waiting for the next poll
+    corpus_generation.on_change(lambda old, new: threading.Thread(target=vector_index.refresh, daemon=True).start())
+elif RETRIEVAL_BACKEND != "pgvector":
+    print(f"Warning: Unknown RETRIEVAL_BACKEND '{RETRIEVAL_BACKEND}', using pgvector")
+    RETRIEVAL_BACKEND = "pgvector"
+
+def prepare_query(data: dict) -> dict:
+    """
+    Parse a /query request body and build everything the answer depends on:
+    the personalized prompt and the document context from retrieval.
+    Shared by the Flask route and the async server (kiwi_asgi.py).
+
+    Args:
+        data (dict): Request JSON, must contain "query"
+    Returns:
+        dict: Query context consumed by stream_answer / build_answer_prompt
+    """
+    user_input = data["query"]
+    pdf_path = data.get("pdf_url")  # 获取pdf_path参数
+    if not pdf_path:
+        pdf_path = data.get("pdf_path")  # 尝试备用参数名
+    page_number = data.get("pageNumber")  # 获取当前页码
+    quiz_mode = data.get("quiz_mode", False)
+    user_id = data.get("user_id", "anonymous")
+    user_name = data.get("user_name", "User")
+    user_email = data.get("user_email", "N/A")
+    pdf_url = data.get("pdf_url")
+    use_ann = data.get("use_ann", True)
+    ef_search = data.get("ef_search")  # 可选: 每个请求的HNSW ef_search
+    hybrid = data.get("hybrid")  # 可选: 覆盖 HYBRID_SEARCH
+    mmr = data.get("mmr")  # 可选: 覆盖 MMR_ENABLED
+    mmr_lambda = data.get("mmr_lambda")  # 可选: 覆盖 MMR_LAMBDA
+    max_distance = data.get("max_distance")  # 可选: 覆盖 MAX_DISTANCE
+    reset_context = data.get("reset_context", False)  # 添加是否重置上下文的参数
+    # 提示包含对话历史时答案因用户而异, 不使用共享的答案缓存 -> answers that read the history are per user; skip the shared cache
+    use_answer_cache = ANSWER_CACHE_ENABLED and not ANSWER_HISTORY_TURNS and data.get("use_answer_cache", True)
+    
+    if page_number is not None:
+        page_number = page_number - 1  # 页码调整
+    
+    # 记录更详细的阅读信息
+    reading_info = ""
+    if pdf_path:
+        reading_info += f"PDF路径: {pdf_path}"
         
-        if page_number is not None:
-            page_number = page_number - 1  # 页码调整
+    if page_number:
+        reading_info += f", 当前页码: {page_number}"
         
-        # 记录更详细的阅读信息
-        reading_info = ""
-        if pdf_path:
-            reading_info += f"PDF路径: {pdf_path}"
-            
-        if page_number:
-            reading_info += f", 当前页码: {page_number}"
-            
-        print(f"Query received from {user_name} (ID: {user_id}, Email: {user_email}) - {reading_info} - Quiz mode: {quiz_mode}")
-        print(f"请求数据: {data}")  # 打印完整请求数据以便调试
-
-        # 如果需要重置上下文，先删除现有记忆 -> If context reset is requested, delete existing memory first
-        if reset_context and user_id in user_memories:
-            print(f"Resetting conversation context for user {user_id}")
-            del user_memories[user_id]
-            
-        # Get user-specific memory and personalized prompt
-        user_data = get_user_memory(user_id, user_name, user_email)
-        memory = user_data["memory"]
-        personalized_prompt = user_data["personalized_prompt"]
-
-        # 增强个性化提示，包含当前阅读的文档和页码信息
-        if pdf_path or page_number:
-            context_info = f"\n\nThe user is currently reading "
-            if pdf_path:
-                context_info += f"the document at path '{pdf_path}'"
-                
-            if page_number:
-                context_info += f" on page {page_number}"
-            
-            context_info += "."
-            personalized_prompt += context_info
+    print(f"Query received from {user_name} (ID: {user_id}, Email: {user_email}) - {reading_info} - Quiz mode: {quiz_mode}")
+    print(f"请求数据: {data}")  # 打印完整请求数据以便调试
 
-        # 获取文档上下文
-        document_context = ""
+    # 如果需要重置上下文，先删除现有记忆 -> If context reset is requested, delete existing memory first
+    if reset_context and user_memories.pop(user_id) is not None:
+        print(f"Resetting conversation context for user {user_id}")
         
-        # 1. 先尝试精准查询当前页
-        exact_context = None
-        if pdf_path and page_number is not None:
-            try:
-                # 确保pdf_path有正确的前缀
-                if pdf_path and not pdf_path.startswith('public/'):
-                    pdf_path_with_prefix = 'public/' + pdf_path
-                else:
-                    pdf_path_with_prefix = pdf_path
-                    
-                conn = get_db_connection()
-                with conn.cursor() as cursor:
-                    # 先列出示例路径以便调试
-                    cursor.execute('SELECT "pdfPath" FROM "PdfChunk" LIMIT 10')
-                    paths = cursor.fetchall()
-                    print(f"Incoming path: '{pdf_path}'")
-                    print(f"Path after adding prefix: '{pdf_path_with_prefix}'")
-                    print(f"Database paths: {paths}")
-                    
-                    print(f"Query parameters: pdf_path={pdf_path_with_prefix}, page_number={page_number}, Types: {type(pdf_path_with_prefix)}, {type(page_number)}")
-                    cursor.execute("""
-                        SELECT content
-                        FROM "PdfChunk"
-                        WHERE "pdfPath" = %s AND "pageNumber" = %s
-                        LIMIT 1
-                    """, (pdf_path_with_prefix, page_number))
-                    row = cursor.fetchone()
-                conn.close()
-
-                if row:
-                    # 确保路径格式正确 - 移除public/前缀
-                    clean_path = pdf_path
-                    if clean_path and clean_path.startswith('public/'):
-                        clean_path = clean_path[7:]  # 移除public/前缀
-                    
-                    # 确保链接中使用正斜杠
-                    if clean_path:
-                        clean_path = clean_path.replace('\\', '/')
-                    
-                    # 页码+1以匹配用户看到的页码
-                    display_page = page_number + 1 if isinstance(page_number, int) else page_number
-                    
-                    exact_context = f"[{os.path.basename(pdf_path)} - Page {display_page}](https://{display_page}?file={clean_path}): {row[0]}"
-                else:
-                    exact_context = f"No content found at {pdf_path_with_prefix} page {page_number}."
-            except Exception as e:
-                print(f"Error fetching exact page: {e}")
-                traceback.print_exc()
-                exact_context = "Error fetching page content."
+    # Load the user's memory alongside retrieval only when that reads the database (HISTORY_LAZY=0);
+    # a resident or lazily loaded memory is a dictionary lookup and is taken inline
+    memory_stage = None
+    if CONCURRENT_QUERY_STAGES and not HISTORY_LAZY:
+        memory_stage = query_stages.submit("memory", get_user_memory, user_id, user_name, user_email)
+
+    def resolve_user_data():
+        if memory_stage is None:
+            return get_user_memory(user_id, user_name, user_email)
+        # Without history the answer still works; the entry is stored once the load finishes
+        return query_stages.result(memory_stage) or new_user_memory(user_id, user_name, user_email)
+
+    # 获取文档上下文
+    document_context = ""
+    
+    # 确保检索使用正确的路径前缀
+    search_pdf_path = None
+    if pdf_path:
+        # 首先尝试提取基本文件名，避免路径格式不一致的问题
+        base_name = os.path.basename(pdf_path)
+        # 检查是否需要添加前缀
+        if not pdf_path.startswith('public/'):
+            search_pdf_path = 'public/' + pdf_path
+        else:
+            search_pdf_path = pdf_path
+            
+        print(f"原始路径: {pdf_path}, 基本文件名: {base_name}, 搜索路径: {search_pdf_path}")
+
+    # 测验模式优先从题库抽题, 命中时跳过检索 -> quiz mode serves a bank question when there is one, skipping retrieval
+    if quiz_mode and search_pdf_path:
+        bank_questions = quiz_bank.sample(search_pdf_path, normalize_difficulty(data.get("difficulty")), 1,
+                                          user_id=user_id, page=page_number)
+        if bank_questions:
+            user_data = resolve_user_data()
+            return {
+                "user_input": user_input,
+                "user_id": user_id,
+                "pdf_path": pdf_path,
+                "pdf_url": pdf_url,
+                "search_pdf_path": search_pdf_path,
+                "page_number": page_number,
+                "quiz_mode": quiz_mode,
+                "quiz_question": to_quiz_mode(bank_questions[0]),
+                "use_answer_cache": use_answer_cache,
+                "user_data": user_data,
+                "memory": user_data["memory"],
+                "personalized_prompt": user_data["personalized_prompt"],
+                "document_context": "",
+                "context_report": None,
+            }
 
-        # 2. 再做向量相似度检索（跨所有 PDF）
-        # 确保向量检索也使用正确的路径前缀
-        search_pdf_path = None
+    # 1+2. 当前页精准查询与向量相似度检索（跨所有 PDF）
+    # 候选数量; 上下文长度由 token 预算控制 -> candidate count; context length is bounded by the token budget
+    max_chunks = CONTEXT_CANDIDATES
+    exact_page = page_number if pdf_path and page_number is not None else None
+
+    # 已通过 /load_pdf 缓存的PDF直接从内存取当前页 -> pages of PDFs opened via /load_pdf come from memory
+    page_cached, cached_page_content = False, None
+    if exact_page is not None:
+        page_cached, cached_page_content = pdf_cache.page_content(search_pdf_path, exact_page)
+
+    page_unavailable = False
+    retrieval_failed = False
+    if CONCURRENT_QUERY_STAGES:
+        # Page lookup and embedding + vector search run side by side, each with its own timeout,
+        # so a slow stage degrades the context instead of delaying the first token
+        page_stage = None
+        if exact_page is not None and not page_cached:
+            page_stage = query_stages.submit("page", fetch_page_content, search_pdf_path, exact_page)
+        retrieval_stage = query_stages.submit(
+            "retrieval", retrieve_query_context, user_input, search_pdf_path, k=max_chunks,
+            use_ann=use_ann, ef_search=ef_search, hybrid=hybrid, mmr=mmr, mmr_lambda=mmr_lambda,
+            max_distance=max_distance
+        )
+        retrieved = query_stages.result(retrieval_stage, default=STAGE_FAILED)
+        retrieval_failed = retrieved is STAGE_FAILED
+        sim_chunks, used_fallback, _ = ([], False, None) if retrieval_failed else retrieved
+        page_content = cached_page_content
+        if page_stage is not None:
+            page_content = query_stages.result(page_stage, default=STAGE_FAILED)
+            if page_content is STAGE_FAILED:
+                page_content, page_unavailable = None, True
+        user_data = resolve_user_data()
+    else:
+        # Exact page lookup and cross-PDF vector search share a single database round trip
+        try:
+            sim_chunks, used_fallback, page_content = retrieve_query_context(
+                user_input, search_pdf_path, page_number=None if page_cached else exact_page, k=max_chunks,
+                use_ann=use_ann, ef_search=ef_search, hybrid=hybrid, mmr=mmr, mmr_lambda=mmr_lambda,
+                max_distance=max_distance
+            )
+        except Exception as e:
+            print(f"Warning: Retrieval failed, falling back to the current PDF: {e}")
+            sim_chunks, used_fallback, page_content = [], False, None
+            retrieval_failed = True
+            page_unavailable = exact_page is not None and not page_cached
+        if page_cached:
+            page_content = cached_page_content
+        user_data = resolve_user_data()
+
+    # Get user-specific memory and personalized prompt
+    memory = user_data["memory"]
+    personalized_prompt = user_data["personalized_prompt"]
+
+    # 增强个性化提示，包含当前阅读的文档和页码信息
+    if pdf_path or page_number:
+        context_info = f"\n\nThe user is currently reading "
         if pdf_path:
-            # 首先尝试提取基本文件名，避免路径格式不一致的问题
-            base_name = os.path.basename(pdf_path)
-            # 检查是否需要添加前缀
-            if not pdf_path.startswith('public/'):
-                search_pdf_path = 'public/' + pdf_path
-            else:
-                search_pdf_path = pdf_path
-                
-            print(f"原始路径: {pdf_path}, 基本文件名: {base_name}, 搜索路径: {search_pdf_path}")
+            context_info += f"the document at path '{pdf_path}'"
             
-        # 使用指定的PDF路径进行搜索，同时允许回退到全局搜索
-        # 限制检索数量以避免上下文长度过长
-        max_chunks = 15  # 减少从30到15
-        sim_chunks, used_fallback = get_relevant_chunks(user_input, None, search_pdf_path, k=max_chunks, allow_fallback=True, use_ann=use_ann)
-        
-        # 格式化向量搜索结果
-        similar_contexts = []
-        current_pdf_contexts = []
-        other_pdf_contexts = []
+        if page_number:
+            context_info += f" on page {page_number}"
         
-        # 如果有结果，添加引导性说明 -> If there are results, add an introductory note
-        if sim_chunks:
-            fallback_note = "**Query results include content from multiple documents:**\\n\\n"
-            
-        for chunk in sim_chunks:
-            p = chunk['metadata']['page']
-            p_path = chunk['metadata'].get('pdf_path', 'Unknown')
-            p_name = chunk['metadata'].get('pdf_name', 'Unknown')
-            is_current_pdf = chunk['metadata'].get('is_current_pdf', False)
-            content = chunk['content']
-            
-            # 获取文档名称，优先使用文件名，没有则使用PDF名称
-            doc_name = os.path.basename(p_path) if p_path else p_name
-            
+        context_info += "."
+        personalized_prompt += context_info
+
+    # 相似度检索失败时，回退到当前PDF按页码排序的内容 (设置了距离阈值时，空结果是有意的)
+    if not sim_chunks and search_pdf_path and (retrieval_failed or (max_distance is None and MAX_DISTANCE is None)):
+        sim_chunks = [
+            {**chunk, "metadata": {**chunk["metadata"], "is_current_pdf": True}}
+            for chunk in get_fallback_chunks(pdf_path=search_pdf_path, k=max_chunks)
+        ]
+
+    exact_context = None
+    if exact_page is not None:
+        if page_content is not None:
             # 确保路径格式正确 - 移除public/前缀
-            clean_path = p_path
+            clean_path = pdf_path
             if clean_path and clean_path.startswith('public/'):
                 clean_path = clean_path[7:]  # 移除public/前缀
             
@@ -948,62 +1416,144 @@ def query():
             if clean_path:
                 clean_path = clean_path.replace('\\', '/')
             
-            # 将页码+1，使其与用户看到的页码一致
-            display_page = p + 1 if isinstance(p, int) else p
+            # 页码+1以匹配用户看到的页码
+            display_page = page_number + 1 if isinstance(page_number, int) else page_number
             
-            # 添加可点击的页面链接
-            page_info = f"[{doc_name} - Page {display_page}](https://{display_page}?file={clean_path})"
-            
-            # 根据来源分类
-            if is_current_pdf:
-                current_pdf_contexts.append(f"{page_info}: {content}")
-            else:
-                other_pdf_contexts.append(f"{page_info}: {content}")
-            
-        # 如果有当前PDF的内容，先添加 -> If there is content from the current PDF, add it first
-        if current_pdf_contexts:
-            similar_contexts.append("**Current document content:**\\n" + "\\n---\\n".join(current_pdf_contexts))
+            exact_context = f"[{os.path.basename(pdf_path)} - Page {display_page}](https://{display_page}?file={clean_path}): {page_content}"
+        elif page_unavailable:
+            exact_context = f"Content of {search_pdf_path} page {page_number} is temporarily unavailable."
+        else:
+            exact_context = f"No content found at {search_pdf_path} page {page_number}."
+
+    # 按相关性顺序填充模型的上下文 token 预算（当前页优先），去除重叠的重复内容
+    # -> Fill the model's context token budget in relevance order after the current page, dropping overlap duplicates
+    reserved = context_packer.count_tokens(exact_context, llm.model_name) if exact_context else 0
+    sim_chunks, context_report = context_packer.pack(sim_chunks, render_chunk, model=llm.model_name,
+                                                     reserved_tokens=reserved)
+    print(f"Context packing: {context_report}")
+    
+    # 格式化向量搜索结果
+    similar_contexts = []
+    current_pdf_contexts = []
+    other_pdf_contexts = []
+    
+    # 如果有结果，添加引导性说明 -> If there are results, add an introductory note
+    if sim_chunks:
+        fallback_note = "**Query results include content from multiple documents:**\\n\\n"
         
-        # 如果有其他PDF的内容，再添加，并确保它们有明显的标注 -> If there is content from other PDFs, add it next, ensuring clear labeling
-        if other_pdf_contexts:
-            # 根据文件名分组 -> Group by filename
-            grouped_contexts = {}
-            for ctx in other_pdf_contexts:
-                # 提取文件名
-                match = re.search(r'\[(.*?) -', ctx)
-                if match:
-                    file_name = match.group(1)
-                    grouped_contexts.setdefault(file_name, []).append(ctx)
-            
-            # 添加每组内容 -> Add content for each group
-            for file_name, contexts in grouped_contexts.items():
-                similar_contexts.append(f"**Related document [{file_name}] content:**\\n" + "\\n---\\n".join(contexts))
-            
-        sim_section = fallback_note + "\\n\\n".join(similar_contexts) if similar_contexts else "No related content."
-
-        # 3. 合并成最终 document_context -> Merge into the final document_context
-        if exact_context:
-            document_context = (
-                f"**Current page content**:\n{exact_context}\n\n"
-                f"**Related passages from all documents**:\n{sim_section}"
-            )
+    for chunk in sim_chunks:
+        p = chunk['metadata']['page']
+        p_path = chunk['metadata'].get('pdf_path', 'Unknown')
+        p_name = chunk['metadata'].get('pdf_name', 'Unknown')
+        is_current_pdf = chunk['metadata'].get('is_current_pdf', False)
+        content = chunk['content']
+        
+        # 获取文档名称，优先使用文件名，没有则使用PDF名称
+        doc_name = os.path.basename(p_path) if p_path else p_name
+        
+        # 确保路径格式正确 - 移除public/前缀
+        clean_path = p_path
+        if clean_path and clean_path.startswith('public/'):
+            clean_path = clean_path[7:]  # 移除public/前缀
+        
+        # 确保链接中使用正斜杠
+        if clean_path:
+            clean_path = clean_path.replace('\\', '/')
+        
+        # 将页码+1，使其与用户看到的页码一致
+        display_page = p + 1 if isinstance(p, int) else p
+        
+        # 添加可点击的页面链接
+        page_info = f"[{doc_name} - Page {display_page}](https://{display_page}?file={clean_path})"
+        
+        # 根据来源分类
+        if is_current_pdf:
+            current_pdf_contexts.append(f"{page_info}: {content}")
         else:
-            document_context = sim_section
+            other_pdf_contexts.append(f"{page_info}: {content}")
+        
+    # 如果有当前PDF的内容，先添加 -> If there is content from the current PDF, add it first
+    if current_pdf_contexts:
+        similar_contexts.append("**Current document content:**\\n" + "\\n---\\n".join(current_pdf_contexts))
+    
+    # 如果有其他PDF的内容，再添加，并确保它们有明显的标注 -> If there is content from other PDFs, add it next, ensuring clear labeling
+    if other_pdf_contexts:
+        # 根据文件名分组 -> Group by filename
+        grouped_contexts = {}
+        for ctx in other_pdf_contexts:
+            # 提取文件名
+            match = re.search(r'\[(.*?) -', ctx)
+            if match:
+                file_name = match.group(1)
+                grouped_contexts.setdefault(file_name, []).append(ctx)
+        
+        # 添加每组内容 -> Add content for each group
+        for file_name, contexts in grouped_contexts.items():
+            similar_contexts.append(f"**Related document [{file_name}] content:**\\n" + "\\n---\\n".join(contexts))
+        
+    sim_section = fallback_note + "\\n\\n".join(similar_contexts) if similar_contexts else "No related content."
 
-        # 如果真一条都没，就给个提示 -> If truly nothing was found, provide a hint
-        if not document_context.strip():
-            document_context = "No relevant context found."
+    # 3. 合并成最终 document_context -> Merge into the final document_context
+    if exact_context:
+        document_context = (
+            f"**Current page content**:\n{exact_context}\n\n"
+            f"**Related passages from all documents**:\n{sim_section}"
+        )
+    else:
+        document_context = sim_section
+
+    # 如果真一条都没，就给个提示 -> If truly nothing was found, provide a hint
+    if not document_context.strip():
+        document_context = "No relevant context found."
+
+    return {
+        "user_input": user_input,
+        "user_id": user_id,
+        "pdf_path": pdf_path,
+        "pdf_url": pdf_url,
+        "search_pdf_path": search_pdf_path,
+        "page_number": page_number,
+        "quiz_mode": quiz_mode,
+        "quiz_question": None,
+        "use_answer_cache": use_answer_cache,
+        "user_data": user_data,
+        "memory": memory,
+        "personalized_prompt": personalized_prompt,
+        "document_context": document_context,
+        "context_report": context_report,
+    }
+
+
+def quiz_mode_answer(query_context: dict) -> str:
+    """
+    Quiz mode answer of /query: the quiz bank question picked by prepare_query,
+    or a question generated live with the retrieved context when the bank had none
+    """
+    if query_context["quiz_question"] is not None:
+        return json.dumps(query_context["quiz_question"])
+    # Use the quiz generation tool with context
+    return generate_quiz_question(query_context["user_input"], query_context["personalized_prompt"],
+                                  query_context["document_context"])
 
-        def generate():
-            try:
-                if quiz_mode:
-                    # Use the quiz generation tool with context
-                    answer_text = generate_quiz_question(user_input, personalized_prompt, document_context)
-                    yield f"data: {json.dumps({'answer': answer_text})}\n\n"
-                else:
-                    # 更新系统提示，包含文档内容
-                    if document_context:
-                        system = f"""You are a professional assistant named Kiwi. You will answer the user's questions about the following documents:
+
+def build_answer_prompt(query_context: dict) -> str:
+    """
+    Build the final LLM prompt for a non-quiz /query answer
+
+    Args:
+        query_context (dict): Result of prepare_query
+    Returns:
+        str: Prompt text
+    """
+    document_context = query_context["document_context"]
+    pdf_path = query_context["pdf_path"]
+    pdf_url = query_context["pdf_url"]
+    page_number = query_context["page_number"]
+    user_input = query_context["user_input"]
+
+    # 更新系统提示，包含文档内容
+    if document_context:
+        system = f"""You are a professional assistant named Kiwi. You will answer the user's questions about the following documents:
 
 {document_context}
 
@@ -1017,74 +1567,153 @@ Please adhere to the following requirements:
 7. If the user's question is outside the scope of the documents, politely decline to answer.
 
 Remember, integrating relevant information from different documents is very important. Clearly indicate the source of each piece of information to provide the user with a more complete and reliable answer."""
-                    else:
-                        system = f"""You are a professional assistant named Kiwi. Please do your best to answer the user's questions.
+    else:
+        system = f"""You are a professional assistant named Kiwi. Please do your best to answer the user's questions.
 
 If you cannot answer based on the available information, honestly inform the user and suggest they provide more relevant information or upload related documents."""
-                    
-                    # 构建最终提示，不包含对话历史
-                    final_prompt = f"{system}\\n\\n"
-                    
-                    if pdf_path:
-                        final_prompt += f"PDF Path: {pdf_path}\n"
-                    if page_number:
-                        final_prompt += f"Current Page: {page_number}\n"
-                    if pdf_url:
-                        final_prompt += f"PDF URL: {pdf_url}\n"
-                        
-                    final_prompt += f"\nDocument Context:\n{document_context}\n\n"
-                    # 移除对话历史部分
-                    final_prompt += f"User: {user_input}\n"
-                    final_prompt += f"Assistant:"
-                    
-                    # Use streaming for the LLM response
-                    response = llm.stream(final_prompt)
-                    full_answer = ""
-                    sentence_buffer = ""
-                    
-                    print("Starting streaming response...")
-                    for chunk in response:
-                        if chunk.content:
-                            print(f"Received chunk: '{chunk.content}'")
-                            sentence_buffer += chunk.content
-                            
-                            # Check if we have a complete sentence or meaningful chunk
-                            if (chunk.content.endswith('.') or 
-                                chunk.content.endswith('!') or 
-                                chunk.content.endswith('?') or 
-                                chunk.content.endswith('\n') or
-                                len(sentence_buffer) > 80):  # 降低阈值以更频繁发送
-                                
-                                if sentence_buffer.strip():
-                                    print(f"Yielding sentence: '{sentence_buffer}'")
-                                    full_answer += sentence_buffer
-                                    yield f"data: {json.dumps({'answer': sentence_buffer})}\n\n"
-                                    sentence_buffer = ""
-                    
-                    # Send any remaining content
-                    if sentence_buffer.strip():
-                        print(f"Yielding final chunk: '{sentence_buffer}'")
-                        full_answer += sentence_buffer
-                        yield f"data: {json.dumps({'answer': sentence_buffer})}\n\n"
-                    
-                    # 发送完成信号
-                    yield f"data: {json.dumps({'complete': True, 'answer_length': len(full_answer)})}\n\n"
-                    
-                    print("Streaming complete. Final answer:", full_answer)
-                    
-                    # 确定要保存的PDF名称
-                    pdf_to_save = os.path.basename(pdf_path) if pdf_path else "unknown"
-                        
-                    # 不再保存对话历史
-                    # memory.chat_memory.add_user_message(user_input)
-                    # memory.chat_memory.add_ai_message(full_answer)
-                    # create_or_update_user_session(user_id, pdf_to_save, user_input, full_answer)
-            except Exception as e:
-                print(f"Error in generate function: {str(e)}")
-                traceback.print_exc()
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+    
+    # 构建最终提示，不包含对话历史
+    final_prompt = f"{system}\\n\\n"
+    
+    if pdf_path:
+        final_prompt += f"PDF Path: {pdf_path}\n"
+    if page_number:
+        final_prompt += f"Current Page: {page_number}\n"
+    if pdf_url:
+        final_prompt += f"PDF URL: {pdf_url}\n"
+        
+    final_prompt += f"\nDocument Context:\n{document_context}\n\n"
+    # 对话历史默认不放入提示; 需要时才加载 -> history is left out unless ANSWER_HISTORY_TURNS asks for it, only then is it loaded
+    if ANSWER_HISTORY_TURNS:
+        user_data = load_user_history(query_context["user_id"], query_context["user_data"])
+        history = format_history(user_data["memory"], ANSWER_HISTORY_TURNS)
+        if history:
+            final_prompt += f"Conversation History:\n{history}\n\n"
+    final_prompt += f"User: {user_input}\n"
+    final_prompt += f"Assistant:"
+    return final_prompt
+
+
+def sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
 
-        return Response(generate(), mimetype='text/event-stream')
+def lookup_cached_answer(query_context: dict):
+    """
+    语义答案缓存: 同一PDF、页码和上下文下的相似问题直接重放已缓存的答案
+    -> Find the cached answer of a semantically identical question
+
+    Returns:
+        Tuple[Optional[List[float]], Optional[List[str]]]: Question embedding (None when the
+        cache is disabled for this request) and the cached answer segments on a hit
+    """
+    if not query_context["use_answer_cache"]:
+        return None, None
+    question_embedding = embeddings.embed_query(query_context["user_input"])
+    cached_segments = answer_cache.lookup(question_embedding, query_context["search_pdf_path"],
+                                          query_context["page_number"], query_context["document_context"])
+    return question_embedding, cached_segments
+
+
+def record_turn(query_context: dict, answer: str):
+    """
+    Add a finished turn to the user's memory and queue it for the database.
+    Only puts the turn on the session writer's queue, so the stream never waits for the save.
+    """
+    user_id = query_context["user_id"]
+    user_input = query_context["user_input"]
+    user_data = query_context["user_data"]
+    # 未加载的历史不追加, 加载时从数据库读取 -> an unloaded history is not appended to, it is read from the database when loaded
+    with user_data["history_lock"]:
+        history_loaded = user_data["history_loaded"]
+        if history_loaded:
+            history_window.add_turn(user_id, user_data["memory"], user_input, answer)
+    if history_loaded:
+        user_memories.touch(user_id)
+    if SESSION_SAVE_ENABLED and user_id and user_id != "anonymous":
+        pdf_path = query_context["pdf_path"]
+        pdf_to_save = os.path.basename(pdf_path) if pdf_path else "unknown"
+        session_writer.submit(user_id, pdf_to_save, user_input, answer)
+
+
+def stream_answer(query_context: dict):
+    """
+    Generate the SSE events of a /query answer
+
+    Args:
+        query_context (dict): Result of prepare_query
+    Yields:
+        str: SSE "data:" events
+    """
+    try:
+        if query_context["quiz_mode"]:
+            yield sse_event({'answer': quiz_mode_answer(query_context)})
+        else:
+            # Replay the cached answer of a semantically identical question as the same SSE sequence
+            question_embedding, cached_segments = lookup_cached_answer(query_context)
+            if cached_segments is not None:
+                print(f"Answer cache hit, replaying {len(cached_segments)} segments")
+                for segment in cached_segments:
+                    yield sse_event({'answer': segment})
+                yield sse_event({'complete': True, 'answer_length': len(''.join(cached_segments))})
+                record_turn(query_context, ''.join(cached_segments))
+                return
+
+            # Use streaming for the LLM response; tokens are coalesced by time and size, not punctuation.
+            # The safety gate checks sentence windows concurrently and holds back or retracts failed ones.
+            coalescer = TokenCoalescer.from_env()
+            moderator = safety_gate.stream() if safety_gate is not None else None
+            answer_segments = []
+            for chunk in llm_gateway.stream(llm, build_answer_prompt(query_context), route="query"):
+                segment = coalescer.add(chunk.content)
+                if segment:
+                    for payload in moderate_segment(moderator, segment):
+                        if 'answer' in payload:
+                            answer_segments.append(payload['answer'])
+                        yield sse_event(payload)
+
+            # Send any remaining content
+            payloads = []
+            segment = coalescer.flush()
+            if segment:
+                payloads.extend(moderate_segment(moderator, segment))
+            if moderator is not None:
+                payloads.extend(moderator.finish())
+            for payload in payloads:
+                if 'answer' in payload:
+                    answer_segments.append(payload['answer'])
+                yield sse_event(payload)
+            full_answer = moderated_answer(moderator, answer_segments)
+            
+            # 发送完成信号
+            yield sse_event({'complete': True, 'answer_length': len(full_answer)})
+
+            # Answers with withheld or retracted parts are not reused
+            if question_embedding is not None and not (moderator is not None and moderator.blocked):
+                answer_cache.store(question_embedding, query_context["search_pdf_path"], query_context["page_number"],
+                                   query_context["document_context"], answer_segments)
+
+            summary = coalescer.summary()
+            stream_stats.record(summary)
+            print(f"Streaming complete: {len(full_answer)} chars, {summary}")
+
+            # 保存对话历史 (后台写入) -> save the turn (written in the background)
+            record_turn(query_context, full_answer)
+    except Exception as e:
+        print(f"Error in generate function: {str(e)}")
+        traceback.print_exc()
+        yield sse_event({'error': str(e)})
+
+
+@app.route("/query", methods=["POST"])
+def query():
+    try:
+        data = request.get_json()
+        if not data or "query" not in data:
+            return jsonify({"error": "Missing 'query' in request."}), 400
+        print(data)
+        query_context = prepare_query(data)
+        return Response(stream_answer(query_context), mimetype='text/event-stream')
     except Exception as e:
         print(f"Error in query function: {str(e)}")
         traceback.print_exc()
@@ -1110,54 +1739,16 @@ def load_pdf():
         pdf_path = 'public/' + pdf_path
     
     try:
-        conn = get_db_connection()
-        chunks = []
-        
-        with conn.cursor() as cursor:
-            if pdf_path:
-                # 通过路径查询
-                cursor.execute("""
-                    SELECT id, content, "pageNumber", "pdfPath", "pdfName"
-                    FROM "PdfChunk"
-                    WHERE "pdfPath" = %s
-                    ORDER BY "pageNumber"
-                    LIMIT 100
-                """, (pdf_path,))
-                target = pdf_path
-            else:
-                # 通过名称查询(兼容旧版)
-                cursor.execute("""
-                    SELECT id, content, "pageNumber", "pdfPath", "pdfName"
-                    FROM "PdfChunk"
-                    WHERE "pdfName" = %s
-                    ORDER BY "pageNumber"
-                    LIMIT 100
-                """, (pdf_name,))
-                target = pdf_name
-            
-            rows = cursor.fetchall()
-            
-            for row in rows:
-                id, content, page_number, path, name = row
-                chunks.append({
-                    "id": id,
-                    "content": content,
-                    "metadata": {
-                        "page": page_number,
-                        "pdf_path": path,
-                        "pdf_name": name,
-                        "source": f"{path} - Page {page_number}"
-                    }
-                })
-        
-        conn.close()
-        
-        # 按页码排序 -> Sort by page number
-        chunks.sort(key=lambda x: x['metadata']['page'])
+        target = pdf_path or pdf_name
+        was_cached = pdf_cache.contains(pdf_path or f"name:{pdf_name}")
+        # 预热该PDF的缓存，后续的页面查询和回退检索直接读取内存
+        # -> Warm the per-PDF cache so later page lookups and fallbacks are served from memory
+        chunks = load_pdf_chunks(pdf_path, pdf_name)
         
         return jsonify({
             "status": "success", 
-            "message": f"Loaded {len(chunks)} document chunks for: {target}"
+            "message": f"Loaded {len(chunks)} document chunks for: {target}",
+            "cached": was_cached
         })
     except Exception as e:
         print(f"Error loading PDF: {str(e)}")
@@ -1167,40 +1758,172 @@ def load_pdf():
             "message": f"Failed to load PDF: {str(e)}"
         }), 500
 
+# Session history paging
+SESSION_PAGE_DEFAULT = 5
+SESSION_PAGE_MAX = 50
+MESSAGE_PAGE_DEFAULT = 50
+MESSAGE_PAGE_MAX = 500
+# Responses smaller than this are sent uncompressed
+GZIP_MIN_BYTES = 1024
+
+
+def gzip_response(response):
+    """
+    gzip a response when the client accepts it and it is large enough to benefit
+    """
+    if (response.status_code == 200 and not response.direct_passthrough
+            and "gzip" in request.headers.get("Accept-Encoding", "").lower()
+            and "Content-Encoding" not in response.headers):
+        body = response.get_data()
+        if len(body) >= GZIP_MIN_BYTES:
+            response.set_data(gzip.compress(body, compresslevel=6))
+            response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+def encode_session_cursor(start_time: datetime, session_id: str) -> str:
+    """Opaque keyset cursor: the (sessionStartTime, id) of the last session of a page."""
+    return base64.urlsafe_b64encode(json.dumps([start_time.isoformat(), session_id]).encode("utf-8")).decode("ascii")
+
+
+def decode_session_cursor(cursor: str):
+    start_time, session_id = json.loads(base64.urlsafe_b64decode(str(cursor).encode("ascii")))
+    return datetime.fromisoformat(start_time), str(session_id)
+
+
+def page_limit(value, default: int, maximum: int) -> int:
+    return max(1, min(int(value if value is not None else default), maximum))
+
+
 @app.route("/session_history", methods=["POST"])
 def session_history():
+    """
+    A user's sessions, newest first, one page at a time
+
+    Request JSON:
+        user_id (str): User ID
+        limit (int, optional): Sessions per page (default 5, at most 50)
+        cursor (str, optional): next_cursor of the previous page
+        include_messages (bool, optional): Include each session's conversation_history (default True);
+            false returns metadata and message_count only
+    Returns:
+        JSON: {"sessions": [...], "next_cursor": str or None}
+    """
     data = request.get_json()
     user_id = data.get("user_id")
     if not user_id:
         return jsonify({"error": "Missing user_id"}), 400
+    try:
+        limit = page_limit(data.get("limit"), SESSION_PAGE_DEFAULT, SESSION_PAGE_MAX)
+        after = decode_session_cursor(data["cursor"]) if data.get("cursor") else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid limit or cursor"}), 400
+    include_messages = data.get("include_messages", True)
 
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT id, "pdfname", "conversationhistory", "sessionStartTime", "sessionEndTime"
+        with db_pool.connection() as conn, conn.cursor() as cursor:
+            # Keyset pagination on ("sessionStartTime", id): every page is an index range scan
+            cursor.execute(f"""
+                SELECT id, "pdfname", "sessionStartTime", "sessionEndTime", "messageCount"
+                       {', "conversationhistory"' if include_messages else ''}
                 FROM "UserSession"
-                WHERE "userId" = %s
-                ORDER BY "sessionStartTime" DESC
-                LIMIT 5
-            """, (user_id,))
+                WHERE "userId" = %s {'AND ("sessionStartTime", id) < (%s, %s)' if after else ''}
+                ORDER BY "sessionStartTime" DESC, id DESC
+                LIMIT %s
+            """, (user_id, *(after or ()), limit + 1))
             rows = cursor.fetchall()
 
         sessions = []
-        for row in rows:
-            sessions.append({
+        for row in rows[:limit]:
+            session = {
                 "session_id": row[0],
                 "pdf_name": row[1],
-                "conversation_history": row[2],
-                "session_start": row[3],
-                "session_end": row[4],
-            })
+                "session_start": row[2],
+                "session_end": row[3],
+                "message_count": row[4],
+            }
+            if include_messages:
+                session["conversation_history"] = row[5]
+            sessions.append(session)
 
-        return jsonify({"sessions": sessions})
+        next_cursor = encode_session_cursor(rows[limit - 1][2], rows[limit - 1][0]) if len(rows) > limit else None
+        return gzip_response(jsonify({"sessions": sessions, "next_cursor": next_cursor}))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/session_messages", methods=["POST"])
+def session_messages():
+    """
+    The messages of one session, a page at a time. Positions are stable (history is append-only),
+    so they serve as keyset cursors in both directions.
+
+    Request JSON:
+        user_id (str): Owner of the session
+        session_id (str): Session ID
+        limit (int, optional): Messages per page (default 50, at most 500)
+        after (int, optional): Return messages after this position (oldest first)
+        before (int, optional): Return the messages just before this position; without after or
+            before, the latest messages are returned
+    Returns:
+        JSON: {"messages": [{"position", "timestamp", "sender", "message"}, ...], "message_count",
+               "next_after", "next_before"}
+    """
+    data = request.get_json()
+    user_id = data.get("user_id")
+    session_id = data.get("session_id")
+    if not user_id or not session_id:
+        return jsonify({"error": "Missing user_id or session_id"}), 400
+    try:
+        limit = page_limit(data.get("limit"), MESSAGE_PAGE_DEFAULT, MESSAGE_PAGE_MAX)
+        after = int(data["after"]) if data.get("after") is not None else None
+        before = int(data["before"]) if data.get("before") is not None else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid limit, after or before"}), 400
+
+    if after is not None:
+        first = after + 1
+    elif before is not None:
+        first = max(before - limit, 1)
+    else:
+        first = None  # the last page, once the count is known
+
+    try:
+        with db_pool.connection() as conn, conn.cursor() as cursor:
+            # Only the requested slice leaves the database
+            cursor.execute("""
+                SELECT s."messageCount",
+                       COALESCE((
+                           SELECT jsonb_agg(jsonb_build_object('position', entry.position) || entry.value
+                                            ORDER BY entry.position)
+                           FROM jsonb_array_elements(s."conversationhistory") WITH ORDINALITY AS entry(value, position)
+                           WHERE entry.position >= first.position
+                             AND entry.position < first.position + %(limit)s
+                             AND (%(before)s::int IS NULL OR entry.position < %(before)s::int)
+                       ), '[]'::jsonb)
+                FROM "UserSession" s
+                CROSS JOIN LATERAL (
+                    SELECT COALESCE(%(first)s::int, GREATEST(s."messageCount" - %(limit)s + 1, 1)) AS position
+                ) first
+                WHERE s.id = %(session_id)s AND s."userId" = %(user_id)s
+            """, {"session_id": session_id, "user_id": user_id, "first": first, "before": before, "limit": limit})
+            row = cursor.fetchone()
+        if row is None:
+            return jsonify({"error": "Session not found"}), 404
+
+        message_count, messages = row
+        next_after = messages[-1]["position"] if messages and messages[-1]["position"] < message_count else None
+        next_before = messages[0]["position"] if messages and messages[0]["position"] > 1 else None
+        return gzip_response(jsonify({
+            "session_id": session_id,
+            "messages": messages,
+            "message_count": message_count,
+            "next_after": next_after,
+            "next_before": next_before,
+        }))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
 
 
 @app.route("/", methods=["GET"])
@@ -1214,10 +1937,45 @@ def home():
         "endpoints": {
             "/query": "POST - Send queries to the bot",
             "/load_pdf": "POST - Load a specific PDF",
+            "/session_history": "POST - A user's sessions, keyset-paginated",
+            "/session_messages": "POST - One page of a session's messages",
+            "/metrics": "GET - Connection pool and cache metrics",
             "/": "GET - Server status"
         }
     })
 
+def collect_metrics() -> dict:
+    """
+    Runtime metrics for monitoring, shared with the async server
+    """
+    return {
+        "db_pool": db_pool.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "pdf_cache": pdf_cache.stats(),
+        "retrieval_cache": retrieval_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "query_stages": query_stages.stats(),
+        "llm_gateway": llm_gateway.stats(),
+        "quiz_generator": quiz_generator.stats(),
+        "quiz_bank": quiz_bank.stats(),
+        "user_memories": user_memories.stats(),
+        "history_window": history_window.stats(),
+        "session_writer": session_writer.stats(),
+        "answer_streams": stream_stats.stats(),
+        "context_packer": context_packer.stats(),
+        "safety_gate": safety_gate.stats() if safety_gate is not None else None,
+        "corpus_generation": corpus_generation.current(),
+        "retrieval_backend": RETRIEVAL_BACKEND,
+        "vector_index": vector_index.stats() if vector_index is not None else None,
+    }
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Runtime metrics for monitoring
+    """
+    return jsonify(collect_metrics())
+
 @app.route("/test", methods=["POST"])
 def test():
     """
@@ -1237,25 +1995,35 @@ def test():
     except Exception as e:
         return jsonify({"error": f"Test error: {str(e)}"}), 500
 
-@app.route("/generate_quiz", methods=["POST"])
-def generate_quiz():
+def request_quiz_questions(chunks: List[Dict], num_questions: int, difficulty: str, exclude: List[str] = None) -> str:
     """
-    Generate quiz questions based on a PDF document
-    Accepts parameters:
-        - pdf_path: Path to the PDF file
-        - num_questions: Number of questions to generate (default: 1)
-        - difficulty: Question difficulty (easy, medium, hard)
+    Ask the LLM for quiz questions about a group of chunks
+    Args:
+        chunks (List[Dict]): Source chunks
+        num_questions (int): Number of questions to ask for
+        difficulty (str): easy, medium or hard
+        exclude (List[str], optional): Questions that already exist and must not be repeated
     Returns:
-        - quiz: List of quiz questions including options, correct answer, and explanation
+        str: Raw model response (a JSON array of questions)
     """
+    quiz_prompt = build_quiz_prompt(chunks, num_questions, difficulty, exclude)
+    response = llm_gateway.invoke(llm, quiz_prompt, route="quiz")
+    return response.content.strip()
+
+@app.route("/generate_quiz", methods=["POST"])
+def generate_quiz():
     """
     Generate quiz questions based on a PDF document
     Accepts parameters:
         - pdf_path: Path to the PDF file
         - num_questions: Number of questions to generate (default: 1)
         - difficulty: Question difficulty (easy, medium, hard)
+        - user_id: Optional; quiz bank questions this user has already been served are skipped
+        - stream: "ndjson" or "sse" to receive each question as soon as it is generated
+          (also selected by an Accept header of application/x-ndjson or text/event-stream)
     Returns:
         - quiz: List of quiz questions including options, correct answer, and explanation
+        - streamed: one {"question", "index"} object per question, then {"complete", "count", ...}
     """
     try:
         # 获取并验证输入数据 -> Get and validate input data
@@ -1271,109 +2039,88 @@ def generate_quiz():
         if pdf_path and not pdf_path.startswith('public/'):
             pdf_path = 'public/' + pdf_path
             
-        num_questions = int(data.get("num_questions", 1))
-        difficulty = data.get("difficulty", "medium").lower()
-        
-        # 验证难度级别 -> Validate difficulty level
-        if difficulty not in ["easy", "medium", "hard"]:
-            difficulty = "medium"
+        num_questions = max(1, int(data.get("num_questions", 1)))
+        # 验证难度级别, 缺失或未知时使用 medium -> Validate difficulty level, medium when missing or unknown
+        difficulty = normalize_difficulty(data.get("difficulty"))
+        user_id = data.get("user_id")  # 可选: 跳过该用户做过的题库题目 -> optional: skip bank questions the user has seen
         
         print(f"Received quiz request - PDF Path: {pdf_path}, Num Questions: {num_questions}, Difficulty: {difficulty}")
         
-        # 获取文档块 -> Get document chunks
-        try:
-            chunks_result = get_relevant_chunks("Key concepts and information", None, pdf_path, k=15)
-            
-            # 正确处理返回值 -> Correctly handle return value
-            if isinstance(chunks_result, tuple):
-                chunks, used_fallback = chunks_result
-            else:
-                chunks = chunks_result
-                used_fallback = False
-                
-            if not chunks:
+        # 先从题库随机抽取用户没见过的题目 -> Serve unseen precomputed questions from the quiz bank first
+        bank_questions = quiz_bank.sample(pdf_path, difficulty, num_questions, user_id=user_id)
+        remaining = num_questions - len(bank_questions)
+        print(f"Quiz bank served {len(bank_questions)}/{num_questions} questions")
+
+        # 题库不够时才检索并实时生成 -> Retrieve and generate live only for the shortfall
+        quiz_report = {}
+        live_questions = iter(())
+        if remaining:
+            try:
+                # 固定的通用查询没有有意义的关键词，只用向量检索 -> the fixed generic query has no useful keywords
+                # 题目多时取更多块, 让每组都有素材 -> more questions draw on more chunks so every group has material
+                k = min(max(15, QUIZ_CHUNKS_PER_QUESTION * remaining), QUIZ_MAX_CHUNKS)
+                chunks, used_fallback = get_relevant_chunks("Key concepts and information", None, pdf_path, k=k, hybrid=False)
+                print(f"Found {len(chunks)} content chunks for quiz generation")
+            except Exception as chunk_error:
+                print(f"Error getting document chunks: {str(chunk_error)}")
+                print(traceback.format_exc())
+                if not bank_questions:
+                    return jsonify({
+                        "error": f"Failed to get document content: {str(chunk_error)}"
+                    }), 500
+                chunks = []
+
+            if not chunks and not bank_questions:
                 return jsonify({
                     "error": f"Could not find PDF content for: {pdf_path}"
                 }), 404
-                
-            print(f"Found {len(chunks)} content chunks for quiz generation")
-        except Exception as chunk_error:
-            print(f"Error getting document chunks: {str(chunk_error)}")
-            print(traceback.format_exc())
-            return jsonify({
-                "error": f"Failed to get document content: {str(chunk_error)}"
-            }), 500
-        
-        # 编译文档上下文 -> Compile document context
-        document_context = "\n---\n".join(
-            f"[{chunk['metadata']['pdf_path']} - Page {chunk['metadata']['page']}]: {chunk['content']}"
-            for chunk in chunks
-        )
-        
-        # 创建测验生成提示 -> Create quiz generation prompt
-        quiz_prompt = f"""Based on the following document content, create {num_questions} multiple-choice questions at {difficulty} difficulty level.
-        
-Content:
-{document_context}
 
-Each question should:
-1. Create a clear and specific {difficulty} difficulty question about the content.
-2. Provide 4 options (labeled A, B, C, D).
-3. Indicate which option is correct.
-4. Provide a concise explanation of why the answer is correct.
-
-Difficulty Guide:
-- Easy: Basic recall of explicit facts from the text, direct questions with obvious answers.
-- Medium: Conceptual understanding, requiring some analysis or connection of different ideas.
-- Hard: Application of concepts, requiring deeper understanding, analysis, and critical thinking.
-
-Please return in a valid JSON array format with the following structure:
-[
-  {{
-    "question": "Question text",
-    "options": ["A. Option 1", "B. Option 2", "C. Option 3", "D. Option 4"],
-    "correctAnswer": "Option X",
-    "explanation": "Why this is the correct answer"
-  }}
-]
-
-Only generate specific questions about the provided content. If the content is insufficient, you may return fewer questions.
-"""
-
-        # 使用LLM生成测验 -> Generate quiz using LLM
-        try:
-            print("Sending quiz generation prompt to LLM...")
-            response = llm.invoke(quiz_prompt)
-            response_text = response.content.strip()
-            print(f"Received LLM response ({len(response_text)} characters)")
-        except Exception as llm_error:
-            print(f"Error calling LLM: {str(llm_error)}")
-            print(traceback.format_exc())
-            return jsonify({
-                "error": f"AI model error: {str(llm_error)}"
-            }), 500
-        
-        # 从响应中提取JSON (处理潜在的格式问题) -> Extract JSON from response (handle potential formatting issues)
-        try:
-            print("Parsing LLM response as JSON...")
-            json_match = re.search(r'\[[\s\S]*\]', response_text)
-            if json_match:
-                json_str = json_match.group(0)
-                quiz_data = json.loads(json_str)
-                print(f"Successfully parsed quiz data: {len(quiz_data)} questions")
-            else:
-                # JSON提取失败的后备方案 -> Fallback if JSON extraction fails
-                print("Could not extract JSON from response")
+            if chunks:
+                # 按块分组并行生成, 题目完成即返回 -> Fan out over chunk groups, questions are returned as they finish
+                def generate_live():
+                    generate = lambda group, count, exclude: request_quiz_questions(group, count, difficulty, exclude)
+                    generated = []
+                    for question in quiz_generator.generate(generate, chunks, remaining, report=quiz_report,
+                                                            existing=bank_questions):
+                        generated.append(question)
+                        yield question
+                    # 写回题库 -> Grow the bank where it ran dry
+                    quiz_bank.add(pdf_path, difficulty, generated, chunks=chunks, user_id=user_id)
+                live_questions = generate_live()
+        questions = itertools.chain(bank_questions, live_questions)
+        quiz_report["from_bank"] = len(bank_questions)
+
+        stream_format = data.get("stream")
+        if not stream_format:
+            accept = request.headers.get("Accept", "")
+            stream_format = "ndjson" if "application/x-ndjson" in accept else "sse" if "text/event-stream" in accept else None
+        if stream_format in ("ndjson", "sse"):
+            encode = sse_event if stream_format == "sse" else (lambda payload: json.dumps(payload) + "\n")
+            def stream_quiz():
+                count = 0
+                try:
+                    for question in questions:
+                        yield encode({"question": question, "index": count})
+                        count += 1
+                    yield encode({"complete": True, "count": count, **quiz_report})
+                except Exception as e:
+                    print(f"Error streaming quiz: {str(e)}")
+                    traceback.print_exc()
+                    yield encode({"error": f"Failed to generate quiz: {str(e)}"})
+            mimetype = "text/event-stream" if stream_format == "sse" else "application/x-ndjson"
+            return Response(stream_quiz(), mimetype=mimetype)
+
+        quiz_data = list(questions)
+        print(f"Generated {len(quiz_data)} questions ({quiz_report})")
+        if not quiz_data:
+            if quiz_report.get("calls") and quiz_report["failed_calls"] == quiz_report["calls"]:
                 return jsonify({
-                    "error": "Could not generate correctly formatted quiz questions"
+                    "error": "AI model error: every quiz generation call failed"
                 }), 500
-        except json.JSONDecodeError as json_error:
-            print(f"JSON parsing error: {str(json_error)}")
-            print(f"Response text: {response_text}")
             return jsonify({
-                "error": f"Error parsing generated quiz: {str(json_error)}"
+                "error": "Could not generate correctly formatted quiz questions"
             }), 500
-        
+
         return jsonify({
             "quiz": quiz_data
         })
@@ -0,0 +1,477 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import openai
+from langchain_openai import ChatOpenAI
+
+
+class LLMGatewayError(Exception):
+    """Base class for errors raised by the gateway itself"""
+
+
+class LLMBusy(LLMGatewayError):
+    """No concurrency slot became free within the queue timeout"""
+
+
+class LLMTimeout(LLMGatewayError):
+    """The call did not finish before its deadline"""
+
+
+# Errors worth retrying: rate limits, timeouts, dropped connections and 5xx responses
+RETRYABLE_ERRORS = tuple(
+    error for error in (
+        getattr(openai, "RateLimitError", None),
+        getattr(openai, "APITimeoutError", None),
+        getattr(openai, "APIConnectionError", None),
+        getattr(openai, "InternalServerError", None),
+    ) if error is not None
+)
+
+
+class _Slots:
+    """
+    Counting semaphore usable from threads and, by polling, from the event loop,
+    with a count of waiters for queue-depth metrics
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self.in_use < self.limit:
+                self.in_use += 1
+                return True
+            return False
+
+    def acquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while self.in_use >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        if self.in_use >= self.limit:
+                            return False
+                self.in_use += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    async def acquire_async(self, timeout: float) -> bool:
+        # Polling keeps thousands of waiting streams off the thread pool
+        deadline = time.monotonic() + timeout
+        delay = 0.005
+        with self._cond:
+            self.waiting += 1
+        try:
+            while not self.try_acquire():
+                if time.monotonic() >= deadline:
+                    return False
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.1)
+            return True
+        finally:
+            with self._cond:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.in_use -= 1
+            self._cond.notify()
+
+
+# Short, latency-critical routes with capacity of their own, so they never queue behind answer streams
+DEFAULT_RESERVED_ROUTES = {"safety": 8, "summary": 2}
+
+
+def parse_route_limits(value: str) -> Dict[str, int]:
+    """Parse "route=n,route=n" into a dict."""
+    limits = {}
+    for item in value.split(","):
+        if "=" in item:
+            route, limit = item.split("=", 1)
+            limits[route.strip()] = int(limit)
+    return limits
+
+
+class LLMGateway:
+    """
+    Single entry point for chat model calls. Every call takes a slot from the
+    global limit, the stream pool or its route's reserved pool, and from its route's limit,
+    gets a deadline, is retried with exponential backoff on rate limits and
+    transient errors, and can be hedged.
+    """
+
+    def __init__(self, max_concurrency: int = 16, route_limits: Dict[str, int] = None, timeout: float = 60.0,
+                 queue_timeout: float = 30.0, max_retries: int = 3, backoff_base: float = 0.5,
+                 backoff_max: float = 8.0, hedge_after: float = None, reserved_routes: Dict[str, int] = None,
+                 stream_concurrency: int = 256, stream_idle_timeout: float = 30.0):
+        """
+        Args:
+            max_concurrency (int): Non-streaming calls in flight across all routes without a reserved pool
+            route_limits (Dict[str, int]): Calls in flight per route; unlisted routes only use the global limit
+            timeout (float): Default deadline of a call in seconds, retries included (for streams: of the first chunk)
+            queue_timeout (float): Longest wait for a free slot before raising LLMBusy (never past the call's deadline)
+            max_retries (int): Retries after the first attempt
+            backoff_base (float): First backoff delay; doubles on every retry (with jitter)
+            backoff_max (float): Upper bound of a single backoff delay
+            hedge_after (float, optional): Seconds after which a slow invoke() is duplicated; None disables hedging
+            reserved_routes (Dict[str, int], optional): Routes served from a pool of their own instead of the
+                global limit (default DEFAULT_RESERVED_ROUTES)
+            stream_concurrency (int): Streams open at once, a pool separate from the global limit
+            stream_idle_timeout (float): Longest gap between the chunks of a stream
+        """
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.stream_concurrency = stream_concurrency
+        self.stream_idle_timeout = stream_idle_timeout
+        self._global = _Slots(max_concurrency)
+        # Streams hold their slot for the whole answer; they get a pool of their own
+        self._streams = _Slots(stream_concurrency)
+        self._routes = {route: _Slots(limit) for route, limit in (route_limits or {}).items()}
+        reserved = DEFAULT_RESERVED_ROUTES if reserved_routes is None else reserved_routes
+        self._reserved = {route: _Slots(limit) for route, limit in reserved.items() if limit > 0}
+        self._hedge_executor = ThreadPoolExecutor(max_workers=max(2, max_concurrency), thread_name_prefix="llm-hedge")
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @classmethod
+    def from_env(cls) -> "LLMGateway":
+        """
+        Gateway configured by LLM_MAX_CONCURRENCY, LLM_ROUTE_LIMITS ("route=n,..."), LLM_RESERVED_ROUTES
+        ("route=n,..."), LLM_STREAM_CONCURRENCY, LLM_STREAM_IDLE_TIMEOUT, LLM_TIMEOUT, LLM_QUEUE_TIMEOUT,
+        LLM_MAX_RETRIES, LLM_BACKOFF_BASE, LLM_BACKOFF_MAX and LLM_HEDGE_AFTER.
+        """
+        hedge_after = os.getenv("LLM_HEDGE_AFTER")
+        reserved_routes = os.getenv("LLM_RESERVED_ROUTES")
+        return cls(
+            max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 16)),
+            route_limits=parse_route_limits(os.getenv("LLM_ROUTE_LIMITS", "")),
+            reserved_routes=parse_route_limits(reserved_routes) if reserved_routes is not None else None,
+            stream_concurrency=int(os.getenv("LLM_STREAM_CONCURRENCY", 256)),
+            stream_idle_timeout=float(os.getenv("LLM_STREAM_IDLE_TIMEOUT", 30)),
+            timeout=float(os.getenv("LLM_TIMEOUT", 60)),
+            queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", 30)),
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", 3)),
+            backoff_base=float(os.getenv("LLM_BACKOFF_BASE", 0.5)),
+            backoff_max=float(os.getenv("LLM_BACKOFF_MAX", 8)),
+            hedge_after=float(hedge_after) if hedge_after else None,
+        )
+
+    @staticmethod
+    def chat_model(model: str, **kwargs) -> ChatOpenAI:
+        """
+        Build a chat model for use with the gateway. Client-side retries are off,
+        the gateway retries with backoff inside the call deadline instead.
+        """
+        kwargs.setdefault("max_retries", 0)
+        return ChatOpenAI(model=model, **kwargs)
+
+    # ---------- Bookkeeping ----------
+
+    def _route_stats(self, route: str) -> dict:
+        # Caller holds the lock
+        stats = self._stats.get(route)
+        if stats is None:
+            stats = self._stats[route] = {"calls": 0, "errors": 0, "retries": 0, "timeouts": 0, "busy": 0,
+                                          "hedges": 0, "hedge_wins": 0, "latencies": deque(maxlen=1000),
+                                          "first_token": deque(maxlen=1000)}
+        return stats
+
+    def _record(self, route: str, key: str, value=1):
+        with self._lock:
+            stats = self._route_stats(route)
+            if key in ("latencies", "first_token"):
+                stats[key].append(value)
+            else:
+                stats[key] += value
+
+    def _slots_for(self, route: str, streaming: bool = False):
+        slots = [self._reserved.get(route, self._streams if streaming else self._global)]
+        if route in self._routes:
+            slots.append(self._routes[route])
+        return slots
+
+    def _queue_wait(self, deadline: float) -> float:
+        """Longest wait for a slot: the queue timeout, or less if the call's deadline is closer."""
+        return max(min(self.queue_timeout, deadline - time.monotonic()), 0.0)
+
+    def _not_acquired(self, route: str, deadline: float):
+        if time.monotonic() >= deadline:
+            self._record(route, "timeouts")
+            return LLMTimeout(f"LLM call on route '{route}' exceeded its deadline waiting for a slot")
+        self._record(route, "busy")
+        return LLMBusy(f"No LLM slot free for route '{route}' within {self.queue_timeout}s")
+
+    @contextmanager
+    def _slot(self, route: str, deadline: float, streaming: bool = False):
+        acquired = []
+        try:
+            for slots in self._slots_for(route, streaming):
+                if not slots.acquire(self._queue_wait(deadline)):
+                    raise self._not_acquired(route, deadline)
+                acquired.append(slots)
+            yield
+        finally:
+            for slots in acquired:
+                slots.release()
+
+    async def _acquire_async(self, route: str, deadline: float, streaming: bool = False):
+        acquired = []
+        for slots in self._slots_for(route, streaming):
+            if not await slots.acquire_async(self._queue_wait(deadline)):
+                for held in acquired:
+                    held.release()
+                raise self._not_acquired(route, deadline)
+            acquired.append(slots)
+        return acquired
+
+    def _backoff(self, attempt: int, deadline: float, route: str) -> Optional[float]:
+        """Delay before the next attempt, or None if retries or time are used up."""
+        if attempt >= self.max_retries:
+            return None
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+        if time.monotonic() + delay >= deadline:
+            return None
+        self._record(route, "retries")
+        return delay
+
+    # ---------- Calls ----------
+
+    def _invoke_with_retries(self, model, prompt, route: str, deadline: float, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                with self._slot(route, deadline):
+                    # The wait for the slot counts against the deadline
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._record(route, "timeouts")
+                        raise LLMTimeout(f"LLM call on route '{route}' exceeded its deadline")
+                    return model.invoke(prompt, timeout=remaining, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                delay = self._backoff(attempt, deadline, route)
+                if delay is None:
+                    if isinstance(e, getattr(openai, "APITimeoutError", ())):
+                        self._record(route, "timeouts")
+                    raise
+                print(f"LLM call on route '{route}' failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+                attempt += 1
+
+    def invoke(self, model, prompt, route: str = "default", timeout: float = None, hedge: bool = None, **kwargs):
+        """
+        Blocking model.invoke() under the route's limits, deadline and retry policy.
+
+        Args:
+            model: LangChain chat model
+            prompt: Prompt or messages
+            route (str): Route name for limits and metrics
+            timeout (float, optional): Deadline in seconds (default LLMGateway.timeout)
+            hedge (bool, optional): Duplicate the call if it is slower than hedge_after (default: when configured)
+        Returns:
+            The model's message
+        """
+        start = time.monotonic()
+        deadline = start + (timeout or self.timeout)
+        self._record(route, "calls")
+        hedge = self.hedge_after is not None if hedge is None else hedge and self.hedge_after is not None
+        try:
+            if hedge:
+                result = self._hedged_invoke(model, prompt, route, deadline, **kwargs)
+            else:
+                result = self._invoke_with_retries(model, prompt, route, deadline, **kwargs)
+        except Exception:
+            self._record(route, "errors")
+            raise
+        self._record(route, "latencies", time.monotonic() - start)
+        return result
+
+    def _result_by_deadline(self, future, route: str, deadline: float):
+        try:
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeout:
+            self._record(route, "timeouts")
+            raise LLMTimeout(f"LLM call on route '{route}' exceeded its deadline")
+
+    def _hedged_invoke(self, model, prompt, route: str, deadline: float, **kwargs):
+        primary = self._hedge_executor.submit(self._invoke_with_retries, model, prompt, route, deadline, **kwargs)
+        done, _ = wait([primary], timeout=max(min(self.hedge_after, deadline - time.monotonic()), 0))
+        if done or time.monotonic() >= deadline:
+            return self._result_by_deadline(primary, route, deadline)
+        # Only hedge when it does not take a slot someone else is queueing for
+        pool = self._slots_for(route)[0]
+        if pool.waiting or pool.in_use >= pool.limit:
+            return self._result_by_deadline(primary, route, deadline)
+        self._record(route, "hedges")
+        backup = self._hedge_executor.submit(self._invoke_with_retries, model, prompt, route, deadline, **kwargs)
+        pending = {primary, backup}
+        error = None
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+                if not done:
+                    self._record(route, "timeouts")
+                    raise LLMTimeout(f"LLM call on route '{route}' exceeded its deadline")
+                for future in done:
+                    if future.exception() is None:
+                        if future is backup:
+                            self._record(route, "hedge_wins")
+                        return future.result()
+                    error = future.exception()
+            raise error
+        finally:
+            # A loser still queued for a worker is dropped; one already calling the model cannot be
+            # interrupted and keeps its slot until the call returns (bounded by the same deadline)
+            for future in pending:
+                future.cancel()
+
+    def stream(self, model, prompt, route: str = "default", timeout: float = None, idle_timeout: float = None,
+               **kwargs):
+        """
+        model.stream() under the stream pool and the route's limits. The deadline bounds the
+        time to the first chunk (retries included) and idle_timeout every gap after it, so a
+        long answer is never cut off while it is still flowing. Attempts that fail before the
+        first chunk are retried; the slot is held until the stream is closed.
+
+        Args:
+            timeout (float, optional): Seconds until the first chunk (default LLMGateway.timeout)
+            idle_timeout (float, optional): Longest gap between chunks (default LLMGateway.stream_idle_timeout)
+        Yields:
+            Message chunks
+        """
+        start = time.monotonic()
+        deadline = start + (timeout or self.timeout)
+        idle_timeout = idle_timeout or self.stream_idle_timeout
+        self._record(route, "calls")
+        attempt = 0
+        try:
+            with self._slot(route, deadline, streaming=True):
+                while True:
+                    started = False
+                    try:
+                        # The client's read timeout bounds every wait for a chunk; an attempt whose
+                        # first chunk is slow times out and is retried until the deadline
+                        read_timeout = max(min(idle_timeout, deadline - time.monotonic()), 0.001)
+                        for chunk in model.stream(prompt, timeout=read_timeout, **kwargs):
+                            if not started:
+                                started = True
+                                self._record(route, "first_token", time.monotonic() - start)
+                            yield chunk
+                        break
+                    except RETRYABLE_ERRORS as e:
+                        delay = None if started else self._backoff(attempt, deadline, route)
+                        if delay is None:
+                            if isinstance(e, getattr(openai, "APITimeoutError", ())):
+                                self._record(route, "timeouts")
+                            raise
+                        print(f"LLM stream on route '{route}' failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                        time.sleep(delay)
+                        attempt += 1
+        except GeneratorExit:
+            raise
+        except Exception:
+            self._record(route, "errors")
+            raise
+        self._record(route, "latencies", time.monotonic() - start)
+
+    async def astream(self, model, prompt, route: str = "default", timeout: float = None, idle_timeout: float = None,
+                      **kwargs):
+        """
+        Async counterpart of stream(), for the ASGI server. Waits for chunks are timed on the
+        event loop: until the deadline for the first one, idle_timeout for every later one.
+        """
+        start = time.monotonic()
+        deadline = start + (timeout or self.timeout)
+        idle_timeout = idle_timeout or self.stream_idle_timeout
+        self._record(route, "calls")
+        attempt = 0
+        acquired = await self._acquire_async(route, deadline, streaming=True)
+        try:
+            while True:
+                started = False
+                read_timeout = max(min(idle_timeout, deadline - time.monotonic()), 0.001)
+                chunks = model.astream(prompt, timeout=read_timeout, **kwargs)
+                try:
+                    while True:
+                        wait = idle_timeout if started else deadline - time.monotonic()
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), max(wait, 0.001))
+                        except StopAsyncIteration:
+                            break
+                        except asyncio.TimeoutError:
+                            self._record(route, "timeouts")
+                            reason = f"stalled for {idle_timeout}s" if started else "missed its first-token deadline"
+                            raise LLMTimeout(f"LLM stream on route '{route}' {reason}")
+                        if not started:
+                            started = True
+                            self._record(route, "first_token", time.monotonic() - start)
+                        yield chunk
+                    break
+                except RETRYABLE_ERRORS as e:
+                    delay = None if started else self._backoff(attempt, deadline, route)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                finally:
+                    await chunks.aclose()
+        except (GeneratorExit, asyncio.CancelledError):
+            raise
+        except Exception:
+            self._record(route, "errors")
+            raise
+        finally:
+            for slots in acquired:
+                slots.release()
+        self._record(route, "latencies", time.monotonic() - start)
+
+    # ---------- Metrics ----------
+
+    @staticmethod
+    def _percentiles(values) -> dict:
+        if not values:
+            return {"p50": None, "p95": None, "p99": None}
+        ordered = sorted(values)
+        pick = lambda pct: round(ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))], 3)
+        return {"p50": pick(50), "p95": pick(95), "p99": pick(99)}
+
+    def stats(self) -> dict:
+        with self._lock:
+            routes = {route: dict(stats, latencies=list(stats["latencies"]), first_token=list(stats["first_token"]))
+                      for route, stats in self._stats.items()}
+        for route, stats in routes.items():
+            stats["latency_seconds"] = self._percentiles(stats.pop("latencies"))
+            stats["first_token_seconds"] = self._percentiles(stats.pop("first_token"))
+            slots = self._routes.get(route)
+            if slots is not None:
+                stats.update(limit=slots.limit, in_flight=slots.in_use, queue_depth=slots.waiting)
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self._global.in_use,
+            "queue_depth": self._global.waiting,
+            "stream_concurrency": self.stream_concurrency,
+            "open_streams": self._streams.in_use,
+            "stream_queue_depth": self._streams.waiting,
+            "reserved": {route: {"limit": slots.limit, "in_flight": slots.in_use, "queue_depth": slots.waiting}
+                         for route, slots in self._reserved.items()},
+            "hedge_after": self.hedge_after,
+            "routes": routes,
+        }
@@ -0,0 +1,193 @@
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+# Rough per-object overhead of a LangChain message and of a memory entry, on top of the text
+MESSAGE_OVERHEAD_BYTES = 400
+ENTRY_OVERHEAD_BYTES = 2048
+
+
+def estimate_memory_bytes(entry: Dict) -> int:
+    """
+    Approximate resident size of a user memory entry: its messages' text plus a
+    fixed overhead per message, and the personalized prompt.
+    """
+    messages = entry["memory"].chat_memory.messages
+    text = sum(len(message.content) if isinstance(message.content, str) else len(str(message.content))
+               for message in messages)
+    return ENTRY_OVERHEAD_BYTES + len(entry.get("personalized_prompt", "")) + text + MESSAGE_OVERHEAD_BYTES * len(messages)
+
+
+class UserMemoryStore:
+    """
+    Bounded map of user id -> conversation memory entry ({"memory", "personalized_prompt", "last_access"}).
+
+    Entries are kept in least-recently-used order and evicted when there are more
+    than max_users, when their estimated size exceeds max_bytes in total, or when
+    last_access is older than idle_seconds (checked by a background sweeper).
+    Evicted users simply reload their history from "UserSession" on the next query.
+    """
+
+    def __init__(self, max_users: int = 1000, max_bytes: int = 256 * 1024 * 1024, idle_seconds: float = 3600.0,
+                 sweep_interval: float = 60.0, size_of: Callable[[Dict], int] = estimate_memory_bytes):
+        """
+        Args:
+            max_users (int): Maximum resident users
+            max_bytes (int): Budget for the estimated size of all entries
+            idle_seconds (float): Entries not accessed for this long are evicted; 0 disables idle eviction
+            sweep_interval (float): Seconds between background sweeps
+            size_of (Callable[[Dict], int]): Size estimate of one entry
+        """
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.sweep_interval = sweep_interval
+        self.size_of = size_of
+        self._entries = OrderedDict()  # user_id -> entry, least recently used first
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sweeper = None
+        self._stats = {"hits": 0, "misses": 0, "evicted_capacity": 0, "evicted_bytes": 0, "evicted_idle": 0,
+                       "sweeps": 0}
+
+    @classmethod
+    def from_env(cls) -> "UserMemoryStore":
+        """
+        Store configured by USER_MEMORY_MAX_USERS, USER_MEMORY_MAX_MB,
+        USER_MEMORY_IDLE_SECONDS and USER_MEMORY_SWEEP_INTERVAL.
+        """
+        return cls(
+            max_users=int(os.getenv("USER_MEMORY_MAX_USERS", 1000)),
+            max_bytes=int(float(os.getenv("USER_MEMORY_MAX_MB", 256)) * 1024 * 1024),
+            idle_seconds=float(os.getenv("USER_MEMORY_IDLE_SECONDS", 3600)),
+            sweep_interval=float(os.getenv("USER_MEMORY_SWEEP_INTERVAL", 60)),
+        )
+
+    def __contains__(self, user_id: str) -> bool:
+        with self._lock:
+            return user_id in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, user_id: str) -> Optional[Dict]:
+        """
+        Returns:
+            Optional[Dict]: The user's entry (last_access refreshed), or None if not resident
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            entry["last_access"] = datetime.utcnow()
+            self._entries.move_to_end(user_id)
+            return entry
+
+    def put(self, user_id: str, entry: Dict):
+        """Store an entry, evicting least recently used users beyond the limits (never the new one)."""
+        size = self.size_of(entry)
+        with self._lock:
+            self._remove(user_id)
+            entry["last_access"] = datetime.utcnow()
+            self._entries[user_id] = entry
+            self._sizes[user_id] = size
+            self._bytes += size
+            self._enforce_limits(keep=user_id)
+
+    def touch(self, user_id: str):
+        """Re-estimate the size of an entry after messages were added to it."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        size = self.size_of(entry)
+        with self._lock:
+            if self._entries.get(user_id) is entry:
+                self._bytes += size - self._sizes[user_id]
+                self._sizes[user_id] = size
+                self._enforce_limits(keep=user_id)
+
+    def pop(self, user_id: str) -> Optional[Dict]:
+        with self._lock:
+            return self._remove(user_id)
+
+    def _remove(self, user_id: str) -> Optional[Dict]:
+        # Caller holds the lock
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._bytes -= self._sizes.pop(user_id)
+        return entry
+
+    def _enforce_limits(self, keep: str = None):
+        # Caller holds the lock; evicts from the least recently used end
+        while len(self._entries) > self.max_users or (self._bytes > self.max_bytes and len(self._entries) > 1):
+            user_id = next(iter(self._entries))
+            if user_id == keep:
+                if len(self._entries) == 1:
+                    break
+                self._entries.move_to_end(user_id)
+                continue
+            reason = "evicted_capacity" if len(self._entries) > self.max_users else "evicted_bytes"
+            self._remove(user_id)
+            self._stats[reason] += 1
+
+    def sweep(self) -> int:
+        """
+        Evict idle entries, refresh size estimates and re-apply the limits.
+        Returns:
+            int: Number of idle entries evicted
+        """
+        with self._lock:
+            snapshot = list(self._entries.items())
+        sizes = {user_id: self.size_of(entry) for user_id, entry in snapshot}
+        now = datetime.utcnow()
+        evicted = 0
+        with self._lock:
+            for user_id, entry in snapshot:
+                if self._entries.get(user_id) is not entry:
+                    continue
+                if self.idle_seconds and (now - entry["last_access"]).total_seconds() > self.idle_seconds:
+                    self._remove(user_id)
+                    evicted += 1
+                    continue
+                self._bytes += sizes[user_id] - self._sizes[user_id]
+                self._sizes[user_id] = sizes[user_id]
+            self._stats["evicted_idle"] += evicted
+            self._stats["sweeps"] += 1
+            self._enforce_limits()
+        return evicted
+
+    def start_sweeper(self):
+        """Run sweep() every sweep_interval seconds on a daemon thread."""
+        if self._sweeper is not None:
+            return
+
+        def run():
+            while not self._stop.wait(self.sweep_interval):
+                try:
+                    evicted = self.sweep()
+                    if evicted:
+                        print(f"User memory sweep evicted {evicted} idle users")
+                except Exception as e:
+                    print(f"Warning: User memory sweep failed: {e}")
+
+        self._sweeper = threading.Thread(target=run, name="user-memory-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stop.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["resident_users"] = len(self._entries)
+            stats["resident_bytes"] = self._bytes
+        stats.update(max_users=self.max_users, max_bytes=self.max_bytes, idle_seconds=self.idle_seconds)
+        return stats
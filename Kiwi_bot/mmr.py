@@ -0,0 +1,66 @@
+from typing import Dict, List
+
+import numpy as np
+
+
+def _unit_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def apply_distance_cutoff(chunks: List[Dict], max_distance: float = None) -> List[Dict]:
+    """
+    Drop chunks whose cosine distance to the query exceeds max_distance.
+    Chunks come nearest first, so this stops at the first chunk past the cutoff
+    unless they are ordered by fused score.
+    """
+    if max_distance is None:
+        return chunks
+    kept = []
+    for chunk in chunks:
+        distance = chunk['metadata'].get('distance')
+        if distance is not None and distance > max_distance:
+            if 'rrf_score' in chunk['metadata']:
+                continue
+            break
+        kept.append(chunk)
+    return kept
+
+
+def mmr_select(query_embedding: List[float], chunks: List[Dict], k: int, lambda_mult: float = 0.5) -> List[Dict]:
+    """
+    Maximal marginal relevance: greedily pick k chunks that are close to the query
+    but far from the chunks already picked, so overlapping windows of the same
+    page do not crowd out other passages.
+
+    Args:
+        query_embedding (List[float]): Query vector
+        chunks (List[Dict]): Candidates, each with an "embedding" entry
+        k (int): Number of chunks to select
+        lambda_mult (float): 1 = pure relevance, 0 = pure diversity
+    Returns:
+        List[Dict]: Selected chunks in selection order
+    """
+    if k <= 0:
+        return []
+    if len(chunks) <= 1:
+        return chunks[:k]
+
+    matrix = _unit_rows(np.vstack([chunk["embedding"] for chunk in chunks]).astype(np.float32, copy=False))
+    query = np.asarray(query_embedding, dtype=np.float32)
+    norm = np.linalg.norm(query)
+    if norm:
+        query = query / norm
+    relevance = matrix @ query
+    pairwise = matrix @ matrix.T
+
+    selected = [int(np.argmax(relevance))]
+    max_similarity = pairwise[selected[0]].copy()
+    while len(selected) < min(k, len(chunks)):
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * max_similarity
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        max_similarity = np.maximum(max_similarity, pairwise[best])
+    return [chunks[i] for i in selected]
@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+class PdfChunkCache:
+    """
+    Bounded LRU cache of per-PDF chunk text and page -> content maps.
+    Filled when a student opens a document (/load_pdf) so page lookups and
+    the fallback path in /query can skip the database.
+    """
+
+    def __init__(self, max_pdfs: int = 32, ttl_seconds: float = 600.0):
+        """
+        Args:
+            max_pdfs (int): Maximum number of PDFs kept in memory
+            ttl_seconds (float): Entry lifetime, so re-embedded PDFs are picked up; 0 disables expiry
+        """
+        self.max_pdfs = max_pdfs
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> {"chunks", "pages", "loaded_at", "bytes"}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "page_hits": 0, "page_misses": 0, "evictions": 0, "expired": 0}
+
+    def put(self, key: str, chunks: List[Dict]):
+        """
+        Cache the chunks of one PDF, keyed by pdfPath (or pdfName for legacy lookups).
+        Chunks are expected in page order; the first chunk of a page is its page content.
+        """
+        pages = {}
+        for chunk in chunks:
+            pages.setdefault(chunk['metadata'].get('page'), chunk['content'])
+        entry = {
+            "chunks": chunks,
+            "pages": pages,
+            "loaded_at": time.time(),
+            "bytes": sum(len(chunk['content']) for chunk in chunks),
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_pdfs:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def _get_entry(self, key: str) -> Optional[Dict]:
+        # Caller holds the lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self.ttl_seconds and time.time() - entry["loaded_at"] > self.ttl_seconds:
+            del self._entries[key]
+            self._stats["expired"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key: str) -> Optional[List[Dict]]:
+        """
+        Returns:
+            Optional[List[Dict]]: Cached chunks of the PDF in page order, or None on a miss
+        """
+        with self._lock:
+            entry = self._get_entry(key)
+            self._stats["hits" if entry else "misses"] += 1
+            return entry["chunks"] if entry else None
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            return self._get_entry(key) is not None
+
+    def page_content(self, key: str, page_number: int):
+        """
+        Returns:
+            Tuple[bool, Optional[str]]: Whether the PDF is cached, and the page content
+            (None if the PDF is cached but has no such page)
+        """
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                self._stats["page_misses"] += 1
+                return False, None
+            self._stats["page_hits"] += 1
+            return True, entry["pages"].get(page_number)
+
+    def invalidate(self, key: str = None):
+        """Drop one PDF, or everything when key is None."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pdfs"] = len(self._entries)
+            stats["max_pdfs"] = self.max_pdfs
+            stats["chunks"] = sum(len(e["chunks"]) for e in self._entries.values())
+            stats["content_bytes"] = sum(e["bytes"] for e in self._entries.values())
+        return stats
@@ -11,6 +11,8 @@ from urllib.parse import urlparse
 from dotenv import load_dotenv, find_dotenv
 from pathlib import Path
 
+from corpus_state import bump_corpus_generation
+
 # Find and load .env file
 env_path = find_dotenv()
 print("Found .env file at:", env_path)
@@ -132,6 +134,8 @@ class PDFEmbeddingProcessor:
                     embedding_list
                 )
             )
+        # Tell running servers the corpus changed so retrieval caches are dropped
+        bump_corpus_generation(self.cur)
         self.conn.commit()
 
     def __del__(self):
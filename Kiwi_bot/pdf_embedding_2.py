@@ -13,6 +13,8 @@ from tqdm import tqdm
 import time
 import argparse
 
+from corpus_state import bump_corpus_generation
+
 # 加载环境变量但会被显式API密钥覆盖
 load_dotenv()
 
@@ -104,6 +106,8 @@ class PDFEmbeddingProcessor:
                     sanitized_pdf_path
                 )
             )
+        # 通知服务器语料已变化，使检索缓存失效 -> tell servers the corpus changed so retrieval caches are dropped
+        bump_corpus_generation(self.cur)
         self.conn.commit()
         
     def delete_existing_chunks(self, pdf_path=None):
@@ -115,9 +119,11 @@ class PDFEmbeddingProcessor:
             else:
                 logging.info("删除所有现有chunks...")
                 self.cur.execute('DELETE FROM "PdfChunk"')
+            affected_rows = self.cur.rowcount
             
+            if affected_rows:
+                bump_corpus_generation(self.cur)
             self.conn.commit()
-            affected_rows = self.cur.rowcount
             logging.info(f"已删除{affected_rows}条记录")
             return affected_rows
         except Exception as e:
@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Callable, Dict
+
+
+class _StageClock:
+    """Records when a worker picks a stage up."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.started = None
+
+    def run(self, fn: Callable, *args, **kwargs):
+        self.started = time.time()
+        self.event.set()
+        return fn(*args, **kwargs)
+
+
+class StageRunner:
+    """
+    Runs the independent stages of a request (history load, page lookup,
+    embedding + vector search) concurrently on a bounded thread pool.
+
+    Every stage has its own timeout, counted from when a worker starts it, so time
+    spent queued behind other requests' stages does not eat into it. A stage that
+    times out or fails yields its default value so the request can continue with
+    degraded context instead of waiting on the slowest stage. A stage still queued
+    after its timeout is cancelled and never runs; one that timed out while running
+    keeps going in the background, bounded by the database statement timeout.
+    """
+
+    def __init__(self, max_workers: int = 16, timeouts: Dict[str, float] = None):
+        """
+        Args:
+            max_workers (int): Maximum number of stages running at once across all requests
+            timeouts (Dict[str, float]): Seconds to wait for each named stage; missing names wait forever
+        """
+        self.max_workers = max_workers
+        self.timeouts = dict(timeouts or {})
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="query-stage")
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @classmethod
+    def from_env(cls) -> "StageRunner":
+        """
+        Build a runner configured by QUERY_STAGE_WORKERS, MEMORY_STAGE_TIMEOUT,
+        PAGE_STAGE_TIMEOUT and RETRIEVAL_STAGE_TIMEOUT.
+        """
+        return cls(
+            max_workers=int(os.getenv("QUERY_STAGE_WORKERS", 16)),
+            timeouts={
+                "memory": float(os.getenv("MEMORY_STAGE_TIMEOUT", 3)),
+                "page": float(os.getenv("PAGE_STAGE_TIMEOUT", 2)),
+                "retrieval": float(os.getenv("RETRIEVAL_STAGE_TIMEOUT", 15)),
+            },
+        )
+
+    def _record(self, name: str, outcome: str, elapsed: float):
+        with self._lock:
+            stats = self._stats.setdefault(name, {"ok": 0, "timeouts": 0, "errors": 0, "not_started": 0,
+                                                  "total_ms": 0.0, "max_ms": 0.0})
+            stats[outcome] += 1
+            stats["total_ms"] += elapsed * 1000
+            stats["max_ms"] = max(stats["max_ms"], elapsed * 1000)
+
+    def submit(self, name: str, fn: Callable, *args, **kwargs):
+        """
+        Queue a stage.
+        Returns:
+            Tuple[str, Future, float, _StageClock]: Handle to pass to result()
+        """
+        clock = _StageClock()
+        return name, self._executor.submit(clock.run, fn, *args, **kwargs), time.time(), clock
+
+    def result(self, handle, default=None):
+        """
+        Wait for a stage: up to its timeout for a worker to start it, then up to its
+        timeout from the start. A stage that has not started by then is cancelled.
+        Returns:
+            The stage result, or default if the stage timed out, was cancelled or raised
+        """
+        name, future, submitted, clock = handle
+        timeout = self.timeouts.get(name)
+        if timeout is not None and not clock.event.wait(timeout) and future.cancel():
+            self._record(name, "not_started", time.time() - submitted)
+            print(f"Warning: Stage '{name}' did not start within {timeout}s, cancelled")
+            return default
+        remaining = None
+        if timeout is not None:
+            clock.event.wait()  # set before the stage runs, unless it was cancelled above
+            remaining = max(timeout - (time.time() - clock.started), 0)
+        try:
+            value = future.result(timeout=remaining)
+        except FutureTimeout:
+            self._record(name, "timeouts", time.time() - clock.started)
+            print(f"Warning: Stage '{name}' timed out after {timeout}s, continuing without it")
+            return default
+        except Exception as e:
+            self._record(name, "errors", time.time() - (clock.started or submitted))
+            print(f"Warning: Stage '{name}' failed: {e}")
+            return default
+        self._record(name, "ok", time.time() - clock.started)
+        return value
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stages = {name: dict(s) for name, s in self._stats.items()}
+        for s in stages.values():
+            calls = s["ok"] + s["timeouts"] + s["errors"] + s["not_started"]
+            s["avg_ms"] = round(s.pop("total_ms") / calls, 2) if calls else 0.0
+            s["max_ms"] = round(s["max_ms"], 2)
+        return {"max_workers": self.max_workers, "timeouts": dict(self.timeouts), "stages": stages}
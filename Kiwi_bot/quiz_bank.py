@@ -0,0 +1,211 @@
+import os
+import re
+import threading
+import uuid
+from typing import Dict, List
+
+from psycopg2.extras import Json, execute_values
+
+# Questions generated ahead of time by build_quiz_bank.py (and written back by live generation),
+# plus the questions each user has already been served
+QUIZ_BANK_DDL = """
+    CREATE TABLE IF NOT EXISTS "QuizBankQuestion" (
+        "id" TEXT NOT NULL PRIMARY KEY,
+        "pdfPath" TEXT NOT NULL,
+        "pageStart" INTEGER NOT NULL,
+        "pageEnd" INTEGER NOT NULL,
+        "difficulty" TEXT NOT NULL,
+        "question" TEXT NOT NULL,
+        "options" JSONB NOT NULL,
+        "correctAnswer" TEXT NOT NULL,
+        "explanation" TEXT NOT NULL,
+        "source" TEXT NOT NULL DEFAULT 'offline',
+        "createdAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS "quiz_bank_pdf_difficulty_idx" ON "QuizBankQuestion" ("pdfPath", "difficulty");
+    CREATE TABLE IF NOT EXISTS "QuizBankSeen" (
+        "userId" TEXT NOT NULL,
+        "questionId" TEXT NOT NULL REFERENCES "QuizBankQuestion" ("id") ON DELETE CASCADE,
+        "seenAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY ("userId", "questionId")
+    );
+"""
+
+_LETTER_RE = re.compile(r"^(?:option\s+)?([A-Za-z])(?:[.):]|\s|$)", re.IGNORECASE)
+_ANSWER_PREFIX_RE = re.compile(r"^\s*(?:correct\s+)?answer\s*[:\-]?\s*", re.IGNORECASE)
+_PREFIXED_LETTER_RE = re.compile(r"^\s*(?:correct\s+)?answer\s*[:\-]?\s*([A-D])\b", re.IGNORECASE)
+
+
+def answer_letter(question: Dict) -> str:
+    """
+    Letter (A, B, ...) of the correct option. Models write the answer as "B",
+    "Option B", "B. text", "Answer: B", "Correct answer - B" or the option text itself.
+    """
+    answer = str(question.get("correctAnswer") or question.get("answer") or "").strip()
+    match = _PREFIXED_LETTER_RE.match(answer)
+    if match:
+        return match.group(1).upper()
+    answer = _ANSWER_PREFIX_RE.sub("", answer)
+    for index, option in enumerate(question.get("options", [])):
+        text = option.split(".", 1)[-1].strip() if _LETTER_RE.match(option) else option.strip()
+        if answer.lower() in (option.strip().lower(), text.lower()):
+            return chr(ord("A") + index)
+    match = _LETTER_RE.match(answer)
+    return match.group(1).upper() if match else answer
+
+
+def to_quiz_mode(question: Dict) -> Dict:
+    """Bank question in the single-question format of quiz mode in /query."""
+    return {
+        "question": question["question"],
+        "options": question["options"],
+        "answer": answer_letter(question),
+        "explanation": question.get("explanation", ""),
+    }
+
+
+def store_questions(cursor, pdf_path: str, page_start: int, page_end: int, difficulty: str,
+                    questions: List[Dict], source: str = "offline") -> List[str]:
+    """
+    Insert questions into the bank. Call inside the caller's transaction.
+    Returns:
+        List[str]: Ids of the inserted questions
+    """
+    ids = [str(uuid.uuid4()) for _ in questions]
+    rows = [(question_id, pdf_path, page_start, page_end, difficulty, question["question"], Json(question["options"]),
+             str(question["correctAnswer"]), question["explanation"], source)
+            for question_id, question in zip(ids, questions)]
+    if rows:
+        # One multi-row statement for the whole set
+        execute_values(cursor, """
+            INSERT INTO "QuizBankQuestion"
+                ("id", "pdfPath", "pageStart", "pageEnd", "difficulty", "question", "options",
+                 "correctAnswer", "explanation", "source")
+            VALUES %s
+        """, rows, page_size=len(rows))
+    return ids
+
+
+def mark_seen(cursor, user_id: str, question_ids: List[str]):
+    if user_id and question_ids:
+        cursor.execute(
+            """
+            INSERT INTO "QuizBankSeen" ("userId", "questionId")
+            SELECT %s, unnest(%s::text[])
+            ON CONFLICT DO NOTHING
+            """,
+            (user_id, list(question_ids))
+        )
+
+
+class QuizBank:
+    """
+    Serves precomputed quiz questions by random sampling, skipping questions the
+    user has already seen. Callers generate live questions only for the shortfall
+    and hand them back with add(), so the bank grows where it ran dry.
+    """
+
+    def __init__(self, pool, enabled: bool = True):
+        """
+        Args:
+            pool (ConnectionPool): Database pool
+            enabled (bool): When False, sample() always returns nothing
+        """
+        self.pool = pool
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "hits": 0, "partial": 0, "misses": 0, "served": 0, "stored": 0, "errors": 0}
+
+    @classmethod
+    def from_env(cls, pool) -> "QuizBank":
+        """Bank configured by QUIZ_BANK_ENABLED."""
+        return cls(pool, enabled=os.getenv("QUIZ_BANK_ENABLED", "1").lower() not in ("0", "false", "no"))
+
+    def _count(self, key: str, value: int = 1):
+        with self._lock:
+            self._stats[key] += value
+
+    def sample(self, pdf_path: str, difficulty: str, count: int, user_id: str = None, page: int = None) -> List[Dict]:
+        """
+        Draw up to count random questions the user has not seen and mark them as seen.
+
+        Args:
+            pdf_path (str): PDF path (with public/ prefix)
+            difficulty (str): easy, medium or hard
+            count (int): Questions wanted
+            user_id (str, optional): User whose seen questions are skipped; None serves any question
+            page (int, optional): 0-based page; questions whose range covers it come first
+        Returns:
+            List[Dict]: Questions with question, options, correctAnswer and explanation
+        """
+        if not self.enabled or not pdf_path or count <= 0:
+            return []
+        self._count("requests")
+        if user_id == "anonymous":
+            user_id = None
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        """
+                        SELECT q."id", q."question", q."options", q."correctAnswer", q."explanation"
+                        FROM "QuizBankQuestion" q
+                        WHERE q."pdfPath" = %s AND q."difficulty" = %s
+                          AND (%s::text IS NULL OR NOT EXISTS (
+                              SELECT 1 FROM "QuizBankSeen" s
+                              WHERE s."userId" = %s AND s."questionId" = q."id"))
+                        ORDER BY (%s::int IS NOT NULL AND %s::int BETWEEN q."pageStart" AND q."pageEnd") DESC,
+                                 random()
+                        LIMIT %s
+                        """,
+                        (pdf_path, difficulty, user_id, user_id, page, page, count)
+                    )
+                    rows = cursor.fetchall()
+                    mark_seen(cursor, user_id, [row[0] for row in rows])
+                conn.commit()
+        except Exception as e:
+            self._count("errors")
+            print(f"Warning: Quiz bank lookup failed: {e}")
+            return []
+
+        questions = [{"question": question, "options": options, "correctAnswer": correct, "explanation": explanation}
+                     for _, question, options, correct, explanation in rows]
+        self._count("served", len(questions))
+        self._count("hits" if len(questions) == count else "partial" if questions else "misses")
+        return questions
+
+    def add(self, pdf_path: str, difficulty: str, questions: List[Dict], chunks: List[Dict] = None,
+            user_id: str = None):
+        """
+        Store live-generated questions, marked as seen by the user they were generated for.
+
+        Args:
+            pdf_path (str): PDF path (with public/ prefix)
+            difficulty (str): easy, medium or hard
+            questions (List[Dict]): Generated questions
+            chunks (List[Dict], optional): Chunks the questions were generated from; sets the page range
+            user_id (str, optional): User who was served the questions
+        """
+        if not self.enabled or not pdf_path or not questions:
+            return
+        pages = [chunk["metadata"].get("page", 0) for chunk in chunks or []
+                 if chunk["metadata"].get("pdf_path") == pdf_path]
+        if user_id == "anonymous":
+            user_id = None
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    ids = store_questions(cursor, pdf_path, min(pages, default=0), max(pages, default=0),
+                                          difficulty, questions, source="live")
+                    mark_seen(cursor, user_id, ids)
+                conn.commit()
+            self._count("stored", len(ids))
+        except Exception as e:
+            self._count("errors")
+            print(f"Warning: Failed to store generated quiz questions: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["enabled"] = self.enabled
+        return stats
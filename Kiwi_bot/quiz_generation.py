@@ -0,0 +1,238 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterator, List
+
+_WORD_RE = re.compile(r"\w+")
+_FENCE_RE = re.compile(r"```(?:json)?", re.IGNORECASE)
+
+REQUIRED_FIELDS = ("question", "options", "correctAnswer", "explanation")
+
+DIFFICULTIES = ("easy", "medium", "hard")
+
+
+def normalize_difficulty(value, default: str = "medium") -> str:
+    """Requested difficulty in lower case; missing, null or unknown values become default."""
+    difficulty = str(value or default).strip().lower()
+    return difficulty if difficulty in DIFFICULTIES else default
+
+
+def parse_quiz_questions(text: str) -> List[Dict]:
+    """
+    Extract quiz questions from a model response.
+
+    Every top-level JSON object is decoded on its own, so text around the array,
+    code fences, a truncated last question or one malformed entry only lose
+    the affected question, not the whole set.
+    """
+    text = _FENCE_RE.sub("", text)
+    decoder = json.JSONDecoder()
+    questions = []
+    position = text.find("{")
+    while position != -1:
+        try:
+            value, end = decoder.raw_decode(text, position)
+        except json.JSONDecodeError:
+            position = text.find("{", position + 1)
+            continue
+        if isinstance(value, dict) and valid_question(value):
+            questions.append(value)
+        position = text.find("{", end)
+    return questions
+
+
+def valid_question(question: Dict) -> bool:
+    if not all(question.get(field) for field in REQUIRED_FIELDS):
+        return False
+    options = question["options"]
+    return isinstance(options, list) and len(options) >= 2 and all(isinstance(o, str) for o in options)
+
+
+def _question_words(question: Dict) -> set:
+    return set(_WORD_RE.findall(question["question"].lower()))
+
+
+def is_duplicate(question: Dict, accepted: List[Dict], threshold: float = 0.8) -> bool:
+    """True if the question's words overlap an accepted question's by at least threshold (Jaccard)."""
+    words = _question_words(question)
+    if not words:
+        return True
+    for other in accepted:
+        other_words = _question_words(other)
+        if len(words & other_words) / len(words | other_words) >= threshold:
+            return True
+    return False
+
+
+def split_chunk_groups(chunks: List[Dict], groups: int) -> List[List[Dict]]:
+    """Deal chunks (most relevant first) round-robin into groups, so every group gets relevant material."""
+    groups = max(1, min(groups, len(chunks)))
+    return [chunks[i::groups] for i in range(groups)]
+
+
+def build_quiz_prompt(chunks: List[Dict], num_questions: int, difficulty: str, exclude: List[str] = None) -> str:
+    """
+    Prompt asking for num_questions multiple-choice questions about the chunks, as a JSON array
+    Args:
+        chunks (List[Dict]): Source chunks ("content" and "metadata" with pdf_path and page)
+        num_questions (int): Number of questions to ask for
+        difficulty (str): easy, medium or hard
+        exclude (List[str], optional): Questions that already exist and must not be repeated
+    Returns:
+        str: The prompt
+    """
+    document_context = "\n---\n".join(
+        f"[{chunk['metadata']['pdf_path']} - Page {chunk['metadata']['page']}]: {chunk['content']}"
+        for chunk in chunks
+    )
+
+    quiz_prompt = f"""Based on the following document content, create {num_questions} multiple-choice questions at {difficulty} difficulty level.
+        
+Content:
+{document_context}
+
+Each question should:
+1. Create a clear and specific {difficulty} difficulty question about the content.
+2. Provide 4 options (labeled A, B, C, D).
+3. Indicate which option is correct.
+4. Provide a concise explanation of why the answer is correct.
+
+Difficulty Guide:
+- Easy: Basic recall of explicit facts from the text, direct questions with obvious answers.
+- Medium: Conceptual understanding, requiring some analysis or connection of different ideas.
+- Hard: Application of concepts, requiring deeper understanding, analysis, and critical thinking.
+
+Please return in a valid JSON array format with the following structure:
+[
+  {{
+    "question": "Question text",
+    "options": ["A. Option 1", "B. Option 2", "C. Option 3", "D. Option 4"],
+    "correctAnswer": "Option X",
+    "explanation": "Why this is the correct answer"
+  }}
+]
+
+Only generate specific questions about the provided content. If the content is insufficient, you may return fewer questions.
+"""
+    if exclude:
+        quiz_prompt += "\nDo not repeat or rephrase any of these existing questions:\n" + "\n".join(f"- {q}" for q in exclude) + "\n"
+    return quiz_prompt
+
+
+class QuizGenerator:
+    """
+    Fans a quiz request out over groups of chunks. Each group is asked for a share
+    of the questions concurrently; questions are yielded as their call finishes,
+    near-duplicates are dropped, and a shortfall is topped up with one more call.
+    """
+
+    def __init__(self, max_workers: int = 4, questions_per_call: int = 5, dedup_threshold: float = 0.8):
+        """
+        Args:
+            max_workers (int): Concurrent generation calls across all requests
+            questions_per_call (int): Questions asked of a single call
+            dedup_threshold (float): Word overlap (Jaccard) that makes two questions duplicates
+        """
+        self.max_workers = max_workers
+        self.questions_per_call = questions_per_call
+        self.dedup_threshold = dedup_threshold
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="quiz-gen")
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "calls": 0, "failed_calls": 0, "questions": 0, "duplicates_dropped": 0,
+                       "top_ups": 0, "first_question_ms_total": 0.0}
+
+    @classmethod
+    def from_env(cls) -> "QuizGenerator":
+        """Generator configured by QUIZ_WORKERS, QUIZ_QUESTIONS_PER_CALL and QUIZ_DEDUP_THRESHOLD."""
+        return cls(
+            max_workers=int(os.getenv("QUIZ_WORKERS", 4)),
+            questions_per_call=int(os.getenv("QUIZ_QUESTIONS_PER_CALL", 5)),
+            dedup_threshold=float(os.getenv("QUIZ_DEDUP_THRESHOLD", 0.8)),
+        )
+
+    def _count(self, key: str, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def _call(self, generate: Callable, chunks: List[Dict], count: int, exclude: List[str]) -> List[Dict]:
+        self._count("calls")
+        text = generate(chunks, count, exclude)
+        return parse_quiz_questions(text)
+
+    def generate(self, generate: Callable[[List[Dict], int, List[str]], str], chunks: List[Dict],
+                 num_questions: int, report: Dict = None, existing: List[Dict] = None) -> Iterator[Dict]:
+        """
+        Generate up to num_questions questions.
+
+        Args:
+            generate (Callable): generate(chunks, count, exclude_questions) -> raw model response
+            chunks (List[Dict]): Source chunks, most relevant first
+            num_questions (int): Questions wanted
+            report (Dict, optional): Filled with calls, failed_calls and duplicates_dropped for this request
+            existing (List[Dict], optional): Questions already served (e.g. from the quiz bank) that must not be repeated
+        Yields:
+            Dict: Questions, in the order their calls finished
+        """
+        started = time.perf_counter()
+        report = report if report is not None else {}
+        report.update(calls=0, failed_calls=0, duplicates_dropped=0)
+        self._count("requests")
+        accepted = []
+        existing = list(existing or [])
+
+        def take(questions):
+            for question in questions:
+                if len(accepted) >= num_questions:
+                    return
+                if is_duplicate(question, existing + accepted, self.dedup_threshold):
+                    report["duplicates_dropped"] += 1
+                    self._count("duplicates_dropped")
+                    continue
+                if not accepted:
+                    self._count("first_question_ms_total", (time.perf_counter() - started) * 1000)
+                accepted.append(question)
+                self._count("questions")
+                yield question
+
+        calls = math.ceil(num_questions / self.questions_per_call)
+        groups = split_chunk_groups(chunks, calls)
+        # Spread the questions over the groups; the first groups take the remainder
+        shares = [num_questions // len(groups) + (1 if i < num_questions % len(groups) else 0) for i in range(len(groups))]
+        futures = [self._executor.submit(self._call, generate, group, share, [])
+                   for group, share in zip(groups, shares) if share]
+        report["calls"] += len(futures)
+        for future in as_completed(futures):
+            try:
+                questions = future.result()
+            except Exception as e:
+                report["failed_calls"] += 1
+                self._count("failed_calls")
+                print(f"Warning: Quiz generation call failed: {e}")
+                continue
+            yield from take(questions)
+
+        missing = num_questions - len(accepted)
+        if missing > 0 and chunks:
+            # One top-up over all chunks, told which questions already exist
+            self._count("top_ups")
+            report["calls"] += 1
+            try:
+                questions = self._call(generate, chunks, missing, [q["question"] for q in existing + accepted])
+            except Exception as e:
+                report["failed_calls"] += 1
+                self._count("failed_calls")
+                print(f"Warning: Quiz top-up call failed: {e}")
+                questions = []
+            yield from take(questions)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        requests = stats["requests"]
+        stats["avg_first_question_ms"] = round(stats.pop("first_question_ms_total") / requests, 2) if requests else 0.0
+        stats.update(max_workers=self.max_workers, questions_per_call=self.questions_per_call)
+        return stats
@@ -0,0 +1,76 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+
+
+def embedding_fingerprint(embedding: List[float]) -> str:
+    """
+    Short, stable hash of a query embedding (as float32), used as a cache key
+    """
+    return hashlib.blake2b(np.asarray(embedding, dtype=np.float32).tobytes(), digest_size=16).hexdigest()
+
+
+class RetrievalCache:
+    """
+    Bounded LRU + TTL cache of merged retrieval results.
+    Every entry is tagged with the corpus generation it was computed under;
+    entries from an older generation are never served.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 900.0):
+        """
+        Args:
+            max_entries (int): Maximum number of cached results
+            ttl_seconds (float): Entry lifetime, a backstop for ingestion that does not bump the generation
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (generation, created_at, value)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key: tuple, generation: int):
+        """
+        Returns:
+            The cached value, or None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            entry_generation, created_at, value = entry
+            if entry_generation != generation or (self.ttl_seconds and time.time() - created_at > self.ttl_seconds):
+                del self._entries[key]
+                self._stats["stale"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def put(self, key: tuple, generation: int, value):
+        with self._lock:
+            self._entries[key] = (generation, time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats["invalidations"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+            stats["max_entries"] = self.max_entries
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
@@ -0,0 +1,142 @@
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from psycopg2.extras import Json, execute_values
+
+# Appends to the active sessions are done by Postgres with jsonb concatenation, so a turn sends
+# only its new entries instead of reading and rewriting the whole "conversationhistory" array.
+# The row locks taken here serialize concurrent turns of a session without losing any.
+# One statement appends for every user of a batch; a "system" entry is added first where the
+# session's document differs from the batch's first one.
+_APPEND_SQL = """
+    WITH batch ("userId", "firstPdf", "lastPdf", "entries", "timestamp") AS (
+        VALUES %s
+    ), active AS (
+        SELECT session.id, session."pdfname", batch.*
+        FROM batch
+        CROSS JOIN LATERAL (
+            SELECT id, "pdfname" FROM "UserSession"
+            WHERE "userId" = batch."userId" AND "sessionEndTime" IS NULL
+            ORDER BY "sessionStartTime" DESC
+            LIMIT 1
+            FOR UPDATE
+        ) session
+    ), appended AS (
+        SELECT id, "lastPdf",
+               CASE WHEN "pdfname" IS DISTINCT FROM "firstPdf"
+                    THEN jsonb_build_array(jsonb_build_object(
+                        'timestamp', "timestamp",
+                        'sender', 'system',
+                        'message', 'Switched document: from ' || COALESCE("pdfname", 'None')
+                                   || ' to ' || COALESCE("firstPdf", 'None')))
+                    ELSE '[]'::jsonb END || "entries" AS "entries"
+        FROM active
+    )
+    UPDATE "UserSession" s
+    SET "conversationhistory" = COALESCE(s."conversationhistory", '[]'::jsonb) || appended."entries",
+        "messageCount" = s."messageCount" + jsonb_array_length(appended."entries"),
+        "pdfname" = appended."lastPdf"
+    FROM appended
+    WHERE s.id = appended.id
+    RETURNING s."userId", s.id, s."messageCount"
+"""
+
+# (user_id, pdf_name, entries) of one turn
+Turn = Tuple[str, Optional[str], List[Dict]]
+
+
+def message_entry(sender: str, message: str, timestamp: Optional[str] = None) -> Dict:
+    """One "conversationhistory" entry."""
+    return {
+        "timestamp": timestamp or datetime.utcnow().isoformat(),
+        "sender": sender,
+        "message": message,
+    }
+
+
+def merge_turns(turns: Sequence[Turn]) -> Dict[str, list]:
+    """
+    Combine turns per user, in order, recording PDF switches between them.
+    Returns:
+        Dict[str, list]: user_id -> [first pdf, last pdf, entries]
+    """
+    merged = {}
+    for user_id, pdf_name, entries in turns:
+        current = merged.get(user_id)
+        if current is None:
+            merged[user_id] = [pdf_name, pdf_name, list(entries)]
+            continue
+        if current[1] != pdf_name:
+            current[2].append(message_entry("system", f"Switched document: from {current[1]} to {pdf_name}",
+                                            entries[0]["timestamp"] if entries else None))
+        current[1] = pdf_name
+        current[2].extend(entries)
+    return merged
+
+
+def _append_existing(cursor, merged: Dict[str, list], timestamp: str) -> Dict[str, Tuple[str, int, bool]]:
+    # Users in a fixed order, so concurrent batches lock their sessions in the same order
+    rows = [(user_id, first_pdf, last_pdf, Json(entries), timestamp)
+            for user_id, (first_pdf, last_pdf, entries) in sorted(merged.items())]
+    if not rows:
+        return {}
+    updated = execute_values(cursor, _APPEND_SQL, rows, template="(%s, %s, %s, %s::jsonb, %s)",
+                             page_size=len(rows), fetch=True)
+    return {user_id: (session_id, count, False) for user_id, session_id, count in updated}
+
+
+def append_session_batch(cursor, turns: Sequence[Turn]) -> Dict[str, Tuple[str, int, bool]]:
+    """
+    Append the turns of many users to their active sessions, creating sessions where
+    there are none, with one multi-row statement per step. Call inside the caller's transaction.
+    Args:
+        cursor: psycopg2 cursor
+        turns (Sequence[Turn]): (user_id, pdf_name, entries) per turn, in order
+    Returns:
+        Dict[str, Tuple[str, int, bool]]: user_id -> session id, its message count, and whether it was created
+    """
+    merged = merge_turns(turns)
+    timestamp = datetime.utcnow().isoformat()
+    results = _append_existing(cursor, merged, timestamp)
+
+    missing = sorted(user_id for user_id in merged if user_id not in results)
+    if not missing:
+        return results
+
+    # No active session: serialize session creation per user, then check again,
+    # so two first turns arriving together do not open two sessions
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(u)) FROM unnest(%s::text[]) AS u", (missing,))
+    results.update(_append_existing(cursor, {user_id: merged[user_id] for user_id in missing}, timestamp))
+
+    now = datetime.utcnow()
+    rows = []
+    for user_id in missing:
+        if user_id in results:
+            continue
+        _, last_pdf, entries = merged[user_id]
+        session_id = str(uuid.uuid4())
+        rows.append((session_id, user_id, last_pdf, Json(entries), len(entries), now))
+        results[user_id] = (session_id, len(entries), True)
+    if rows:
+        execute_values(cursor, """
+            INSERT INTO "UserSession" (id, "userId", "pdfname", "conversationhistory", "messageCount", "sessionStartTime")
+            VALUES %s
+        """, rows, template="(%s, %s, %s, %s::jsonb, %s, %s)", page_size=len(rows))
+    return results
+
+
+def append_session_messages(cursor, user_id: str, pdf_name: str, entries: List[Dict]) -> Tuple[str, int, bool]:
+    """
+    Append entries to the user's active session, creating one if there is none.
+    A "system" entry recording the switch is added first when pdf_name differs from
+    the session's document. Call inside the caller's transaction.
+    Args:
+        cursor: psycopg2 cursor
+        user_id (str): User ID
+        pdf_name (str): PDF the entries belong to
+        entries (List[Dict]): Entries from message_entry(), in order
+    Returns:
+        Tuple[str, int, bool]: Session id, its message count, and whether it was created
+    """
+    return append_session_batch(cursor, [(user_id, pdf_name, entries)])[user_id]
@@ -0,0 +1,174 @@
+import os
+import queue
+import threading
+import time
+from typing import List
+
+import psycopg2
+
+from session_history import Turn, append_session_batch, message_entry
+
+# A batch failing with these is not retried as a whole; its users are written one by one
+# so a single rejected turn (e.g. an unknown user id) does not take the others with it
+REJECTED_ERRORS = (psycopg2.IntegrityError, psycopg2.DataError)
+
+
+class SessionWriter:
+    """
+    Write-behind persistence of finished conversation turns.
+
+    submit() only puts the turn on an in-process queue, so the answer stream closes
+    without waiting for the database. A background thread appends queued turns to
+    "UserSession" in batches (one multi-row statement per step, see
+    session_history.append_session_batch), retries failed batches with backoff and
+    drains the queue on close().
+    """
+
+    def __init__(self, pool, batch_size: int = 100, flush_interval: float = 0.2, max_queue: int = 10000,
+                 max_retries: int = 5, retry_backoff: float = 0.5):
+        """
+        Args:
+            pool (ConnectionPool): Database pool
+            batch_size (int): Maximum turns written per transaction
+            flush_interval (float): Seconds to wait for more turns before writing a partial batch
+            max_queue (int): Queued turns beyond this are dropped (and counted) instead of blocking requests
+            max_retries (int): Attempts per batch before its turns are dropped
+            retry_backoff (float): Base of the exponential backoff between attempts, in seconds
+        """
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._closing = threading.Event()
+        self._worker = None
+        self._stats = {"submitted": 0, "written": 0, "batches": 0, "retries": 0, "dropped_full": 0,
+                       "dropped_closed": 0, "dropped_failed": 0, "rejected": 0, "last_batch_ms": 0.0}
+
+    @classmethod
+    def from_env(cls, pool) -> "SessionWriter":
+        """
+        Writer configured by SESSION_WRITE_BATCH, SESSION_WRITE_INTERVAL,
+        SESSION_WRITE_QUEUE and SESSION_WRITE_RETRIES.
+        """
+        return cls(
+            pool,
+            batch_size=int(os.getenv("SESSION_WRITE_BATCH", 100)),
+            flush_interval=float(os.getenv("SESSION_WRITE_INTERVAL", 0.2)),
+            max_queue=int(os.getenv("SESSION_WRITE_QUEUE", 10000)),
+            max_retries=int(os.getenv("SESSION_WRITE_RETRIES", 5)),
+        )
+
+    def _count(self, key: str, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def submit(self, user_id: str, pdf_name: str, user_input: str, bot_response: str) -> bool:
+        """
+        Queue a finished turn. Timestamps are taken now, so entries keep the order of the answers.
+        Returns:
+            bool: False if the turn was dropped because the queue is full or the writer is closed
+        """
+        if self._closing.is_set():
+            self._count("dropped_closed")
+            return False
+        turn = (user_id, pdf_name, [message_entry("user", user_input), message_entry("bot", bot_response)])
+        try:
+            self._queue.put_nowait(turn)
+        except queue.Full:
+            self._count("dropped_full")
+            print(f"Warning: Session write queue full, dropping turn of user {user_id}")
+            return False
+        self._count("submitted")
+        self.start()
+        return True
+
+    def start(self):
+        """Start the background writer (done by the first submit())."""
+        with self._lock:
+            if self._worker is not None:
+                return
+            self._worker = threading.Thread(target=self._run, name="session-writer", daemon=True)
+        self._worker.start()
+
+    def _next_batch(self) -> List[Turn]:
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 and not self._closing.is_set()
+                             else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not (self._closing.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self.flush(batch)
+
+    def _write(self, turns: List[Turn]):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                append_session_batch(cursor, turns)
+            conn.commit()
+
+    def flush(self, turns: List[Turn]):
+        """Write turns in one transaction, retrying with backoff; the whole batch is rolled back on failure."""
+        start = time.perf_counter()
+        for attempt in range(self.max_retries):
+            try:
+                self._write(turns)
+                break
+            except REJECTED_ERRORS as e:
+                print(f"Warning: Session batch rejected, writing per user: {e}")
+                self._write_per_user(turns)
+                return
+            except Exception as e:
+                if attempt + 1 == self.max_retries:
+                    self._count("dropped_failed", len(turns))
+                    print(f"Error: Session write failed {self.max_retries} times, dropping {len(turns)} turns: {e}")
+                    return
+                self._count("retries")
+                print(f"Warning: Session write failed (attempt {attempt + 1}), retrying: {e}")
+                time.sleep(self.retry_backoff * 2 ** attempt)
+        with self._lock:
+            self._stats["written"] += len(turns)
+            self._stats["batches"] += 1
+            self._stats["last_batch_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+    def _write_per_user(self, turns: List[Turn]):
+        by_user = {}
+        for turn in turns:
+            by_user.setdefault(turn[0], []).append(turn)
+        if len(by_user) == 1:
+            self._count("rejected", len(turns))
+            print(f"Warning: Session write rejected for user {turns[0][0]}")
+            return
+        for user_turns in by_user.values():
+            self.flush(user_turns)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def close(self, timeout: float = 10.0):
+        """Stop accepting turns and wait up to timeout seconds for the queue to be written."""
+        self._closing.set()
+        worker = self._worker
+        if worker is not None:
+            worker.join(timeout)
+        if self._queue.qsize():
+            print(f"Warning: {self._queue.qsize()} queued session turns were not written")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(pending=self._queue.qsize(), batch_size=self.batch_size, max_retries=self.max_retries)
+        return stats
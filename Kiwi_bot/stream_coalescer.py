@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+from typing import Optional
+
+
+class TokenCoalescer:
+    """
+    Groups streamed LLM tokens into SSE writes. The first visible text is flushed
+    immediately; after that the buffer is flushed once it is flush_interval_ms old
+    or holds flush_bytes bytes, whichever comes first. Whitespace-only buffers are
+    held back and sent with the next text.
+
+    Also collects the write statistics of the stream.
+    """
+
+    def __init__(self, flush_interval_ms: float = 50.0, flush_bytes: int = 256):
+        """
+        Args:
+            flush_interval_ms (float): Maximum time text waits in the buffer once a token arrives
+            flush_bytes (int): Buffer size (UTF-8 bytes) that forces a flush
+        """
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.flush_bytes = flush_bytes
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._last_flush = None
+        self.started = time.perf_counter()
+        self.stats = {"tokens": 0, "writes": 0, "bytes": 0, "first_write_ms": None, "max_write_gap_ms": 0.0}
+
+    @classmethod
+    def from_env(cls) -> "TokenCoalescer":
+        """Coalescer configured by STREAM_FLUSH_INTERVAL_MS and STREAM_FLUSH_BYTES."""
+        return cls(
+            flush_interval_ms=float(os.getenv("STREAM_FLUSH_INTERVAL_MS", 50)),
+            flush_bytes=int(os.getenv("STREAM_FLUSH_BYTES", 256)),
+        )
+
+    def add(self, text: str) -> Optional[str]:
+        """
+        Buffer one token.
+        Returns:
+            Optional[str]: Text to write now, or None to keep buffering
+        """
+        if not text:
+            return None
+        self.stats["tokens"] += 1
+        self._buffer.append(text)
+        self._buffer_bytes += len(text.encode("utf-8"))
+        if self._last_flush is None:
+            due = True  # first token goes out right away
+        else:
+            due = (self._buffer_bytes >= self.flush_bytes
+                   or time.perf_counter() - self._last_flush >= self.flush_interval)
+        return self._take() if due else None
+
+    def flush(self) -> Optional[str]:
+        """
+        Returns:
+            Optional[str]: Whatever is left in the buffer at the end of the stream
+        """
+        return self._take()
+
+    def _take(self) -> Optional[str]:
+        segment = "".join(self._buffer)
+        if not segment.strip():
+            return None
+        now = time.perf_counter()
+        if self._last_flush is None:
+            self.stats["first_write_ms"] = round((now - self.started) * 1000, 2)
+        else:
+            self.stats["max_write_gap_ms"] = round(max(self.stats["max_write_gap_ms"], (now - self._last_flush) * 1000), 2)
+        self.stats["writes"] += 1
+        self.stats["bytes"] += self._buffer_bytes
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._last_flush = now
+        return segment
+
+    def summary(self) -> dict:
+        """Write statistics of the finished stream."""
+        stats = dict(self.stats)
+        stats["duration_ms"] = round((time.perf_counter() - self.started) * 1000, 2)
+        stats["tokens_per_write"] = round(stats["tokens"] / stats["writes"], 2) if stats["writes"] else 0.0
+        return stats
+
+
+class StreamStats:
+    """
+    Aggregate write statistics over all answer streams, for /metrics
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {"streams": 0, "tokens": 0, "writes": 0, "bytes": 0, "first_write_ms_total": 0.0,
+                        "max_first_write_ms": 0.0, "max_write_gap_ms": 0.0}
+
+    def record(self, summary: dict):
+        with self._lock:
+            totals = self._totals
+            totals["streams"] += 1
+            totals["tokens"] += summary["tokens"]
+            totals["writes"] += summary["writes"]
+            totals["bytes"] += summary["bytes"]
+            if summary["first_write_ms"] is not None:
+                totals["first_write_ms_total"] += summary["first_write_ms"]
+                totals["max_first_write_ms"] = max(totals["max_first_write_ms"], summary["first_write_ms"])
+            totals["max_write_gap_ms"] = max(totals["max_write_gap_ms"], summary["max_write_gap_ms"])
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._totals)
+        streams = stats["streams"]
+        stats["avg_first_write_ms"] = round(stats.pop("first_write_ms_total") / streams, 2) if streams else 0.0
+        stats["tokens_per_write"] = round(stats["tokens"] / stats["writes"], 2) if stats["writes"] else 0.0
+        return stats
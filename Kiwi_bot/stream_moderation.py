@@ -0,0 +1,201 @@
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Callable, Dict, List
+
+_SENTENCE_END_RE = re.compile(r"[.!?。！？\n]\s*$")
+
+BLOCKED_NOTICE = "[Part of this answer was withheld by the safety filter.]"
+
+
+class SafetyGate:
+    """
+    Moderation for streamed answers. Answer text is grouped into sentence windows
+    and each window is checked on a bounded worker pool while generation continues.
+
+    Policies:
+        "hold": a window is only sent once its check passed; a failed window is
+                replaced with a notice. Works with any SSE client.
+        "retract": text is sent immediately; a failed window is followed by a
+                "retract" event with its character range and replacement.
+    """
+
+    def __init__(self, check: Callable[[str, str], bool], max_workers: int = 8, window_chars: int = 300,
+                 first_window_chars: int = 80, policy: str = "hold", timeout: float = 5.0, fail_open: bool = True):
+        """
+        Args:
+            check (Callable[[str, str], bool]): check(window_text, preceding_text) -> True if safe
+            max_workers (int): Concurrent checks across all streams
+            window_chars (int): Window size; a window closes at the first sentence end past this length
+            first_window_chars (int): Smaller first window, so held answers start sooner
+            policy (str): "hold" or "retract"
+            timeout (float): Seconds a window check may take, counted from submission
+            fail_open (bool): Release windows whose check timed out or failed
+        """
+        if policy not in ("hold", "retract"):
+            raise ValueError(f"Unknown safety policy '{policy}'")
+        self.check = check
+        self.max_workers = max_workers
+        self.window_chars = window_chars
+        self.first_window_chars = first_window_chars
+        self.policy = policy
+        self.timeout = timeout
+        self.fail_open = fail_open
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="safety-check")
+        self._lock = threading.Lock()
+        self._stats = {"streams": 0, "windows": 0, "blocked": 0, "timeouts": 0, "errors": 0,
+                       "check_ms_total": 0.0, "max_check_ms": 0.0}
+
+    @classmethod
+    def from_env(cls, check: Callable[[str, str], bool]) -> "SafetyGate":
+        """
+        Gate configured by SAFETY_WORKERS, SAFETY_WINDOW_CHARS, SAFETY_FIRST_WINDOW_CHARS,
+        SAFETY_POLICY, SAFETY_CHECK_TIMEOUT and SAFETY_FAIL_OPEN.
+        """
+        return cls(
+            check,
+            max_workers=int(os.getenv("SAFETY_WORKERS", 8)),
+            window_chars=int(os.getenv("SAFETY_WINDOW_CHARS", 300)),
+            first_window_chars=int(os.getenv("SAFETY_FIRST_WINDOW_CHARS", 80)),
+            policy=os.getenv("SAFETY_POLICY", "hold").lower(),
+            timeout=float(os.getenv("SAFETY_CHECK_TIMEOUT", 5)),
+            fail_open=os.getenv("SAFETY_FAIL_OPEN", "1").lower() not in ("0", "false", "no"),
+        )
+
+    def stream(self) -> "StreamModerator":
+        """Start moderating one answer stream."""
+        with self._lock:
+            self._stats["streams"] += 1
+        return StreamModerator(self)
+
+    def _timed_check(self, text: str, context: str) -> bool:
+        start = time.perf_counter()
+        try:
+            return self.check(text, context)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self._stats["check_ms_total"] += elapsed
+                self._stats["max_check_ms"] = max(self._stats["max_check_ms"], elapsed)
+
+    def _submit(self, text: str, context: str):
+        with self._lock:
+            self._stats["windows"] += 1
+        return self._executor.submit(self._timed_check, text, context), time.time()
+
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        windows = stats["windows"]
+        stats["avg_check_ms"] = round(stats.pop("check_ms_total") / windows, 2) if windows else 0.0
+        stats["max_check_ms"] = round(stats["max_check_ms"], 2)
+        stats.update(policy=self.policy, max_workers=self.max_workers, window_chars=self.window_chars)
+        return stats
+
+
+class StreamModerator:
+    """
+    Per-stream state of a SafetyGate. Feed it answer segments with add(), send the
+    events it returns, and call finish() once generation is done.
+    """
+
+    def __init__(self, gate: SafetyGate):
+        self.gate = gate
+        self.blocked = 0
+        self._open = []        # segments of the window still being filled
+        self._closed = 0       # windows submitted so far
+        self._windows = []     # closed windows not yet settled: {"segments", "start", "future", "submitted"}
+        self._text_chars = 0   # characters of answer text received
+        self._previous = ""    # tail of the preceding text, given to the checker as context
+        self._retracted = []   # (start, end) of retracted windows
+
+    def _close_window(self):
+        text = "".join(self._open)
+        future, submitted = self.gate._submit(text, self._previous)
+        self._windows.append({"segments": self._open, "start": self._text_chars - len(text),
+                              "future": future, "submitted": submitted})
+        self._previous = (self._previous + text)[-300:]
+        self._open = []
+        self._closed += 1
+
+    def add(self, segment: str) -> List[Dict]:
+        """
+        Returns:
+            List[Dict]: SSE payloads that can be sent now
+        """
+        events = []
+        self._open.append(segment)
+        self._text_chars += len(segment)
+        if self.gate.policy == "retract":
+            events.append({"answer": segment})
+
+        size = sum(len(s) for s in self._open)
+        limit = self.gate.window_chars
+        if self.gate.policy == "hold" and not self._closed:
+            limit = self.gate.first_window_chars
+        if (size >= limit and _SENTENCE_END_RE.search(segment)) or size >= 2 * self.gate.window_chars:
+            self._close_window()
+        return events + self._settle(wait=False)
+
+    def finish(self) -> List[Dict]:
+        """
+        Check the last window and wait for every outstanding check (up to the gate timeout).
+        Returns:
+            List[Dict]: Remaining SSE payloads
+        """
+        if self._open:
+            self._close_window()
+        return self._settle(wait=True)
+
+    def _verdict(self, window, wait: bool):
+        """True/False once known, None if still pending and not waiting."""
+        future = window["future"]
+        if not wait and not future.done():
+            if time.time() - window["submitted"] < self.gate.timeout:
+                return None
+        try:
+            remaining = max(self.gate.timeout - (time.time() - window["submitted"]), 0)
+            return bool(future.result(timeout=remaining))
+        except FutureTimeout:
+            self.gate._count("timeouts")
+            print(f"Warning: Safety check timed out after {self.gate.timeout}s")
+        except Exception as e:
+            self.gate._count("errors")
+            print(f"Warning: Safety check failed: {e}")
+        return self.gate.fail_open
+
+    def _settle(self, wait: bool) -> List[Dict]:
+        # Windows are settled in order so held text is released in order
+        events = []
+        while self._windows:
+            window = self._windows[0]
+            safe = self._verdict(window, wait)
+            if safe is None:
+                break
+            self._windows.pop(0)
+            text = "".join(window["segments"])
+            if safe:
+                if self.gate.policy == "hold":
+                    events.append({"answer": text})
+                continue
+            self.blocked += 1
+            self.gate._count("blocked")
+            if self.gate.policy == "hold":
+                events.append({"answer": f"\n\n{BLOCKED_NOTICE}\n\n"})
+            else:
+                self._retracted.append((window["start"], window["start"] + len(text)))
+                events.append({"retract": {"start": window["start"], "end": window["start"] + len(text),
+                                           "replacement": BLOCKED_NOTICE}})
+        return events
+
+    def apply_retractions(self, text: str) -> str:
+        """The sent answer text with every retracted window replaced, as the client shows it."""
+        for start, end in sorted(self._retracted, reverse=True):
+            text = text[:start] + BLOCKED_NOTICE + text[end:]
+        return text
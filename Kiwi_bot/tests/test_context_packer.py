@@ -0,0 +1,79 @@
+import pytest
+
+import context_packer
+from context_packer import ContextPacker
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    # Token counts from the characters / 4 estimate, so budgets do not depend on tiktoken
+    monkeypatch.setattr(context_packer, "tiktoken", None)
+
+
+def chunk(content, pdf_path="public/a.pdf", page=0):
+    return {"content": content, "metadata": {"pdf_path": pdf_path, "page": page}}
+
+
+def render(c):
+    return c["content"]
+
+
+def words(start, count):
+    return " ".join(f"word{i}" for i in range(start, start + count))
+
+
+def test_keeps_input_order_within_budget():
+    packer = ContextPacker(default_budget=1000)
+    chunks = [chunk(words(0, 20)), chunk(words(100, 20), page=1), chunk(words(200, 20), pdf_path="public/b.pdf")]
+    packed, report = packer.pack(chunks, render)
+    assert [c["content"] for c in packed] == [c["content"] for c in chunks]
+    assert report["chunks_packed"] == 3
+    assert report["duplicates_dropped"] == report["over_budget_dropped"] == 0
+
+
+def test_drops_near_duplicates():
+    packer = ContextPacker(default_budget=1000)
+    text = words(0, 30)
+    packed, report = packer.pack([chunk(text), chunk(text + " extra", pdf_path="public/b.pdf")], render)
+    assert len(packed) == 1
+    assert report["duplicates_dropped"] == 1
+
+
+def test_trims_overlap_with_neighbouring_chunk_of_same_pdf():
+    packer = ContextPacker(default_budget=1000)
+    first = words(0, 30)
+    overlap = words(20, 10)
+    second = overlap + " " + words(300, 30)
+    packed, report = packer.pack([chunk(first), chunk(second, page=1)], render)
+    assert len(packed) == 2
+    assert packed[1]["content"] == words(300, 30)
+    assert report["overlap_tokens_trimmed"] > 0
+
+
+def test_overlap_is_not_trimmed_across_pdfs():
+    packer = ContextPacker(default_budget=1000)
+    first = words(0, 30)
+    second = words(20, 10) + " " + words(300, 30)
+    packed, _ = packer.pack([chunk(first), chunk(second, pdf_path="public/b.pdf")], render)
+    assert packed[1]["content"] == second
+
+
+def test_skips_chunks_over_budget_but_packs_later_ones_that_fit():
+    separator_tokens = ContextPacker().count_tokens("\n---\n")
+    big, small = "x" * 400, "y" * 40
+    packer = ContextPacker(default_budget=50 + separator_tokens)
+    packed, report = packer.pack([chunk(big), chunk(small, page=1)], render)
+    assert [c["content"] for c in packed] == [small]
+    assert report["over_budget_dropped"] == 1
+    assert report["tokens_used"] <= 50 + separator_tokens
+
+
+def test_reserved_tokens_and_model_budgets():
+    packer = ContextPacker(default_budget=10, budgets={"big": 1000})
+    chunks = [chunk(words(0, 20))]
+    assert packer.pack(chunks, render)[0] == []
+    packed, report = packer.pack(chunks, render, model="big", reserved_tokens=100)
+    assert len(packed) == 1
+    assert report["budget"] == 1000
+    assert report["tokens_used"] > 100
+    assert packer.pack(chunks, render, model="big", reserved_tokens=1000)[0] == []
@@ -0,0 +1,122 @@
+import pytest
+
+pytest.importorskip("langchain.schema")
+from langchain.schema import AIMessage, HumanMessage, SystemMessage  # noqa: E402
+
+from history_window import SUMMARY_PREFIX, HistoryWindow, build_summary_prompt, format_history  # noqa: E402
+
+
+class FakeChatMemory:
+    def __init__(self):
+        self.messages = []
+
+    def add_user_message(self, text):
+        self.messages.append(HumanMessage(content=text))
+
+    def add_ai_message(self, text):
+        self.messages.append(AIMessage(content=text))
+
+
+class FakeMemory:
+    def __init__(self):
+        self.chat_memory = FakeChatMemory()
+
+
+def window(**kwargs):
+    history_window = HistoryWindow(None, lambda summary, entries: "summary", **kwargs)
+    history_window.schedule_refresh = lambda user_id, memory=None: None
+    return history_window
+
+
+def memory_with_turns(turns, prompt="You are Kiwi."):
+    memory = FakeMemory()
+    memory.chat_memory.messages.append(SystemMessage(content=prompt))
+    for i in range(turns):
+        memory.chat_memory.add_user_message(f"q{i}")
+        memory.chat_memory.add_ai_message(f"a{i}")
+    return memory
+
+
+def contents(memory):
+    return [m.content for m in memory.chat_memory.messages]
+
+
+def test_apply_summary_drops_only_covered_messages():
+    memory = memory_with_turns(5)
+    window(window_turns=1).apply_summary(memory, "first", covered=4)
+    assert contents(memory) == ["You are Kiwi.", SUMMARY_PREFIX + "first", "q2", "a2", "q3", "a3", "q4", "a4"]
+
+
+def test_apply_summary_keeps_unflushed_turns_beyond_the_window():
+    # The database lags memory: only two turns were summarized although four are resident past the window
+    memory = memory_with_turns(6)
+    history_window = window(window_turns=1)
+    history_window.apply_summary(memory, "first", covered=4)
+    history_window.apply_summary(memory, "second", covered=2)
+    assert contents(memory) == ["You are Kiwi.", SUMMARY_PREFIX + "second", "q3", "a3", "q4", "a4", "q5", "a5"]
+    assert history_window.stats()["trimmed_messages"] == 6
+
+
+def test_apply_summary_never_trims_more_than_resident():
+    memory = memory_with_turns(1)
+    window().apply_summary(memory, "s", covered=10)
+    assert contents(memory) == ["You are Kiwi.", SUMMARY_PREFIX + "s"]
+
+
+def test_hydrate_skips_system_entries():
+    memory = FakeMemory()
+    window().hydrate(memory, "earlier", [{"sender": "user", "message": "q"},
+                                         {"sender": "system", "message": "Switched document"},
+                                         {"sender": "bot", "message": "a"}])
+    assert contents(memory) == [SUMMARY_PREFIX + "earlier", "q", "a"]
+
+
+def test_add_turn_schedules_refresh_once_window_overflows():
+    history_window = window(window_turns=1, summarize_after=1)
+    scheduled = []
+    history_window.schedule_refresh = lambda user_id, memory=None: scheduled.append(user_id)
+    memory = memory_with_turns(1)
+    history_window.add_turn("u1", memory, "q1", "a1")
+    assert scheduled == []
+    history_window.add_turn("u1", memory, "q2", "a2")
+    assert scheduled == ["u1"]
+
+
+def test_format_history_includes_summary_and_last_turns():
+    memory = memory_with_turns(3)
+    window().apply_summary(memory, "s", covered=0)
+    assert format_history(memory, 1) == SUMMARY_PREFIX + "s\nUser: q2\nAssistant: a2"
+
+
+def test_summary_prompt_includes_previous_summary_and_entries():
+    prompt = build_summary_prompt("before", [{"sender": "user", "message": "x" * 5000}])
+    assert "Current summary:\nbefore" in prompt
+    assert "user: " + "x" * 2000 + "\n" in prompt + "\n"
+    assert "x" * 2001 not in prompt
+
+
+def test_failing_refreshes_still_cap_resident_turns():
+    history_window = window(window_turns=1, summarize_after=1, max_resident_turns=3)
+    memory = memory_with_turns(0)
+    for i in range(10):
+        history_window.add_turn("u1", memory, f"q{i}", f"a{i}")
+    assert contents(memory) == ["You are Kiwi.", "q7", "a7", "q8", "a8", "q9", "a9"]
+    assert history_window.stats()["capped_messages"] == 14
+
+
+def test_summary_after_cap_does_not_trim_capped_messages_twice():
+    history_window = window(window_turns=1, summarize_after=1, max_resident_turns=3)
+    memory = memory_with_turns(0)
+    for i in range(5):
+        history_window.add_turn("u1", memory, f"q{i}", f"a{i}")
+    # q0..a1 were capped; a refresh folding turns 0-2 only trims q2 and a2 from memory
+    history_window.apply_summary(memory, "s", covered=6, user_id="u1")
+    assert contents(memory) == ["You are Kiwi.", SUMMARY_PREFIX + "s", "q3", "a3", "q4", "a4"]
+
+
+def test_hydrate_caps_a_session_that_was_never_summarized():
+    history_window = window(window_turns=1, summarize_after=1, max_resident_turns=2)
+    memory = FakeMemory()
+    session = [{"sender": sender, "message": f"{sender}{i}"} for i in range(10) for sender in ("user", "bot")]
+    history_window.hydrate(memory, None, session, user_id="u1")
+    assert contents(memory) == ["user8", "bot8", "user9", "bot9"]
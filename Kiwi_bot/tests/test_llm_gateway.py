@@ -0,0 +1,164 @@
+import asyncio
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+
+from llm_gateway import LLMBusy, LLMGateway, LLMTimeout
+
+
+class FakeModel:
+    """Chat model stand-in: optional failures first, then a reply or chunks with delays."""
+
+    def __init__(self, reply="ok", delay=0.0, failures=0, first_delay=0.0, gap=0.0, chunks=3):
+        self.reply = reply
+        self.delay = delay
+        self.failures = failures
+        self.first_delay = first_delay
+        self.gap = gap
+        self.chunks = chunks
+        self.timeouts = []
+
+    def _maybe_fail(self):
+        if self.failures:
+            self.failures -= 1
+            raise openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/chat"))
+
+    def invoke(self, prompt, timeout=None, **kwargs):
+        self.timeouts.append(timeout)
+        self._maybe_fail()
+        time.sleep(self.delay)
+        return self.reply
+
+    def stream(self, prompt, timeout=None, **kwargs):
+        self.timeouts.append(timeout)
+        self._maybe_fail()
+        time.sleep(self.first_delay)
+        for i in range(self.chunks):
+            if i:
+                time.sleep(self.gap)
+            yield i
+
+    async def astream(self, prompt, timeout=None, **kwargs):
+        self.timeouts.append(timeout)
+        self._maybe_fail()
+        await asyncio.sleep(self.first_delay)
+        for i in range(self.chunks):
+            if i:
+                await asyncio.sleep(self.gap)
+            yield i
+
+
+def hold_slot(gateway, route, seconds):
+    """Occupy one slot of the route's pool from another thread."""
+    thread = threading.Thread(target=gateway.invoke, args=(FakeModel(delay=seconds), "p"), kwargs={"route": route})
+    thread.start()
+    time.sleep(0.05)
+    return thread
+
+
+def collect(gateway, model, **kwargs):
+    async def run():
+        return [chunk async for chunk in gateway.astream(model, "p", **kwargs)]
+    return asyncio.run(run())
+
+
+def test_invoke_passes_remaining_deadline_to_model():
+    gateway = LLMGateway(timeout=5)
+    model = FakeModel()
+    assert gateway.invoke(model, "p") == "ok"
+    assert 0 < model.timeouts[0] <= 5
+
+
+def test_retries_transient_errors():
+    gateway = LLMGateway(backoff_base=0.01, max_retries=2)
+    model = FakeModel(failures=2)
+    assert gateway.invoke(model, "p", route="query") == "ok"
+    assert gateway.stats()["routes"]["query"]["retries"] == 2
+
+
+def test_gives_up_after_max_retries():
+    gateway = LLMGateway(backoff_base=0.01, max_retries=1)
+    with pytest.raises(openai.APIConnectionError):
+        gateway.invoke(FakeModel(failures=5), "p")
+    assert gateway.stats()["routes"]["default"]["errors"] == 1
+
+
+def test_slot_wait_is_bounded_by_deadline():
+    gateway = LLMGateway(max_concurrency=1, queue_timeout=10, reserved_routes={})
+    holder = hold_slot(gateway, "default", 0.6)
+    start = time.monotonic()
+    with pytest.raises(LLMTimeout):
+        gateway.invoke(FakeModel(), "p", timeout=0.2)
+    assert time.monotonic() - start < 0.5
+    holder.join()
+    assert gateway.stats()["routes"]["default"]["timeouts"] == 1
+
+
+def test_queue_timeout_raises_busy():
+    gateway = LLMGateway(max_concurrency=1, queue_timeout=0.1, reserved_routes={})
+    holder = hold_slot(gateway, "default", 0.4)
+    with pytest.raises(LLMBusy):
+        gateway.invoke(FakeModel(), "p", timeout=5)
+    holder.join()
+
+
+def test_reserved_route_does_not_wait_for_global_pool():
+    gateway = LLMGateway(max_concurrency=1, queue_timeout=0.1, reserved_routes={"safety": 1})
+    holder = hold_slot(gateway, "default", 0.4)
+    assert gateway.invoke(FakeModel(), "p", route="safety") == "ok"
+    holder.join()
+
+
+def test_streams_use_their_own_pool():
+    gateway = LLMGateway(max_concurrency=1, queue_timeout=0.1, stream_concurrency=1, reserved_routes={})
+    holder = hold_slot(gateway, "default", 0.4)
+    assert list(gateway.stream(FakeModel(), "p", route="query")) == [0, 1, 2]
+    holder.join()
+    assert gateway.stats()["stream_concurrency"] == 1
+
+
+def test_stream_may_outlast_its_first_token_deadline():
+    gateway = LLMGateway(timeout=0.2, stream_idle_timeout=0.2)
+    model = FakeModel(gap=0.1, chunks=5)
+    assert list(gateway.stream(model, "p")) == [0, 1, 2, 3, 4]
+    assert collect(gateway, model) == [0, 1, 2, 3, 4]
+    assert model.timeouts[0] <= 0.2
+
+
+def test_astream_times_out_before_first_chunk():
+    gateway = LLMGateway(timeout=0.1, stream_idle_timeout=1)
+    with pytest.raises(LLMTimeout, match="first-token"):
+        collect(gateway, FakeModel(first_delay=0.5))
+    assert gateway.stats()["routes"]["default"]["timeouts"] == 1
+
+
+def test_astream_times_out_on_idle_gap():
+    gateway = LLMGateway(timeout=1, stream_idle_timeout=0.1)
+    with pytest.raises(LLMTimeout, match="stalled"):
+        collect(gateway, FakeModel(gap=0.5))
+
+
+def test_astream_retries_before_first_chunk():
+    gateway = LLMGateway(backoff_base=0.01)
+    assert collect(gateway, FakeModel(failures=1)) == [0, 1, 2]
+    assert gateway.stats()["routes"]["default"]["retries"] == 1
+
+
+def test_hedged_invoke_past_deadline_raises_llm_timeout():
+    gateway = LLMGateway(hedge_after=5)
+    with pytest.raises(LLMTimeout):
+        gateway.invoke(FakeModel(delay=0.5), "p", timeout=0.1)
+    assert gateway.stats()["routes"]["default"]["timeouts"] == 1
+
+
+def test_hedge_returns_the_faster_call():
+    gateway = LLMGateway(hedge_after=0.05)
+    slow_then_fast = FakeModel()
+    delays = iter([0.5, 0.0])
+    slow_then_fast.invoke = lambda prompt, timeout=None, **kwargs: time.sleep(next(delays)) or "ok"
+    assert gateway.invoke(slow_then_fast, "p") == "ok"
+    stats = gateway.stats()["routes"]["default"]
+    assert (stats["hedges"], stats["hedge_wins"]) == (1, 1)
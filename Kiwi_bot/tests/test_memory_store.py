@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+from memory_store import UserMemoryStore
+
+
+def entry(size=100):
+    return {"size": size, "personalized_prompt": ""}
+
+
+def store(**kwargs):
+    kwargs.setdefault("size_of", lambda e: e["size"])
+    return UserMemoryStore(**kwargs)
+
+
+def test_evicts_least_recently_used_beyond_max_users():
+    memories = store(max_users=2)
+    memories.put("a", entry())
+    memories.put("b", entry())
+    assert memories.get("a") is not None  # "b" is now the least recently used
+    memories.put("c", entry())
+    assert "a" in memories and "c" in memories and "b" not in memories
+    assert memories.stats()["evicted_capacity"] == 1
+
+
+def test_evicts_by_byte_budget_but_never_the_new_entry():
+    memories = store(max_bytes=250)
+    memories.put("a", entry(100))
+    memories.put("b", entry(100))
+    memories.put("c", entry(100))
+    assert "a" not in memories and len(memories) == 2
+    memories.put("huge", entry(1000))
+    assert "huge" in memories and len(memories) == 1
+    stats = memories.stats()
+    assert stats["evicted_bytes"] == 3
+    assert stats["resident_bytes"] == 1000
+
+
+def test_touch_re_estimates_size():
+    memories = store(max_bytes=250)
+    a, b = entry(100), entry(100)
+    memories.put("a", a)
+    memories.put("b", b)
+    b["size"] = 200
+    memories.touch("b")
+    assert "a" not in memories and "b" in memories
+    assert memories.stats()["resident_bytes"] == 200
+
+
+def test_sweep_evicts_idle_entries():
+    memories = store(idle_seconds=60)
+    memories.put("idle", entry())
+    memories.put("active", entry())
+    memories.get("idle")["last_access"] = datetime.utcnow() - timedelta(seconds=120)
+    assert memories.sweep() == 1
+    assert "idle" not in memories and "active" in memories
+
+
+def test_hits_and_misses():
+    memories = store()
+    memories.put("a", entry())
+    memories.get("a")
+    memories.get("missing")
+    assert memories.pop("a") is not None
+    stats = memories.stats()
+    assert (stats["hits"], stats["misses"], stats["resident_users"]) == (1, 1, 0)
@@ -0,0 +1,48 @@
+from mmr import apply_distance_cutoff, mmr_select
+
+
+def chunk(name, embedding=None, distance=None, **metadata):
+    metadata["distance"] = distance
+    return {"content": name, "embedding": embedding, "metadata": metadata}
+
+
+def names(chunks):
+    return [c["content"] for c in chunks]
+
+
+def test_pure_relevance_orders_by_similarity():
+    chunks = [chunk("far", [0.0, 1.0]), chunk("near", [1.0, 0.0]), chunk("mid", [1.0, 1.0])]
+    assert names(mmr_select([1.0, 0.0], chunks, k=3, lambda_mult=1.0)) == ["near", "mid", "far"]
+
+
+def test_diversity_skips_duplicate_of_selected_chunk():
+    chunks = [
+        chunk("a", [1.0, 0.0, 0.0]),
+        chunk("a-copy", [1.0, 0.0, 0.0]),
+        chunk("b", [0.7, 0.7, 0.0]),
+    ]
+    assert names(mmr_select([1.0, 0.2, 0.0], chunks, k=2, lambda_mult=0.5)) == ["a", "b"]
+
+
+def test_k_bounds():
+    chunks = [chunk("a", [1.0, 0.0]), chunk("b", [0.0, 1.0])]
+    assert mmr_select([1.0, 0.0], chunks, k=0) == []
+    assert len(mmr_select([1.0, 0.0], chunks, k=5)) == 2
+    assert mmr_select([1.0, 0.0], chunks[:1], k=3) == chunks[:1]
+
+
+def test_zero_vectors_do_not_fail():
+    chunks = [chunk("zero", [0.0, 0.0]), chunk("a", [1.0, 0.0])]
+    assert names(mmr_select([0.0, 0.0], chunks, k=2)) == ["zero", "a"]
+
+
+def test_distance_cutoff_stops_at_first_far_chunk():
+    chunks = [chunk("a", distance=0.1), chunk("b", distance=0.5), chunk("c", distance=0.2)]
+    assert names(apply_distance_cutoff(chunks, 0.3)) == ["a"]
+    assert apply_distance_cutoff(chunks, None) == chunks
+
+
+def test_distance_cutoff_filters_fused_results():
+    chunks = [chunk("a", distance=0.5, rrf_score=0.03), chunk("b", distance=0.1, rrf_score=0.02),
+              chunk("text-only", rrf_score=0.01)]
+    assert names(apply_distance_cutoff(chunks, 0.3)) == ["b", "text-only"]
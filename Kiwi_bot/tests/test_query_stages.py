@@ -0,0 +1,44 @@
+import threading
+import time
+
+from query_stages import StageRunner
+
+
+def test_returns_stage_result():
+    runner = StageRunner(max_workers=2, timeouts={"page": 1})
+    assert runner.result(runner.submit("page", lambda: "content")) == "content"
+    assert runner.stats()["stages"]["page"]["ok"] == 1
+
+
+def test_timeout_and_error_yield_default():
+    runner = StageRunner(max_workers=2, timeouts={"slow": 0.05, "broken": 1})
+    assert runner.result(runner.submit("slow", time.sleep, 0.3), default="none") == "none"
+
+    def fail():
+        raise RuntimeError("db down")
+    assert runner.result(runner.submit("broken", fail), default="none") == "none"
+    stages = runner.stats()["stages"]
+    assert (stages["slow"]["timeouts"], stages["broken"]["errors"]) == (1, 1)
+
+
+def test_queue_wait_does_not_count_against_the_timeout():
+    runner = StageRunner(max_workers=1, timeouts={"busy": 5, "page": 0.3})
+    blocker = runner.submit("busy", time.sleep, 0.2)
+    page = runner.submit("page", lambda: time.sleep(0.2) or "content")
+    # Queued for 0.2s and running for 0.2s: over 0.3s in total, but within it from the start
+    assert runner.result(page) == "content"
+    runner.result(blocker)
+
+
+def test_stage_still_queued_after_its_timeout_is_cancelled():
+    runner = StageRunner(max_workers=1, timeouts={"busy": 5, "page": 0.05})
+    release = threading.Event()
+    blocker = runner.submit("busy", release.wait)
+    ran = []
+    page = runner.submit("page", ran.append, True)
+    assert runner.result(page, default="none") == "none"
+    release.set()
+    runner.result(blocker)
+    time.sleep(0.05)
+    assert ran == []
+    assert runner.stats()["stages"]["page"]["not_started"] == 1
@@ -0,0 +1,48 @@
+import pytest
+
+from quiz_bank import answer_letter, to_quiz_mode
+from quiz_generation import normalize_difficulty
+
+OPTIONS = ["A. Paris", "B. Rome", "C. Oslo", "D. Bern"]
+
+
+@pytest.mark.parametrize("correct, letter", [
+    ("B", "B"),
+    ("b", "B"),
+    ("Option D", "D"),
+    ("C. Oslo", "C"),
+    ("C) Oslo", "C"),
+    ("Rome", "B"),
+    ("Answer: B", "B"),
+    ("answer - c", "C"),
+    ("Correct answer: D", "D"),
+    ("Correct Answer:A) Paris", "A"),
+    ("Answer: Oslo", "C"),
+])
+def test_answer_letter(correct, letter):
+    assert answer_letter({"correctAnswer": correct, "options": OPTIONS}) == letter
+
+
+def test_answer_letter_falls_back_to_answer_field_and_raw_text():
+    assert answer_letter({"answer": "B", "options": OPTIONS}) == "B"
+    assert answer_letter({"correctAnswer": "42", "options": OPTIONS}) == "42"
+
+
+def test_options_without_letters_match_by_text():
+    assert answer_letter({"correctAnswer": "Oslo", "options": ["Paris", "Rome", "Oslo"]}) == "C"
+
+
+def test_to_quiz_mode():
+    question = {"question": "Capital of Italy?", "options": OPTIONS, "correctAnswer": "Answer: B",
+                "explanation": "Rome is the capital."}
+    assert to_quiz_mode(question) == {"question": "Capital of Italy?", "options": OPTIONS, "answer": "B",
+                                      "explanation": "Rome is the capital."}
+    del question["explanation"]
+    assert to_quiz_mode(question)["explanation"] == ""
+
+
+@pytest.mark.parametrize("value, difficulty", [
+    (None, "medium"), ("", "medium"), ("HARD", "hard"), (" easy ", "easy"), ("extreme", "medium"), (3, "medium"),
+])
+def test_normalize_difficulty(value, difficulty):
+    assert normalize_difficulty(value) == difficulty
@@ -0,0 +1,46 @@
+import json
+
+from quiz_generation import is_duplicate, parse_quiz_questions, split_chunk_groups
+
+
+def question(text="What does a mitochondrion produce?", **fields):
+    return {"question": text, "options": ["A. ATP", "B. DNA", "C. RNA", "D. Lipids"], "correctAnswer": "A",
+            "explanation": "Cellular respiration.", **fields}
+
+
+def test_parses_json_array():
+    questions = [question(), question("Where is DNA stored?")]
+    assert parse_quiz_questions(json.dumps(questions)) == questions
+
+
+def test_ignores_code_fences_and_surrounding_text():
+    text = "Here are your questions:\n```json\n" + json.dumps([question()]) + "\n```\nGood luck!"
+    assert parse_quiz_questions(text) == [question()]
+
+
+def test_truncated_last_question_only_loses_that_question():
+    text = json.dumps([question(), question("Where is DNA stored?")])
+    assert parse_quiz_questions(text[:-40]) == [question()]
+
+
+def test_skips_invalid_entries():
+    missing_answer = {k: v for k, v in question("No answer?").items() if k != "correctAnswer"}
+    one_option = question("One option?", options=["A. Only"])
+    text = json.dumps([missing_answer, one_option, question()])
+    assert parse_quiz_questions(text) == [question()]
+
+
+def test_no_json_returns_empty_list():
+    assert parse_quiz_questions("Sorry, I cannot help with that.") == []
+
+
+def test_duplicate_detection_by_word_overlap():
+    accepted = [question("What does a mitochondrion produce in the cell?")]
+    assert is_duplicate(question("What does a mitochondrion produce in the cell"), accepted)
+    assert not is_duplicate(question("Where is DNA stored in the cell?"), accepted)
+    assert is_duplicate(question("?"), accepted)
+
+
+def test_chunk_groups_are_dealt_round_robin():
+    assert split_chunk_groups(list(range(5)), 2) == [[0, 2, 4], [1, 3]]
+    assert split_chunk_groups([0], 4) == [[0]]
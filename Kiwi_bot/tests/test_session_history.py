@@ -0,0 +1,80 @@
+import session_history
+from session_history import append_session_batch, merge_turns, message_entry
+
+
+def entries(*messages, timestamp="2025-01-01T00:00:00"):
+    return [message_entry(sender, text, timestamp) for sender, text in messages]
+
+
+def test_merge_keeps_turn_order_per_user():
+    turns = [
+        ("u1", "a.pdf", entries(("user", "q1"), ("bot", "a1"))),
+        ("u2", "b.pdf", entries(("user", "x"), ("bot", "y"))),
+        ("u1", "a.pdf", entries(("user", "q2"), ("bot", "a2"))),
+    ]
+    merged = merge_turns(turns)
+    assert merged["u1"][:2] == ["a.pdf", "a.pdf"]
+    assert [e["message"] for e in merged["u1"][2]] == ["q1", "a1", "q2", "a2"]
+    assert [e["message"] for e in merged["u2"][2]] == ["x", "y"]
+
+
+def test_merge_adds_switch_entry_between_turns_on_different_pdfs():
+    turns = [
+        ("u1", "a.pdf", entries(("user", "q1"), ("bot", "a1"))),
+        ("u1", "b.pdf", entries(("user", "q2"), ("bot", "a2"), timestamp="2025-01-01T00:01:00")),
+        ("u1", "b.pdf", entries(("user", "q3"), ("bot", "a3"))),
+    ]
+    first_pdf, last_pdf, merged = merge_turns(turns)["u1"]
+    assert (first_pdf, last_pdf) == ("a.pdf", "b.pdf")
+    assert [e["sender"] for e in merged] == ["user", "bot", "system", "user", "bot", "user", "bot"]
+    switch = merged[2]
+    assert switch["message"] == "Switched document: from a.pdf to b.pdf"
+    # The switch is stamped with the time of the turn that caused it
+    assert switch["timestamp"] == "2025-01-01T00:01:00"
+
+
+def test_merge_does_not_mutate_input_entries():
+    first = entries(("user", "q1"))
+    merge_turns([("u1", "a.pdf", first), ("u1", "b.pdf", entries(("user", "q2")))])
+    assert len(first) == 1
+
+
+class FakeCursor:
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        self.statements.append((sql, params))
+
+
+def test_batch_appends_existing_sessions_and_creates_missing_ones(monkeypatch):
+    calls = []
+
+    def fake_execute_values(cursor, sql, rows, template=None, page_size=100, fetch=False):
+        calls.append((sql, rows))
+        if fetch:
+            # Only u1 has an active session
+            return [(row[0], "s1", 7) for row in rows if row[0] == "u1"]
+
+    monkeypatch.setattr(session_history, "execute_values", fake_execute_values)
+    cursor = FakeCursor()
+    turns = [("u2", "b.pdf", entries(("user", "x"), ("bot", "y"))), ("u1", "a.pdf", entries(("user", "q")))]
+    results = append_session_batch(cursor, turns)
+
+    append, retry, insert = calls
+    assert [row[0] for row in append[1]] == ["u1", "u2"]  # sorted, so sessions are locked in one order
+    assert [row[0] for row in retry[1]] == ["u2"]
+    assert "pg_advisory_xact_lock" in cursor.statements[0][0]
+    assert cursor.statements[0][1] == (["u2"],)
+    assert "INSERT INTO" in insert[0]
+    session_id, user_id, pdf_name, _, count, _ = insert[1][0]
+    assert (user_id, pdf_name, count) == ("u2", "b.pdf", 2)
+    assert results == {"u1": ("s1", 7, False), "u2": (session_id, 2, True)}
+
+
+def test_batch_without_missing_users_takes_no_lock(monkeypatch):
+    monkeypatch.setattr(session_history, "execute_values",
+                        lambda cursor, sql, rows, **kwargs: [(row[0], "s1", 3) for row in rows])
+    cursor = FakeCursor()
+    assert append_session_batch(cursor, [("u1", "a.pdf", entries(("user", "q")))]) == {"u1": ("s1", 3, False)}
+    assert cursor.statements == []
@@ -0,0 +1,77 @@
+import psycopg2
+
+from session_writer import SessionWriter
+
+
+class FakeDatabase:
+    """Records written batches; fails the first `failures` writes and rejects turns of `rejected_users`."""
+
+    def __init__(self, failures=0, rejected_users=()):
+        self.failures = failures
+        self.rejected_users = set(rejected_users)
+        self.batches = []
+
+    def write(self, turns):
+        if self.failures:
+            self.failures -= 1
+            raise psycopg2.OperationalError("connection lost")
+        if any(turn[0] in self.rejected_users for turn in turns):
+            raise psycopg2.IntegrityError("unknown user")
+        self.batches.append([turn[0] for turn in turns])
+
+
+def writer(database, **kwargs):
+    kwargs.setdefault("retry_backoff", 0)
+    session_writer = SessionWriter(None, **kwargs)
+    session_writer._write = database.write
+    return session_writer
+
+
+def turn(user_id):
+    return (user_id, "a.pdf", [{"sender": "user", "message": "q"}, {"sender": "bot", "message": "a"}])
+
+
+def test_retries_failed_batch():
+    database = FakeDatabase(failures=2)
+    session_writer = writer(database, max_retries=3)
+    session_writer.flush([turn("u1"), turn("u2")])
+    assert database.batches == [["u1", "u2"]]
+    stats = session_writer.stats()
+    assert (stats["retries"], stats["written"], stats["batches"]) == (2, 2, 1)
+
+
+def test_drops_batch_after_max_retries():
+    database = FakeDatabase(failures=5)
+    session_writer = writer(database, max_retries=3)
+    session_writer.flush([turn("u1"), turn("u2")])
+    assert database.batches == []
+    assert session_writer.stats()["dropped_failed"] == 2
+
+
+def test_rejected_batch_is_written_per_user():
+    database = FakeDatabase(rejected_users={"bad"})
+    session_writer = writer(database)
+    session_writer.flush([turn("u1"), turn("bad"), turn("u2"), turn("u1")])
+    assert sorted(database.batches) == [["u1", "u1"], ["u2"]]
+    stats = session_writer.stats()
+    assert (stats["written"], stats["rejected"]) == (3, 1)
+
+
+def test_submitted_turns_are_written_in_batches_on_close():
+    database = FakeDatabase()
+    session_writer = writer(database, batch_size=2, flush_interval=0.01)
+    for user_id in ("u1", "u2", "u3"):
+        assert session_writer.submit(user_id, "a.pdf", "q", "a")
+    session_writer.close(timeout=5)
+    assert [user for batch in database.batches for user in batch] == ["u1", "u2", "u3"]
+    assert all(len(batch) <= 2 for batch in database.batches)
+    assert not session_writer.submit("u4", "a.pdf", "q", "a")
+    assert session_writer.stats()["dropped_closed"] == 1
+
+
+def test_full_queue_drops_turns():
+    session_writer = writer(FakeDatabase(), max_queue=1)
+    session_writer.start = lambda: None  # keep the turn queued
+    assert session_writer.submit("u1", "a.pdf", "q", "a")
+    assert not session_writer.submit("u2", "a.pdf", "q", "a")
+    assert session_writer.stats()["dropped_full"] == 1
@@ -0,0 +1,76 @@
+import pytest
+
+import stream_coalescer
+from stream_coalescer import StreamStats, TokenCoalescer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(stream_coalescer.time, "perf_counter", fake)
+    return fake
+
+
+def test_first_visible_text_is_sent_immediately(clock):
+    coalescer = TokenCoalescer(flush_interval_ms=50, flush_bytes=256)
+    assert coalescer.add("") is None
+    assert coalescer.add(" ") is None  # whitespace is held back with the next text
+    assert coalescer.add("Hello") == " Hello"
+
+
+def test_size_triggered_flush(clock):
+    coalescer = TokenCoalescer(flush_interval_ms=1000, flush_bytes=10)
+    coalescer.add("Hi")
+    assert coalescer.add("abcd") is None
+    assert coalescer.add("efghij") == "abcdefghij"
+    # Bytes, not characters: two 3-byte characters and four more bytes reach the limit
+    assert coalescer.add("日本") is None
+    assert coalescer.add("abcd") == "日本abcd"
+
+
+def test_interval_triggered_flush(clock):
+    coalescer = TokenCoalescer(flush_interval_ms=50, flush_bytes=256)
+    coalescer.add("Hi")
+    clock.now += 0.01
+    assert coalescer.add(" there") is None
+    clock.now += 0.05
+    assert coalescer.add(",") == " there,"
+    assert coalescer.summary()["max_write_gap_ms"] == pytest.approx(60, abs=0.01)
+
+
+def test_final_flush_returns_the_rest(clock):
+    coalescer = TokenCoalescer(flush_interval_ms=1000, flush_bytes=256)
+    coalescer.add("Hi")
+    coalescer.add(" the")
+    coalescer.add(" end")
+    assert coalescer.flush() == " the end"
+    assert coalescer.flush() is None
+    summary = coalescer.summary()
+    assert (summary["tokens"], summary["writes"], summary["tokens_per_write"]) == (3, 2, 1.5)
+
+
+def test_final_flush_drops_trailing_whitespace_only_buffer(clock):
+    coalescer = TokenCoalescer()
+    coalescer.add("Hi")
+    coalescer.add("\n")
+    assert coalescer.flush() is None
+
+
+def test_stream_stats_aggregate(clock):
+    stats = StreamStats()
+    for _ in range(2):
+        coalescer = TokenCoalescer()
+        clock.now += 0.02
+        coalescer.add("Hi")
+        stats.record(coalescer.summary())
+    totals = stats.stats()
+    assert (totals["streams"], totals["writes"]) == (2, 2)
+    assert totals["avg_first_write_ms"] == pytest.approx(20, abs=0.01)
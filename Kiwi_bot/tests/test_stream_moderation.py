@@ -0,0 +1,94 @@
+import threading
+
+import pytest
+
+from stream_moderation import BLOCKED_NOTICE, SafetyGate
+
+
+def flag(word):
+    """Checker that fails windows containing word."""
+    return lambda text, context: word not in text
+
+
+def run(gate, segments):
+    moderator = gate.stream()
+    events = []
+    for segment in segments:
+        events.extend(moderator.add(segment))
+    events.extend(moderator.finish())
+    return moderator, events
+
+
+def answer_text(events):
+    return "".join(e["answer"] for e in events if "answer" in e)
+
+
+SEGMENTS = ["The cell has a nucleus. ", "This part is bad advice. ", "Mitochondria make ATP."]
+
+
+def test_hold_replaces_flagged_window_with_notice():
+    gate = SafetyGate(flag("bad"), window_chars=10, first_window_chars=10, policy="hold")
+    moderator, events = run(gate, SEGMENTS)
+    assert answer_text(events) == SEGMENTS[0] + f"\n\n{BLOCKED_NOTICE}\n\n" + SEGMENTS[2]
+    assert not any("retract" in e for e in events)
+    assert moderator.blocked == 1
+    assert gate.stats()["blocked"] == 1
+
+
+def test_retract_sends_text_then_retracts_flagged_range():
+    gate = SafetyGate(flag("bad"), window_chars=10, policy="retract")
+    moderator, events = run(gate, SEGMENTS)
+    assert answer_text(events) == "".join(SEGMENTS)
+    retractions = [e["retract"] for e in events if "retract" in e]
+    start = len(SEGMENTS[0])
+    assert retractions == [{"start": start, "end": start + len(SEGMENTS[1]), "replacement": BLOCKED_NOTICE}]
+    # The saved answer is the text as the client shows it after the retraction
+    assert moderator.apply_retractions(answer_text(events)) == SEGMENTS[0] + BLOCKED_NOTICE + SEGMENTS[2]
+
+
+def test_retractions_apply_from_the_end_so_ranges_stay_valid():
+    gate = SafetyGate(flag("bad"), window_chars=5, policy="retract")
+    segments = ["bad one. ", "fine. ", "bad two. "]
+    moderator, events = run(gate, segments)
+    assert moderator.apply_retractions(answer_text(events)) == BLOCKED_NOTICE + "fine. " + BLOCKED_NOTICE
+
+
+@pytest.mark.parametrize("fail_open, released", [(True, True), (False, False)])
+def test_failing_check_follows_fail_open(fail_open, released):
+    def broken(text, context):
+        raise RuntimeError("moderation API down")
+
+    gate = SafetyGate(broken, window_chars=10, first_window_chars=10, fail_open=fail_open)
+    _, events = run(gate, SEGMENTS)
+    assert (answer_text(events) == "".join(SEGMENTS)) is released
+    assert gate.stats()["errors"] == len(SEGMENTS)
+
+
+def test_held_windows_are_released_in_order():
+    # The first window's check finishes last; later windows wait for it
+    first_done = threading.Event()
+
+    def check(text, context):
+        if text.startswith("one"):
+            first_done.wait(0.2)
+        else:
+            first_done.set()
+        return True
+
+    gate = SafetyGate(check, window_chars=5, first_window_chars=5)
+    segments = ["one. ", "two. ", "three. ", "four. "]
+    _, events = run(gate, segments)
+    assert [e["answer"] for e in events] == segments
+
+
+def test_context_of_a_window_is_the_preceding_text():
+    contexts = []
+    gate = SafetyGate(lambda text, context: contexts.append(context) or True, max_workers=1,
+                      window_chars=5, first_window_chars=5)
+    run(gate, ["one. ", "two. "])
+    assert contexts == ["", "one. "]
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        SafetyGate(flag("bad"), policy="drop")
@@ -0,0 +1,281 @@
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+def parse_vector(text: str) -> np.ndarray:
+    """
+    Parse pgvector's text representation '[0.1,0.2,...]' into a float32 array
+    """
+    return np.fromstring(text.strip()[1:-1], sep=",", dtype=np.float32)
+
+
+class _Snapshot:
+    """
+    Immutable view of the index. Rows are grouped by pdfPath so every PDF
+    occupies one contiguous row range of the matrix.
+    """
+
+    def __init__(self, matrix, ids, contents, pages, names, paths, created):
+        self.matrix = matrix          # (n, dim) float32, unit-normalized rows
+        self.ids = ids
+        self.contents = contents
+        self.pages = pages
+        self.names = names
+        self.paths = paths
+        self.created = created
+        self.ranges = {}              # pdfPath -> (start, end)
+        self.page_rows = {}           # (pdfPath, pageNumber) -> first row
+        start = 0
+        for i in range(1, len(paths) + 1):
+            if i == len(paths) or paths[i] != paths[start]:
+                self.ranges[paths[start]] = (start, i)
+                start = i
+        for i, key in enumerate(zip(paths, pages)):
+            self.page_rows.setdefault(key, i)
+        self.watermark = max(created) if created else None
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class InMemoryVectorIndex:
+    """
+    Exact cosine-similarity search over all PdfChunk embeddings held in a
+    contiguous float32 NumPy matrix. Answers the same current-PDF / other-PDF
+    top-k queries as the pgvector path without a database round trip.
+    """
+
+    _COLUMNS = 'id, content, "pageNumber", "pdfName", "pdfPath", embedding::text, "createdAt"'
+
+    def __init__(self, pool, refresh_interval: float = 60.0):
+        """
+        Args:
+            pool (ConnectionPool): Pool used to load and refresh rows
+            refresh_interval (float): Seconds between background change checks; 0 disables the refresher
+        """
+        self.pool = pool
+        self.refresh_interval = refresh_interval
+        self._snapshot: Optional[_Snapshot] = None
+        self._refresh_lock = threading.Lock()
+        self._refresher = None
+        self._stop = threading.Event()
+        self._stats = {"full_loads": 0, "incremental_refreshes": 0, "rows_added": 0, "searches": 0,
+                       "last_load_seconds": 0.0, "last_refresh_at": None}
+
+    @property
+    def ready(self) -> bool:
+        return self._snapshot is not None
+
+    # ---------- Loading ----------
+
+    @classmethod
+    def _build(cls, rows) -> _Snapshot:
+        """Build a snapshot from database rows whose embedding column is pgvector text."""
+        return cls._build_from_arrays([r[:5] + (parse_vector(r[5]), r[6]) for r in rows])
+
+    @staticmethod
+    def _build_from_arrays(rows) -> _Snapshot:
+        # Group by path (stable, so page order within a PDF is kept)
+        rows = sorted(rows, key=lambda r: (r[4] is None, r[4] or "", r[2], r[6]))
+        if rows:
+            matrix = np.vstack([r[5] for r in rows]).astype(np.float32, copy=False)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            matrix = np.ascontiguousarray(matrix / norms)
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        return _Snapshot(
+            matrix,
+            ids=[r[0] for r in rows],
+            contents=[r[1] for r in rows],
+            pages=[r[2] for r in rows],
+            names=[r[3] for r in rows],
+            paths=[r[4] for r in rows],
+            created=[r[6] for r in rows],
+        )
+
+    @staticmethod
+    def _rows_of(snapshot: _Snapshot) -> List[Tuple]:
+        # Rebuild raw rows from a snapshot; embeddings are kept normalized, which is fine for cosine
+        return [
+            (snapshot.ids[i], snapshot.contents[i], snapshot.pages[i], snapshot.names[i],
+             snapshot.paths[i], snapshot.matrix[i], snapshot.created[i])
+            for i in range(len(snapshot))
+        ]
+
+    def load(self) -> int:
+        """
+        Load every PdfChunk row into memory, replacing the current snapshot.
+        Returns:
+            int: Number of rows loaded
+        """
+        start = time.time()
+        with self._refresh_lock:
+            with self.pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(f'SELECT {self._COLUMNS} FROM "PdfChunk"')
+                rows = cursor.fetchall()
+            self._snapshot = self._build(rows)
+            self._stats["full_loads"] += 1
+            self._stats["last_load_seconds"] = round(time.time() - start, 3)
+            self._stats["last_refresh_at"] = time.time()
+        print(f"In-memory vector index loaded {len(rows)} chunks in {time.time() - start:.2f} seconds")
+        return len(rows)
+
+    def refresh(self) -> int:
+        """
+        Pick up chunks inserted since the last load (e.g. by pdf_embedding_2.py).
+        Falls back to a full reload when rows were deleted or replaced.
+        Returns:
+            int: Number of rows added
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self.load()
+
+        with self._refresh_lock:
+            with self.pool.connection() as conn, conn.cursor() as cursor:
+                cursor.execute('SELECT COUNT(*), MAX("createdAt") FROM "PdfChunk"')
+                db_count, db_watermark = cursor.fetchone()
+                if db_count == len(snapshot) and db_watermark == snapshot.watermark:
+                    self._stats["last_refresh_at"] = time.time()
+                    return 0
+                new_rows = []
+                if snapshot.watermark is not None:
+                    cursor.execute(
+                        f'SELECT {self._COLUMNS} FROM "PdfChunk" WHERE "createdAt" > %s',
+                        (snapshot.watermark,)
+                    )
+                    new_rows = cursor.fetchall()
+
+            if snapshot.watermark is None or len(snapshot) + len(new_rows) != db_count:
+                # Deletions (re-embedding) cannot be applied incrementally
+                full_reload = True
+            else:
+                full_reload = False
+                parsed = [r[:5] + (parse_vector(r[5]), r[6]) for r in new_rows]
+                self._snapshot = self._build_from_arrays(self._rows_of(snapshot) + parsed)
+                self._stats["incremental_refreshes"] += 1
+                self._stats["rows_added"] += len(new_rows)
+                self._stats["last_refresh_at"] = time.time()
+
+        if full_reload:
+            self.load()
+            return max(len(self._snapshot) - len(snapshot), 0)
+        print(f"In-memory vector index added {len(new_rows)} new chunks")
+        return len(new_rows)
+
+    def start_refresher(self):
+        """Start a daemon thread that calls refresh() every refresh_interval seconds."""
+        if self.refresh_interval <= 0 or self._refresher is not None:
+            return
+
+        def run():
+            while not self._stop.wait(self.refresh_interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Warning: In-memory vector index refresh failed: {e}")
+
+        self._refresher = threading.Thread(target=run, name="vector-index-refresh", daemon=True)
+        self._refresher.start()
+
+    def stop(self):
+        self._stop.set()
+
+    # ---------- Search ----------
+
+    @staticmethod
+    def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+        if k <= 0 or scores.size == 0:
+            return np.empty(0, dtype=np.int64)
+        if k < scores.size:
+            idx = np.argpartition(-scores, k - 1)[:k]
+        else:
+            idx = np.arange(scores.size)
+        return idx[np.argsort(-scores[idx], kind="stable")]
+
+    def _chunk(self, snapshot: _Snapshot, row: int, score: float, is_current_pdf: bool,
+               with_embeddings: bool = False) -> Dict:
+        pdf, page = snapshot.names[row], snapshot.pages[row]
+        chunk = {
+            "id": snapshot.ids[row],
+            "content": snapshot.contents[row],
+            "metadata": {
+                "page": page,
+                "pdf_name": pdf,
+                "pdf_path": snapshot.paths[row],
+                "source": f"{pdf} - Page {page}",
+                "distance": float(1.0 - score),  # same scale as pgvector's <=> cosine distance
+                "is_current_pdf": is_current_pdf
+            }
+        }
+        if with_embeddings:
+            chunk["embedding"] = snapshot.matrix[row]  # read-only view of the normalized row
+        return chunk
+
+    def search(self, query_embedding: List[float], pdf_path: str = None, k: int = 5, with_embeddings: bool = False):
+        """
+        Exact top-k search inside pdf_path and across all other PDFs.
+        with_embeddings adds each chunk's (normalized) embedding, for MMR.
+
+        Returns:
+            Tuple[List[Dict], List[Dict]]: current-PDF chunks and other-PDF chunks, nearest first
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            raise RuntimeError("In-memory vector index is not loaded")
+        self._stats["searches"] += 1
+        if len(snapshot) == 0:
+            return [], []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        scores = snapshot.matrix @ query
+
+        current_pdf_chunks = []
+        if pdf_path:
+            start, end = snapshot.ranges.get(pdf_path, (0, 0))
+            current_scores = scores[start:end]
+            current_pdf_chunks = [
+                self._chunk(snapshot, start + int(i), current_scores[i], True, with_embeddings)
+                for i in self._top_k(current_scores, k)
+            ]
+            # "pdfPath" != %s excludes both the current PDF and rows without a path
+            other_scores = scores.copy()
+            other_scores[start:end] = -np.inf
+            null_start, null_end = snapshot.ranges.get(None, (0, 0))
+            other_scores[null_start:null_end] = -np.inf
+            excluded = (end - start) + (null_end - null_start)
+            other_idx = self._top_k(other_scores, min(k, len(snapshot) - excluded))
+        else:
+            other_idx = self._top_k(scores, k)
+
+        other_pdf_chunks = [self._chunk(snapshot, int(i), scores[i], False, with_embeddings) for i in other_idx]
+        return current_pdf_chunks, other_pdf_chunks
+
+    def page_content(self, pdf_path: str, page_number: int) -> Optional[str]:
+        """
+        Returns:
+            Optional[str]: Content of the first chunk on the given page, if indexed
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            raise RuntimeError("In-memory vector index is not loaded")
+        row = snapshot.page_rows.get((pdf_path, page_number))
+        return snapshot.contents[row] if row is not None else None
+
+    def stats(self) -> dict:
+        snapshot = self._snapshot
+        stats = dict(self._stats)
+        stats.update({
+            "ready": snapshot is not None,
+            "rows": len(snapshot) if snapshot else 0,
+            "pdfs": len(snapshot.ranges) if snapshot else 0,
+            "matrix_bytes": int(snapshot.matrix.nbytes) if snapshot else 0,
+        })
+        return stats
@@ -7,7 +7,7 @@ const KIWI_BOT_URL = 'http://127.0.0.1:5000/generate_quiz';
 export async function POST(req: NextRequest) {
     try {
         const body = await req.json();
-        const { pdfKey, numberOfQuestions = 1, difficulty = 'medium' } = body;
+        const { pdfKey, numberOfQuestions = 1, difficulty = 'medium', userId } = body;
 
         if (!pdfKey) {
             return NextResponse.json({ error: "PDF key is required" }, { status: 400 });
@@ -23,7 +23,8 @@ export async function POST(req: NextRequest) {
         const requestBody = {
             pdf_path: filename,
             num_questions: numberOfQuestions,
-            difficulty: difficulty
+            difficulty: difficulty,
+            user_id: userId // lets the quiz bank skip questions this user has already seen
         };
         
         console.log("Sending request to Kiwi bot:", JSON.stringify(requestBody));
@@ -621,6 +621,7 @@ export default function ChatPage() {
           pdfKey: selectedPdf,
           numberOfQuestions: quizNumQuestions,
           difficulty: quizDifficulty,
+          userId: user?.id,
         }),
       });
 
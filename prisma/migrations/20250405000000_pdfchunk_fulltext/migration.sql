@@ -0,0 +1,6 @@
+-- AlterTable
+ALTER TABLE "PdfChunk" ADD COLUMN IF NOT EXISTS "contentTsv" tsvector
+    GENERATED ALWAYS AS (to_tsvector('english'::regconfig, "content")) STORED;
+
+-- CreateIndex
+CREATE INDEX IF NOT EXISTS "pdf_chunk_content_tsv_idx" ON "PdfChunk" USING GIN ("contentTsv");
@@ -0,0 +1,8 @@
+-- CreateTable
+CREATE TABLE IF NOT EXISTS "CorpusState" (
+    "id" INTEGER NOT NULL,
+    "generation" BIGINT NOT NULL DEFAULT 0,
+    "updatedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "CorpusState_pkey" PRIMARY KEY ("id")
+);
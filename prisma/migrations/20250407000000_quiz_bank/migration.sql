@@ -0,0 +1,34 @@
+-- CreateTable
+CREATE TABLE IF NOT EXISTS "QuizBankQuestion" (
+    "id" TEXT NOT NULL,
+    "pdfPath" TEXT NOT NULL,
+    "pageStart" INTEGER NOT NULL,
+    "pageEnd" INTEGER NOT NULL,
+    "difficulty" TEXT NOT NULL,
+    "question" TEXT NOT NULL,
+    "options" JSONB NOT NULL,
+    "correctAnswer" TEXT NOT NULL,
+    "explanation" TEXT NOT NULL,
+    "source" TEXT NOT NULL DEFAULT 'offline',
+    "createdAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "QuizBankQuestion_pkey" PRIMARY KEY ("id")
+);
+
+-- CreateTable
+CREATE TABLE IF NOT EXISTS "QuizBankSeen" (
+    "userId" TEXT NOT NULL,
+    "questionId" TEXT NOT NULL,
+    "seenAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "QuizBankSeen_pkey" PRIMARY KEY ("userId", "questionId")
+);
+
+-- CreateIndex
+CREATE INDEX IF NOT EXISTS "quiz_bank_pdf_difficulty_idx" ON "QuizBankQuestion"("pdfPath", "difficulty");
+
+-- AddForeignKey (build_quiz_bank.py may already have created the tables)
+DO $$ BEGIN
+    ALTER TABLE "QuizBankSeen" ADD CONSTRAINT "QuizBankSeen_questionId_fkey" FOREIGN KEY ("questionId") REFERENCES "QuizBankQuestion"("id") ON DELETE CASCADE ON UPDATE CASCADE;
+EXCEPTION WHEN duplicate_object THEN NULL;
+END $$;
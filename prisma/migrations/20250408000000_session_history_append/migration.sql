@@ -0,0 +1,22 @@
+-- AlterTable
+ALTER TABLE "UserSession" ADD COLUMN IF NOT EXISTS "messageCount" INTEGER NOT NULL DEFAULT 0;
+
+-- Backfill: every session holds a JSON array (so turns can be appended with jsonb concatenation)
+-- and its length
+UPDATE "UserSession" s
+SET "conversationhistory" = b."history",
+    "messageCount" = jsonb_array_length(b."history")
+FROM (
+    SELECT id, CASE
+            WHEN "conversationhistory" IS NULL OR jsonb_typeof("conversationhistory") = 'null' THEN '[]'::jsonb
+            WHEN jsonb_typeof("conversationhistory") = 'array' THEN "conversationhistory"
+            ELSE jsonb_build_array("conversationhistory")
+        END AS "history"
+    FROM "UserSession"
+) b
+WHERE s.id = b.id;
+
+-- CreateIndex (the active session of a user is looked up on every turn)
+CREATE INDEX IF NOT EXISTS "UserSession_userId_active_idx"
+    ON "UserSession"("userId", "sessionStartTime" DESC)
+    WHERE "sessionEndTime" IS NULL;
@@ -0,0 +1,3 @@
+-- AlterTable: rolling summary of the first "summaryUpTo" entries of "conversationhistory"
+ALTER TABLE "UserSession" ADD COLUMN IF NOT EXISTS "historySummary" TEXT;
+ALTER TABLE "UserSession" ADD COLUMN IF NOT EXISTS "summaryUpTo" INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,3 @@
+-- CreateIndex (keyset pagination of a user's sessions in /session_history)
+CREATE INDEX IF NOT EXISTS "UserSession_userId_sessionStartTime_id_idx"
+    ON "UserSession"("userId", "sessionStartTime" DESC, "id" DESC);